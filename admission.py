@@ -0,0 +1,130 @@
+"""Admission control for expensive hotel searches.
+
+At most `limit` searches run at once, and at most `per_user` of them for one
+user. Searches beyond that wait in a FIFO queue. A waiting search of a user
+who is already at their own limit lets the searches behind it go first, so one
+user cannot hold up the line. While a search waits, its caller is told its
+position in the queue, each time the position changes (at most every
+POSITION_UPDATE_INTERVAL seconds). A full queue refuses new searches with
+QueueFull."""
+import asyncio
+import time
+from collections import defaultdict, deque
+from contextlib import asynccontextmanager
+import metrics
+from config import SEARCH_CONCURRENCY, SEARCH_USER_CONCURRENCY, SEARCH_QUEUE_MAX
+
+POSITION_UPDATE_INTERVAL = 3
+
+
+class QueueFull(Exception):
+    pass
+
+
+class _Waiter:
+    # `changed` is set whenever the waiter moves up or is admitted
+    __slots__ = ("user_id", "granted", "changed")
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.granted = asyncio.Event()
+        self.changed = asyncio.Event()
+
+
+class AdmissionController:
+    def __init__(self, limit=SEARCH_CONCURRENCY, per_user=SEARCH_USER_CONCURRENCY, max_queue=SEARCH_QUEUE_MAX):
+        self.limit = limit
+        self.per_user = per_user
+        self.max_queue = max_queue
+        self.running = 0
+        self._per_user = defaultdict(int)
+        self._queue = deque()
+
+    def _can_run(self, user_id):
+        return self.running < self.limit and self._per_user.get(user_id, 0) < self.per_user
+
+    def _grant(self, user_id):
+        self.running += 1
+        self._per_user[user_id] += 1
+        self._update_gauges()
+
+    def _release(self, user_id):
+        self.running -= 1
+        self._per_user[user_id] -= 1
+        if not self._per_user[user_id]:
+            del self._per_user[user_id]
+        self._admit_waiting()
+
+    def _admit_waiting(self):
+        admitted = False
+        for waiter in list(self._queue):
+            if self.running >= self.limit:
+                break
+            if self._can_run(waiter.user_id):
+                self._queue.remove(waiter)
+                self._grant(waiter.user_id)
+                waiter.granted.set()
+                waiter.changed.set()
+                admitted = True
+        if admitted:
+            # Everybody still waiting moved up
+            for waiter in self._queue:
+                waiter.changed.set()
+        self._update_gauges()
+
+    def _update_gauges(self):
+        metrics.searches_running.set(self.running)
+        metrics.searches_queued.set(len(self._queue))
+
+    def position(self, waiter):
+        return self._queue.index(waiter) + 1
+
+    @asynccontextmanager
+    async def slot(self, user_id, on_position=None):
+        """Hold one search slot for `user_id` while the block runs.
+
+        `on_position(position)` is awaited when the search has to queue and
+        whenever its position changes afterwards."""
+        started = time.monotonic()
+        if len(self._queue) >= self.max_queue:
+            metrics.searches_rejected.inc()
+            raise QueueFull()
+        waiter = _Waiter(user_id)
+        self._queue.append(waiter)
+        self._admit_waiting()
+        if not waiter.granted.is_set():
+            try:
+                await self._wait_turn(waiter, on_position)
+            except BaseException:
+                if waiter.granted.is_set():
+                    self._release(user_id)
+                else:
+                    self._queue.remove(waiter)
+                    for other in self._queue:
+                        other.changed.set()
+                    self._update_gauges()
+                raise
+        metrics.admission_wait.observe(time.monotonic() - started)
+        try:
+            yield
+        finally:
+            self._release(user_id)
+
+    async def _wait_turn(self, waiter, on_position):
+        reported = None
+        while not waiter.granted.is_set():
+            position = self.position(waiter)
+            if on_position is not None and position != reported:
+                reported = position
+                await on_position(position)
+                # Throttle position updates; being admitted still wakes us at once
+                try:
+                    await asyncio.wait_for(waiter.granted.wait(), POSITION_UPDATE_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            waiter.changed.clear()
+            await waiter.changed.wait()
+
+
+controller = AdmissionController()
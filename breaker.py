@@ -0,0 +1,90 @@
+"""Per-endpoint health tracking for the booking-com15 client.
+
+A CircuitBreaker opens after `failures` consecutive failed calls to one
+endpoint. While it is open, calls fail at once instead of waiting for a
+timeout. After `reset_after` seconds a single call is let through as a probe:
+if it succeeds the breaker closes, if it fails the breaker stays open for
+another `reset_after` seconds.
+
+LatencyWindow keeps the latencies of an endpoint's recent successful calls.
+The client uses their p95 to decide when a slow call gets a hedged duplicate."""
+import logging
+import math
+import time
+from collections import deque
+import metrics
+from config import RAPIDAPI_BREAKER_FAILURES, RAPIDAPI_BREAKER_RESET
+
+logger = logging.getLogger(__name__)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+# Values of the rapidapi_breaker_state gauge
+STATE_VALUES = {CLOSED: 0, OPEN: 1, HALF_OPEN: 2}
+
+
+class CircuitBreaker:
+    def __init__(self, name, failures=RAPIDAPI_BREAKER_FAILURES, reset_after=RAPIDAPI_BREAKER_RESET):
+        self.name = name
+        self.failures = failures
+        self.reset_after = reset_after
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.probe_started = None
+        metrics.breaker_state.set(STATE_VALUES[CLOSED], endpoint=name)
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return CLOSED
+        return OPEN if time.monotonic() - self.opened_at < self.reset_after else HALF_OPEN
+
+    def allow(self):
+        """Whether a call may go out now. In the half-open state this lets one
+        probe through and keeps refusing the others until it reports back or
+        another `reset_after` seconds pass."""
+        state = self.state
+        if state == CLOSED:
+            return True
+        now = time.monotonic()
+        if state == HALF_OPEN and (self.probe_started is None or now - self.probe_started > self.reset_after):
+            self.probe_started = now
+            metrics.breaker_state.set(STATE_VALUES[HALF_OPEN], endpoint=self.name)
+            return True
+        metrics.breaker_rejected.inc(endpoint=self.name)
+        return False
+
+    def record_success(self):
+        self.consecutive_failures = 0
+        if self.opened_at is not None:
+            logger.info(f"Circuit for {self.name} closed")
+            self.opened_at = self.probe_started = None
+            metrics.breaker_state.set(STATE_VALUES[CLOSED], endpoint=self.name)
+
+    def record_failure(self):
+        self.consecutive_failures += 1
+        # A failed probe re-opens at once; a closed breaker waits for the threshold
+        if self.opened_at is not None or self.consecutive_failures >= self.failures:
+            if self.opened_at is None:
+                logger.warning(f"Circuit for {self.name} opened after {self.consecutive_failures} failures")
+            self.opened_at = time.monotonic()
+            self.probe_started = None
+            metrics.breaker_state.set(STATE_VALUES[OPEN], endpoint=self.name)
+
+
+class LatencyWindow:
+    def __init__(self, size=200, min_samples=20):
+        self.min_samples = min_samples
+        self._samples = deque(maxlen=size)
+
+    def observe(self, seconds):
+        self._samples.append(seconds)
+
+    def quantile(self, q):
+        """The q-quantile of the recent samples, None while there are too few."""
+        if len(self._samples) < self.min_samples:
+            return None
+        ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, math.ceil(q * len(ordered)) - 1)]
@@ -0,0 +1,127 @@
+"""Response cache for the booking-com15 endpoints.
+
+Entries are keyed by endpoint plus canonicalized query params (see make_key)
+and expire after a per-entry TTL. Both backends are bounded: once more than
+`max_entries` keys are stored the least recently used ones are evicted.
+Expired entries stay until then, so get(key, stale=True) can still return
+them when the upstream API is down."""
+import asyncio
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import urlencode
+from config import CACHE_BACKEND, CACHE_PATH, CACHE_MAX_ENTRIES
+
+# Free-text params the API treats case-insensitively
+CASE_INSENSITIVE_PARAMS = {"query"}
+
+
+def make_key(endpoint, params):
+    canonical = []
+    for k, v in sorted((params or {}).items()):
+        if v is None or v == "":
+            continue
+        v = " ".join(str(v).split())
+        if k in CASE_INSENSITIVE_PARAMS:
+            v = v.casefold()
+        canonical.append((k, v))
+    return f"{endpoint}?{urlencode(canonical)}"
+
+
+class MemoryCache:
+    def __init__(self, max_entries=CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+
+    async def get(self, key, stale=False):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at < time.time() and not stale:
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    async def set(self, key, value, ttl):
+        self._entries[key] = (time.time() + ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def close(self):
+        self._entries.clear()
+
+
+class SqliteCache:
+    """File-backed cache that survives restarts. Queries run in a worker thread
+    so the event loop never waits on disk I/O."""
+
+    def __init__(self, path=CACHE_PATH, max_entries=CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS responses (
+            key TEXT PRIMARY KEY,
+            value TEXT,
+            expires_at REAL,
+            accessed_at REAL
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)")
+        self._conn.commit()
+
+    def _get(self, key, stale):
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, expires_at FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None or (row[1] < now and not stale):
+                return None
+            self._conn.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+        return json.loads(row[0])
+
+    def _set(self, key, value, ttl):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO responses (key, value, expires_at, accessed_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET value = excluded.value, "
+                "expires_at = excluded.expires_at, accessed_at = excluded.accessed_at",
+                (key, json.dumps(value), now + ttl, now)
+            )
+            self._conn.execute(
+                "DELETE FROM responses WHERE key IN ("
+                "SELECT key FROM responses ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,)
+            )
+            self._conn.commit()
+
+    async def get(self, key, stale=False):
+        return await asyncio.to_thread(self._get, key, stale)
+
+    async def set(self, key, value, ttl):
+        await asyncio.to_thread(self._set, key, value, ttl)
+
+    async def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+BACKENDS = {
+    "memory": MemoryCache,
+    "sqlite": SqliteCache,
+}
+
+
+def create_cache(backend=CACHE_BACKEND):
+    try:
+        return BACKENDS[backend]()
+    except KeyError:
+        raise ValueError(f"Unknown cache backend: {backend!r}") from None
@@ -4,4 +4,67 @@ from dotenv import load_dotenv
 load_dotenv()
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
-RAPIDAPI_KEY = os.getenv("RAPIDAPI_KEY")
\ No newline at end of file
+RAPIDAPI_KEY = os.getenv("RAPIDAPI_KEY")
+RAPIDAPI_HOST = os.getenv("RAPIDAPI_HOST", "booking-com15.p.rapidapi.com")
+RAPIDAPI_BASE_URL = os.getenv("RAPIDAPI_BASE_URL", f"https://{RAPIDAPI_HOST}/api/v1/hotels/")
+RAPIDAPI_TIMEOUT = float(os.getenv("RAPIDAPI_TIMEOUT", "10"))
+RAPIDAPI_CONCURRENCY = int(os.getenv("RAPIDAPI_CONCURRENCY", "8"))
+CACHE_BACKEND = os.getenv("CACHE_BACKEND", "memory")
+CACHE_PATH = os.getenv("CACHE_PATH", "cache.db")
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "2000"))
+SESSION_CACHE_SIZE = int(os.getenv("SESSION_CACHE_SIZE", "10000"))
+SESSION_IDLE_TTL = float(os.getenv("SESSION_IDLE_TTL", "1800"))
+SESSION_FLUSH_INTERVAL = float(os.getenv("SESSION_FLUSH_INTERVAL", "5"))
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9464"))
+METRICS_LOG_INTERVAL = float(os.getenv("METRICS_LOG_INTERVAL", "60"))
+RAPIDAPI_RATE = float(os.getenv("RAPIDAPI_RATE", "5"))
+RAPIDAPI_BURST = int(os.getenv("RAPIDAPI_BURST", "15"))
+RAPIDAPI_USER_RATE = float(os.getenv("RAPIDAPI_USER_RATE", "1"))
+RAPIDAPI_USER_BURST = int(os.getenv("RAPIDAPI_USER_BURST", "15"))
+RAPIDAPI_DAILY_QUOTA = int(os.getenv("RAPIDAPI_DAILY_QUOTA", "0"))
+RAPIDAPI_MONTHLY_QUOTA = int(os.getenv("RAPIDAPI_MONTHLY_QUOTA", "0"))
+RAPIDAPI_QUOTA_STATE = os.getenv("RAPIDAPI_QUOTA_STATE", "quota.json")
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_BASE_URL = os.getenv("WEBHOOK_BASE_URL", "")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", os.getenv("PORT", "8080")))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBHOOK_MAX_IN_FLIGHT = int(os.getenv("WEBHOOK_MAX_IN_FLIGHT", "100"))
+DESTINATION_INDEX_PATH = os.getenv("DESTINATION_INDEX_PATH", "destinations.json")
+DESTINATION_INDEX_TTL = float(os.getenv("DESTINATION_INDEX_TTL", str(7 * 24 * 3600)))
+DESTINATION_INDEX_MAX = int(os.getenv("DESTINATION_INDEX_MAX", "50000"))
+RESULTS_MAX_AGE = float(os.getenv("RESULTS_MAX_AGE", "600"))
+FSM_STORAGE = os.getenv("FSM_STORAGE", "db")
+FSM_STATE_TTL = float(os.getenv("FSM_STATE_TTL", str(24 * 3600)))
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+SHARD_WORKERS = int(os.getenv("SHARD_WORKERS", "1"))
+SHARD_MAX_IN_FLIGHT = int(os.getenv("SHARD_MAX_IN_FLIGHT", "100"))
+# Set by sharding.py in worker processes; -1 everywhere else
+SHARD_INDEX = int(os.getenv("SHARD_INDEX", "-1"))
+SESSION_TTL = float(os.getenv("SESSION_TTL", str(7 * 24 * 3600)))
+SESSION_GC_INTERVAL = float(os.getenv("SESSION_GC_INTERVAL", "3600"))
+SESSION_ANALYZE_INTERVAL = float(os.getenv("SESSION_ANALYZE_INTERVAL", str(24 * 3600)))
+LOG_PATH = os.getenv("LOG_PATH", "bot.log")
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_DEBUG_MODULES = os.getenv("LOG_DEBUG_MODULES", "")
+LOG_MAX_FIELD = int(os.getenv("LOG_MAX_FIELD", "2000"))
+LOG_PAYLOAD_SAMPLE = float(os.getenv("LOG_PAYLOAD_SAMPLE", "0.01"))
+TELEGRAM_RATE = float(os.getenv("TELEGRAM_RATE", "30"))
+TELEGRAM_BURST = int(os.getenv("TELEGRAM_BURST", "30"))
+TELEGRAM_CHAT_RATE = float(os.getenv("TELEGRAM_CHAT_RATE", "1"))
+TELEGRAM_CHAT_BURST = int(os.getenv("TELEGRAM_CHAT_BURST", "20"))
+RAPIDAPI_RETRIES = int(os.getenv("RAPIDAPI_RETRIES", "2"))
+RAPIDAPI_RETRY_BACKOFF = float(os.getenv("RAPIDAPI_RETRY_BACKOFF", "0.3"))
+RAPIDAPI_BREAKER_FAILURES = int(os.getenv("RAPIDAPI_BREAKER_FAILURES", "5"))
+RAPIDAPI_BREAKER_RESET = float(os.getenv("RAPIDAPI_BREAKER_RESET", "30"))
+RAPIDAPI_HEDGE_QUANTILE = float(os.getenv("RAPIDAPI_HEDGE_QUANTILE", "0.95"))
+SEARCH_CONCURRENCY = int(os.getenv("SEARCH_CONCURRENCY", "20"))
+SEARCH_USER_CONCURRENCY = int(os.getenv("SEARCH_USER_CONCURRENCY", "1"))
+SEARCH_QUEUE_MAX = int(os.getenv("SEARCH_QUEUE_MAX", "200"))
+LOOP_LAG_INTERVAL = float(os.getenv("LOOP_LAG_INTERVAL", "0.25"))
+LOOP_STALL_THRESHOLD = float(os.getenv("LOOP_STALL_THRESHOLD", "0.3"))
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", "0.005"))
+PROFILE_MAX_SECONDS = int(os.getenv("PROFILE_MAX_SECONDS", "60"))
+ADMIN_IDS = {int(user_id) for user_id in os.getenv("ADMIN_IDS", "").split(",") if user_id.strip()}
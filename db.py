@@ -1,73 +1,595 @@
-import json
+import asyncio
+import logging
 import sqlite3
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, fields as dataclass_fields, astuple
+from typing import Optional
+import metrics
+from config import (
+    SESSION_CACHE_SIZE, SESSION_IDLE_TTL, SESSION_FLUSH_INTERVAL,
+    SESSION_TTL, SESSION_GC_INTERVAL, SESSION_ANALYZE_INTERVAL, SHARD_INDEX
+)
+
+__all__ = [
+    "Session", "Location", "Hotel",
+    "init_db", "get_session", "set_session", "update_session", "clear_session",
+    "get_locations", "set_locations", "get_hotels", "set_hotels",
+    "get_photo_file_ids", "save_photo_file_ids", "forget_photo_file_ids",
+    "start_maintenance", "stop_maintenance", "close_db",
+]
+
+logger = logging.getLogger(__name__)
 
 DB_PATH = "users.db"
 
-def init_db():
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("""
+
+@dataclass(slots=True)
+class Session:
+    user_id: int
+    city_name: Optional[str] = None
+    country: Optional[str] = None
+    location_photo: Optional[str] = None
+    latitude: Optional[float] = None
+    longitude: Optional[float] = None
+    dest_id: Optional[str] = None
+    search_type: Optional[str] = None
+    checkin: Optional[str] = None
+    checkout: Optional[str] = None
+    adults: Optional[int] = None
+    children: Optional[str] = None
+    room: Optional[int] = None
+    max_price: Optional[int] = None
+    chosen_hotel_id: Optional[str] = None
+    # aiogram FSM state and data (JSON) of the conversation, see fsm_storage.py
+    fsm_state: Optional[str] = None
+    fsm_data: Optional[str] = None
+    fsm_updated_at: Optional[float] = None
+    # Unix time of the last write; sessions idle for SESSION_TTL are deleted
+    last_activity: Optional[float] = None
+
+
+@dataclass(slots=True)
+class Location:
+    """The part of a searchDestination/getNearbyCities entry the flow reads back."""
+    label: str
+    name: str
+    city_name: str
+    country: str
+    image_url: str
+    latitude: Optional[float]
+    longitude: Optional[float]
+    dest_id: str
+    search_type: str
+
+    @classmethod
+    def from_api(cls, loc):
+        return cls(
+            label=loc.get("label") or loc.get("name", ""),
+            name=loc.get("name", ""),
+            city_name=loc.get("city_name") or loc.get("name", ""),
+            country=loc.get("country", ""),
+            image_url=loc.get("image_url") or "",
+            latitude=loc.get("latitude"),
+            longitude=loc.get("longitude"),
+            dest_id=str(loc.get("dest_id", "")),
+            search_type=(loc.get("search_type") or loc.get("dest_type") or "").upper()
+        )
+
+
+@dataclass(slots=True)
+class Hotel:
+    hotel_id: str
+    name: str
+    description: str
+
+
+SESSION_COLUMNS = tuple(f.name for f in dataclass_fields(Session))[1:]
+
+# Child collections: session attribute -> (table, row type)
+CHILD_TABLES = {
+    "locations": ("session_locations", Location),
+    "hotels": ("session_hotels", Hotel),
+}
+
+_SQL_TYPES = {int: "INTEGER", float: "REAL", str: "TEXT"}
+
+# Child rows kept per user and collection; only the first pages are ever shown
+MAX_CHILD_ROWS = 120
+# Longest hotel description kept: it ends up in a photo caption, which
+# Telegram caps at 1024 characters anyway
+MAX_DESCRIPTION = 1024
+# Rows deleted per statement, so the db thread is never held for long
+GC_BATCH = 500
+
+# Every query runs on this single thread, which owns one persistent connection,
+# so handlers never block the event loop on disk I/O and writes are serialized.
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db")
+_conn = None
+
+
+def _connection():
+    global _conn
+    if _conn is None:
+        _conn = sqlite3.connect(DB_PATH)
+        _conn.execute("PRAGMA journal_mode=WAL")
+        _conn.execute("PRAGMA synchronous=NORMAL")
+    return _conn
+
+
+async def _run(func, *args):
+    loop = asyncio.get_running_loop()
+    with metrics.db_duration.time(operation=func.__name__.lstrip("_")):
+        return await loop.run_in_executor(_executor, func, *args)
+
+
+def _column_type(annotation):
+    for python_type, sql_type in _SQL_TYPES.items():
+        if annotation in (python_type, Optional[python_type]):
+            return sql_type
+    return "TEXT"
+
+
+def _column_defs(row_type):
+    return ",\n".join(f"        {f.name} {_column_type(f.type)}" for f in dataclass_fields(row_type))
+
+
+def _init_db():
+    conn = _connection()
+    # Shard workers find the schema already prepared by the front process
+    # (see prepare), so only one process ever migrates or VACUUMs
+    if SHARD_INDEX < 0 and conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        # Only takes effect through a VACUUM; afterwards freed pages can be
+        # returned to the OS a few at a time with PRAGMA incremental_vacuum
+        logger.info("Switching users.db to incremental auto-vacuum")
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        conn.execute("VACUUM")
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(sessions)")]
+    if "locations" in columns:
+        # Sessions from before the typed schema kept JSON blobs; they only hold
+        # in-progress conversations, so start them over
+        logger.warning("Dropping legacy sessions table")
+        conn.execute("DROP TABLE sessions")
+
+    session_columns = _column_defs(Session).replace("user_id INTEGER", "user_id INTEGER PRIMARY KEY")
+    conn.execute(f"""
         CREATE TABLE IF NOT EXISTS sessions (
-        user_id INTEGER PRIMARY KEY,
-        city_name TEXT,
-        country TEXT,
-        location_photo TEXT,
-        latitude TEXT,
-        longitude TEXT,
-        dest_id TEXT,
-        search_type TEXT,
-        checkin TEXT,
-        checkout TEXT,
-        adults TEXT,
-        children TEXT,
-        room TEXT,
-        hotel_descriptions TEXT,
-        max_price TEXT,
-        photo_urls TEXT,
-        locations TEXT,
-        hotels_dict TEXT,
-        chosen_hotel_id TEXT
+{session_columns}
+        )
+    """)
+    # Fields added to Session later become nullable columns of existing tables
+    existing = {row[1] for row in conn.execute("PRAGMA table_info(sessions)")}
+    for f in dataclass_fields(Session):
+        if f.name not in existing:
+            conn.execute(f"ALTER TABLE sessions ADD COLUMN {f.name} {_column_type(f.type)}")
+    # Rows from before last_activity existed get a full TTL from now
+    conn.execute("UPDATE sessions SET last_activity = ? WHERE last_activity IS NULL", (time.time(),))
+    conn.execute("CREATE INDEX IF NOT EXISTS sessions_last_activity ON sessions (last_activity)")
+    for table, row_type in CHILD_TABLES.values():
+        conn.execute(f"""
+            CREATE TABLE IF NOT EXISTS {table} (
+            user_id INTEGER NOT NULL,
+            position INTEGER NOT NULL,
+{_column_defs(row_type)},
+            PRIMARY KEY (user_id, position)
+            )
+        """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS photo_file_ids (
+        url TEXT PRIMARY KEY,
+        file_id TEXT NOT NULL
         )
     """)
     conn.commit()
-    conn.close()
 
-def set_session(user_id, key, value):
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
 
-    if isinstance(value, (dict, list)):
-        value = json.dumps(value)
+def _check_fields(fields):
+    for key in fields:
+        if key not in SESSION_COLUMNS:
+            raise ValueError(f"Unknown session field: {key}")
 
-    cursor.execute("SELECT user_id FROM sessions WHERE user_id = ?", (user_id,))
-    if cursor.fetchone():
-        cursor.execute(f"UPDATE sessions SET {key} = ? WHERE user_id = ?", (value, user_id))
-    else:
-        cursor.execute(f"INSERT INTO sessions (user_id, {key}) VALUES (?, ?)", (user_id, value))
-    conn.commit()
-    conn.close()
-
-def get_session(user_id):
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM sessions WHERE user_id = ?", (user_id,))
-    row = cursor.fetchone()
-    keys = [description[0] for description in cursor.description]
-    conn.close()
+
+def _flush(cleared, updates, children):
+    conn = _connection()
+    with conn:
+        for table in ["sessions"] + [table for table, _ in CHILD_TABLES.values()]:
+            conn.executemany(f"DELETE FROM {table} WHERE user_id = ?", [(user_id,) for user_id in cleared])
+
+        for user_id, fields in updates.items():
+            columns = list(fields)
+            placeholders = ", ".join("?" for _ in range(len(columns) + 1))
+            assignments = ", ".join(f"{column} = excluded.{column}" for column in columns)
+            conn.execute(
+                f"INSERT INTO sessions (user_id, {', '.join(columns)}) VALUES ({placeholders}) "
+                f"ON CONFLICT(user_id) DO UPDATE SET {assignments}",
+                (user_id, *fields.values())
+            )
+
+        for (user_id, name), rows in children.items():
+            table, row_type = CHILD_TABLES[name]
+            columns = [f.name for f in dataclass_fields(row_type)]
+            placeholders = ", ".join("?" for _ in range(len(columns) + 2))
+            conn.execute(f"DELETE FROM {table} WHERE user_id = ?", (user_id,))
+            conn.executemany(
+                f"INSERT INTO {table} (user_id, position, {', '.join(columns)}) VALUES ({placeholders})",
+                [(user_id, position, *row) for position, row in enumerate(rows)]
+            )
+
+
+def _get_session(user_id):
+    row = _connection().execute(
+        f"SELECT user_id, {', '.join(SESSION_COLUMNS)} FROM sessions WHERE user_id = ?", (user_id,)
+    ).fetchone()
     if row:
-        data = dict(zip(keys, row))
-        for k, v in data.items():
-            if isinstance(v, str):
-                try:
-                    data[k] = json.loads(v)
-                except (json.JSONDecodeError, TypeError):
-                    pass
-        return data
-    return {}
-
-def clear_session(user_id):
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("DELETE FROM sessions WHERE user_id = ?", (user_id,))
-    conn.commit()
-    conn.close()
\ No newline at end of file
+        return Session(*row)
+    return Session(user_id)
+
+
+def _get_children(user_id, name):
+    table, row_type = CHILD_TABLES[name]
+    columns = [f.name for f in dataclass_fields(row_type)]
+    rows = _connection().execute(
+        f"SELECT {', '.join(columns)} FROM {table} WHERE user_id = ? ORDER BY position", (user_id,)
+    ).fetchall()
+    return [row_type(*row) for row in rows]
+
+
+def _get_photo_file_ids(urls):
+    placeholders = ", ".join("?" for _ in urls)
+    rows = _connection().execute(
+        f"SELECT url, file_id FROM photo_file_ids WHERE url IN ({placeholders})", list(urls)
+    ).fetchall()
+    return dict(rows)
+
+
+def _save_photo_file_ids(file_ids):
+    conn = _connection()
+    with conn:
+        conn.executemany(
+            "INSERT INTO photo_file_ids (url, file_id) VALUES (?, ?) "
+            "ON CONFLICT(url) DO UPDATE SET file_id = excluded.file_id",
+            list(file_ids.items())
+        )
+
+
+def _forget_photo_file_ids(urls):
+    conn = _connection()
+    with conn:
+        conn.executemany("DELETE FROM photo_file_ids WHERE url = ?", [(url,) for url in urls])
+
+
+def _expire_sessions(cutoff):
+    """Delete sessions last written before `cutoff`, with their child rows."""
+    conn = _connection()
+    expired = []
+    while True:
+        rows = conn.execute(
+            "SELECT user_id FROM sessions WHERE last_activity < ? LIMIT ?", (cutoff, GC_BATCH)
+        ).fetchall()
+        if not rows:
+            break
+        with conn:
+            for table in ["sessions"] + [table for table, _ in CHILD_TABLES.values()]:
+                conn.executemany(f"DELETE FROM {table} WHERE user_id = ?", rows)
+        expired += [user_id for user_id, in rows]
+    return expired
+
+
+def _trim_sessions():
+    """Drop child rows past MAX_CHILD_ROWS, child rows left without a session
+    and over-long hotel descriptions; returns the number of rows changed."""
+    conn = _connection()
+    changed = 0
+    with conn:
+        for table, _ in CHILD_TABLES.values():
+            changed += conn.execute(f"DELETE FROM {table} WHERE position >= ?", (MAX_CHILD_ROWS,)).rowcount
+            changed += conn.execute(
+                f"DELETE FROM {table} WHERE user_id NOT IN (SELECT user_id FROM sessions)"
+            ).rowcount
+        changed += conn.execute(
+            "UPDATE session_hotels SET description = substr(description, 1, ?) WHERE length(description) > ?",
+            (MAX_DESCRIPTION, MAX_DESCRIPTION)
+        ).rowcount
+    return changed
+
+
+def _compact(analyze):
+    conn = _connection()
+    conn.execute("PRAGMA incremental_vacuum(1000)").fetchall()
+    if analyze:
+        conn.execute("ANALYZE")
+        conn.commit()
+
+
+def _close_db():
+    global _conn
+    if _conn is not None:
+        _conn.close()
+    _conn = None
+
+
+class SessionCache:
+    """Write-behind cache of decoded sessions.
+
+    Reads are served from memory after the first load, writes only mark fields
+    dirty; dirty fields are written to SQLite in one batch every
+    SESSION_FLUSH_INTERVAL seconds and on shutdown. Child collections are
+    loaded separately, on first use. Clean sessions are evicted when idle for
+    longer than SESSION_IDLE_TTL or when more than SESSION_CACHE_SIZE are held
+    (least recently used first)."""
+
+    def __init__(self, max_sessions=SESSION_CACHE_SIZE, idle_ttl=SESSION_IDLE_TTL):
+        self.max_sessions = max_sessions
+        self.idle_ttl = idle_ttl
+        self._sessions = OrderedDict()
+        self._children = {}
+        self._last_access = {}
+        self._dirty = {}
+        self._dirty_children = {}
+        self._cleared = set()
+        self._flushing = set()
+
+    def _touch(self, user_id):
+        self._sessions.move_to_end(user_id)
+        self._last_access[user_id] = time.monotonic()
+
+    def _is_dirty(self, user_id):
+        return (
+            user_id in self._dirty or user_id in self._dirty_children
+            or user_id in self._cleared or user_id in self._flushing
+        )
+
+    async def _load(self, user_id):
+        if user_id not in self._sessions:
+            session = await _run(_get_session, user_id)
+            # Another coroutine may have loaded or written it meanwhile
+            if user_id not in self._sessions:
+                self._sessions[user_id] = session
+                self._touch(user_id)
+                self.evict(keep=user_id)
+        self._touch(user_id)
+        return self._sessions[user_id]
+
+    async def get(self, user_id):
+        session = await self._load(user_id)
+        return Session(*astuple(session))
+
+    async def update(self, user_id, fields):
+        _check_fields(fields)
+        session = await self._load(user_id)
+        for key, value in fields.items():
+            setattr(session, key, value)
+        session.last_activity = time.time()
+        self._dirty.setdefault(user_id, set()).update(fields, ("last_activity",))
+
+    async def get_children(self, user_id, name):
+        await self._load(user_id)
+        key = (user_id, name)
+        if key not in self._children:
+            rows = await _run(_get_children, user_id, name)
+            self._children.setdefault(key, rows)
+        return list(self._children[key])
+
+    async def set_children(self, user_id, name, rows):
+        session = await self._load(user_id)
+        self._children[(user_id, name)] = list(rows)
+        self._dirty_children.setdefault(user_id, set()).add(name)
+        # Also makes sure the sessions row exists for the expiry scan
+        session.last_activity = time.time()
+        self._dirty.setdefault(user_id, set()).add("last_activity")
+
+    def clear(self, user_id):
+        self._sessions[user_id] = Session(user_id)
+        self._touch(user_id)
+        for name in CHILD_TABLES:
+            self._children[(user_id, name)] = []
+        self._dirty.pop(user_id, None)
+        self._dirty_children.pop(user_id, None)
+        self._cleared.add(user_id)
+
+    async def flush(self):
+        if not self._dirty and not self._dirty_children and not self._cleared:
+            return
+        cleared, self._cleared = self._cleared, set()
+        dirty, self._dirty = self._dirty, {}
+        dirty_children, self._dirty_children = self._dirty_children, {}
+
+        # A dirty key whose session is no longer cached has nothing left to write
+        dirty = {user_id: keys for user_id, keys in dirty.items() if user_id in self._sessions}
+        dirty_children = {
+            user_id: {name for name in names if (user_id, name) in self._children}
+            for user_id, names in dirty_children.items()
+        }
+        updates = {
+            user_id: {key: getattr(self._sessions[user_id], key) for key in keys}
+            for user_id, keys in dirty.items()
+        }
+        children = {
+            (user_id, name): [astuple(row) for row in self._children[(user_id, name)]]
+            for user_id, names in dirty_children.items()
+            for name in names
+        }
+        # The batch stays dirty for evict() until it is written
+        self._flushing = set(updates) | set(dirty_children) | cleared
+        try:
+            await _run(_flush, cleared, updates, children)
+        except Exception:
+            # Keep the batch for the next attempt
+            self._cleared |= cleared
+            for user_id, keys in dirty.items():
+                self._dirty.setdefault(user_id, set()).update(keys)
+            for user_id, names in dirty_children.items():
+                if names:
+                    self._dirty_children.setdefault(user_id, set()).update(names)
+            raise
+        finally:
+            self._flushing = set()
+
+    def forget(self, user_ids):
+        """Account for sessions whose rows were deleted behind our back.
+
+        Clean ones are dropped. One written to since the expiry scan belongs
+        to a user who is back; all of it is marked dirty, so the next flush
+        writes the whole row again instead of a partial one."""
+        for user_id in user_ids:
+            if user_id not in self._sessions:
+                continue
+            if not self._is_dirty(user_id):
+                self._drop(user_id)
+                continue
+            self._dirty[user_id] = set(SESSION_COLUMNS)
+            self._dirty_children[user_id] = {name for name in CHILD_TABLES if (user_id, name) in self._children}
+
+    def _drop(self, user_id):
+        del self._sessions[user_id]
+        del self._last_access[user_id]
+        for name in CHILD_TABLES:
+            self._children.pop((user_id, name), None)
+
+    def evict(self, keep=None):
+        deadline = time.monotonic() - self.idle_ttl
+        for user_id in list(self._sessions):
+            over_capacity = len(self._sessions) > self.max_sessions
+            if not over_capacity and self._last_access[user_id] > deadline:
+                break
+            if user_id == keep or self._is_dirty(user_id):
+                continue
+            self._drop(user_id)
+
+
+_cache = SessionCache()
+_flusher = None
+
+
+async def _flush_periodically():
+    while True:
+        await asyncio.sleep(SESSION_FLUSH_INTERVAL)
+        try:
+            await _cache.flush()
+        except Exception as e:
+            logger.error(f"[Session flush failed] {e}")
+        _cache.evict()
+
+
+async def _maintain_periodically():
+    analyzed_at = time.monotonic()
+    while True:
+        await asyncio.sleep(SESSION_GC_INTERVAL)
+        try:
+            # Last-activity times still waiting in the cache must reach the table first
+            await _cache.flush()
+            expired = await _run(_expire_sessions, time.time() - SESSION_TTL)
+            _cache.forget(expired)
+            metrics.sessions_expired.inc(len(expired))
+            trimmed = await _run(_trim_sessions)
+            analyze = time.monotonic() - analyzed_at > SESSION_ANALYZE_INTERVAL
+            await _run(_compact, analyze)
+            if analyze:
+                analyzed_at = time.monotonic()
+            logger.info(f"Session maintenance: {len(expired)} expired, {trimmed} rows trimmed")
+        except Exception as e:
+            logger.error(f"[Session maintenance failed] {e}")
+
+
+_maintenance = None
+
+
+async def start_maintenance():
+    """Start the background task that expires idle sessions, trims oversized
+    rows and compacts users.db every SESSION_GC_INTERVAL seconds.
+
+    With shard workers only worker 0 runs it. Sessions it expires belong to
+    users idle for SESSION_TTL, whom the other workers' caches evicted long
+    before."""
+    global _maintenance
+    if SHARD_INDEX > 0:
+        return
+    if _maintenance is None and SESSION_GC_INTERVAL > 0:
+        _maintenance = asyncio.create_task(_maintain_periodically())
+
+
+async def stop_maintenance():
+    global _maintenance
+    if _maintenance is not None:
+        _maintenance.cancel()
+        _maintenance = None
+
+
+def prepare():
+    """Create or migrate the schema before shard workers start (blocking)."""
+    _executor.submit(_init_db).result()
+    _executor.submit(_close_db).result()
+
+
+async def init_db():
+    global _flusher
+    await _run(_init_db)
+    if _flusher is None:
+        _flusher = asyncio.create_task(_flush_periodically())
+
+
+async def update_session(user_id, **fields):
+    """Set several session fields at once; they reach the database on the
+    next flush in a single statement."""
+    if fields:
+        await _cache.update(user_id, fields)
+
+
+async def set_session(user_id, key, value):
+    await update_session(user_id, **{key: value})
+
+
+async def get_session(user_id) -> Session:
+    """Return a copy of the user's session; missing sessions come back empty."""
+    return await _cache.get(user_id)
+
+
+async def clear_session(user_id):
+    _cache.clear(user_id)
+
+
+async def get_locations(user_id) -> list[Location]:
+    return await _cache.get_children(user_id, "locations")
+
+
+async def set_locations(user_id, locations):
+    """Store the destination candidates offered to the user, given as raw API
+    dicts or Location objects."""
+    await _cache.set_children(user_id, "locations", [
+        loc if isinstance(loc, Location) else Location.from_api(loc) for loc in locations
+    ])
+
+
+async def get_hotels(user_id) -> list[Hotel]:
+    return await _cache.get_children(user_id, "hotels")
+
+
+async def set_hotels(user_id, hotels):
+    await _cache.set_children(user_id, "hotels", hotels)
+
+
+async def get_photo_file_ids(urls) -> dict:
+    """Telegram file_ids of photos already uploaded from these source URLs."""
+    if not urls:
+        return {}
+    return await _run(_get_photo_file_ids, urls)
+
+
+async def save_photo_file_ids(file_ids):
+    if file_ids:
+        await _run(_save_photo_file_ids, file_ids)
+
+
+async def forget_photo_file_ids(urls):
+    if urls:
+        await _run(_forget_photo_file_ids, urls)
+
+
+async def close_db():
+    global _flusher
+    if _flusher is not None:
+        _flusher.cancel()
+        _flusher = None
+    await _cache.flush()
+    await _run(_close_db)
@@ -0,0 +1,340 @@
+"""Local index of searchDestination results for resolving "City, Country" input.
+
+Every destination the upstream API has returned is remembered with the time it
+was fetched, keyed by an accent-folded form of its city name and indexed by
+trigrams, so misspelled or unaccented input ("Zurich", "Pari") still finds
+"Zürich" and "Paris". A lookup is answered locally only for a city name
+searchDestination was asked for within the TTL, or one that some fresh record
+is named exactly; anything else falls through to searchDestination, whose
+answer is added back to the index. Near misses are only offered as
+suggestions (see suggest()) when upstream finds nothing, so a partial name
+such as "York" never hides the city the user meant behind "New York".
+
+City records with coordinates are also bucketed on a lat/lon grid, so the
+cities around a destination can be listed without calling getNearbyCities.
+
+Only the fields the bot reads of each record are kept. Records older than the
+TTL are dropped when the index is saved, and past DESTINATION_INDEX_MAX
+records the oldest go first. The index is persisted to DESTINATION_INDEX_PATH."""
+import asyncio
+import json
+import logging
+import math
+import os
+import re
+import tempfile
+import time
+import unicodedata
+from collections import defaultdict
+from difflib import SequenceMatcher
+from config import DESTINATION_INDEX_PATH, DESTINATION_INDEX_TTL, DESTINATION_INDEX_MAX
+
+logger = logging.getLogger(__name__)
+
+CITY_SIMILARITY = 0.5      # trigram Jaccard similarity a city name needs to match
+COUNTRY_SIMILARITY = 0.75  # edit-based ratio; trigrams are too coarse for short names
+SAVE_INTERVAL = 60
+# Past max_entries the oldest records go until this share of it is left
+PRUNE_TO = 0.9
+
+# The parts of an upstream record the index and db.Location.from_api read
+KEPT_FIELDS = (
+    "dest_id", "search_type", "dest_type", "label", "name", "city_name", "country",
+    "image_url", "latitude", "longitude",
+)
+
+GRID_DEGREES = 0.5         # grid cell size, about 55 km north-south
+NEARBY_RADIUS_KM = 100
+NEARBY_MIN = 5             # fewer fresh cities than this around a point asks upstream
+EARTH_RADIUS_KM = 6371.0
+
+
+def fold(text):
+    """Lower-case, strip accents and collapse punctuation to single spaces."""
+    decomposed = unicodedata.normalize("NFKD", text or "")
+    stripped = "".join(ch for ch in decomposed if not unicodedata.combining(ch))
+    return " ".join(re.sub(r"[\W_]+", " ", stripped.casefold()).split())
+
+
+def trigrams(folded):
+    padded = f"  {folded} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def _country_matches(query, country):
+    return query in country or SequenceMatcher(None, query, country).ratio() >= COUNTRY_SIMILARITY
+
+
+def distance_km(lat1, lon1, lat2, lon2):
+    """Great-circle distance (haversine)."""
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    d_phi = phi2 - phi1
+    d_lambda = math.radians(lon2 - lon1)
+    a = math.sin(d_phi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(d_lambda / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+def _cell(latitude, longitude):
+    return math.floor(latitude / GRID_DEGREES), math.floor(longitude / GRID_DEGREES)
+
+
+def _search_type(record):
+    # searchDestination calls it search_type, getNearbyCities dest_type
+    return (record.get("search_type") or record.get("dest_type") or "").upper()
+
+
+class _Entry:
+    __slots__ = ("record", "fetched_at", "rank", "city", "country", "grams", "cell")
+
+    def __init__(self, record, fetched_at, rank):
+        self.record = record
+        self.fetched_at = fetched_at
+        self.rank = rank
+        self.city = fold(record.get("city_name") or record.get("name"))
+        self.country = fold(record.get("country"))
+        # getNearbyCities records have no label to offer as a search answer
+        self.grams = trigrams(self.city) if record.get("label") else set()
+        latitude, longitude = record.get("latitude"), record.get("longitude")
+        if _search_type(record) == "CITY" and latitude is not None and longitude is not None:
+            self.cell = _cell(latitude, longitude)
+        else:
+            self.cell = None
+
+
+class DestinationIndex:
+    def __init__(self, path=DESTINATION_INDEX_PATH, ttl=DESTINATION_INDEX_TTL, max_entries=DESTINATION_INDEX_MAX):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = {}
+        self._postings = defaultdict(set)
+        self._cells = defaultdict(set)
+        # grid cell -> when getNearbyCities last filled it
+        self._filled = {}
+        # folded city name -> (when searchDestination was asked for it, keys it returned)
+        self._queries = {}
+        self.dirty = False
+        self.saved_at = time.monotonic()
+        self._load()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def _key(record):
+        return str(record.get("dest_id")), _search_type(record)
+
+    def _put(self, record, fetched_at, rank):
+        if not record.get("dest_id") or not _search_type(record):
+            return
+        record = {field: record[field] for field in KEPT_FIELDS if record.get(field) is not None}
+        key = self._key(record)
+        if key in self._entries:
+            # Keep fields only the other endpoint returns, e.g. the label
+            record = {**self._drop(key).record, **record}
+        entry = self._entries[key] = _Entry(record, fetched_at, rank)
+        for gram in entry.grams:
+            self._postings[gram].add(key)
+        if entry.cell is not None:
+            self._cells[entry.cell].add(key)
+
+    def _drop(self, key):
+        entry = self._entries.pop(key)
+        for gram in entry.grams:
+            self._postings[gram].discard(key)
+            if not self._postings[gram]:
+                del self._postings[gram]
+        if entry.cell is not None:
+            self._cells[entry.cell].discard(key)
+            if not self._cells[entry.cell]:
+                del self._cells[entry.cell]
+        return entry
+
+    def add(self, records, query=None, fetched_at=None):
+        """Index one searchDestination or getNearbyCities response (its "data"
+        list); `query` is the city searchDestination was asked for.
+
+        Destinations of that very city which the response no longer contains
+        are forgotten."""
+        fetched_at = time.time() if fetched_at is None else fetched_at
+        records = [record for record in records or [] if isinstance(record, dict)]
+        if query:
+            returned = {self._key(record) for record in records}
+            city = fold(query)
+            for key in [key for key, entry in self._entries.items() if entry.city == city and key not in returned]:
+                self._drop(key)
+        for rank, record in enumerate(records):
+            self._put(record, fetched_at, rank)
+        if query:
+            self._queries[fold(query)] = (fetched_at, [self._key(record) for record in records])
+        if len(self._entries) > self.max_entries:
+            self._prune()
+        self.dirty = True
+        if self.path and time.monotonic() - self.saved_at > SAVE_INTERVAL:
+            self.saved_at = time.monotonic()
+            snapshot = self._snapshot()
+            asyncio.get_running_loop().run_in_executor(None, self._write, snapshot)
+
+    def lookup(self, city, country):
+        """Fresh records for `city` in `country`, in upstream's order.
+
+        Only answers for a city name searchDestination returned within `ttl`,
+        or failing that, for fresh records named exactly `city`. Returns None
+        otherwise, and the caller asks upstream."""
+        query = fold(city)
+        country = fold(country)
+        if not query:
+            return None
+        oldest = time.time() - self.ttl
+        countries = {}
+
+        def in_country(entry):
+            if entry.country not in countries:
+                countries[entry.country] = _country_matches(country, entry.country)
+            return countries[entry.country]
+
+        asked = self._queries.get(query)
+        # An answer some of whose records were pruned since is asked again
+        if asked is not None and asked[0] >= oldest and all(key in self._entries for key in asked[1]):
+            entries = (self._entries[key] for key in asked[1])
+            return [entry.record for entry in entries if entry.grams and in_country(entry)]
+
+        exact = []
+        for key in self._candidates(query):
+            entry = self._entries[key]
+            if entry.city == query and entry.fetched_at >= oldest and in_country(entry):
+                exact.append(entry)
+        if not exact:
+            return None
+        exact.sort(key=lambda entry: entry.rank)
+        return [entry.record for entry in exact]
+
+    def suggest(self, city, country):
+        """Records whose city name is close to `city`, e.g. "Zurich" or "Pari",
+        best match first; to offer when searchDestination finds nothing."""
+        query = fold(city)
+        country = fold(country)
+        if not query:
+            return []
+        grams = trigrams(query)
+        countries = {}
+        scored = []
+        for key, count in self._candidates(query).items():
+            entry = self._entries[key]
+            score = count / (len(grams) + len(entry.grams) - count)
+            if score < CITY_SIMILARITY:
+                continue
+            if entry.country not in countries:
+                countries[entry.country] = _country_matches(country, entry.country)
+            if countries[entry.country]:
+                scored.append((-score, entry.rank, entry))
+        scored.sort(key=lambda item: item[:2])
+        return [entry.record for _, _, entry in scored]
+
+    def _candidates(self, query):
+        """Keys sharing at least one trigram with `query`, with the count shared."""
+        shared = defaultdict(int)
+        for gram in trigrams(query):
+            for key in self._postings.get(gram, ()):
+                shared[key] += 1
+        return shared
+
+    def nearest(self, latitude, longitude, k=10, radius_km=NEARBY_RADIUS_KM, exclude=None):
+        """Up to `k` fresh cities within `radius_km`, as (record, distance_km)
+        pairs, closest first. `exclude` is a dest_id to leave out."""
+        lat_span = math.ceil(radius_km / 111.2 / GRID_DEGREES)
+        # Degrees of longitude shrink towards the poles
+        lon_km = 111.2 * max(math.cos(math.radians(latitude)), 0.01)
+        lon_span = min(math.ceil(radius_km / lon_km / GRID_DEGREES), math.ceil(180 / GRID_DEGREES))
+        row, column = _cell(latitude, longitude)
+        oldest = time.time() - self.ttl
+
+        found = []
+        for d_row in range(-lat_span, lat_span + 1):
+            for d_column in range(-lon_span, lon_span + 1):
+                for key in self._cells.get((row + d_row, column + d_column), ()):
+                    entry = self._entries[key]
+                    if entry.fetched_at < oldest or key[0] == str(exclude):
+                        continue
+                    record = entry.record
+                    distance = distance_km(latitude, longitude, record["latitude"], record["longitude"])
+                    if distance <= radius_km:
+                        found.append((distance, key, record))
+        found.sort(key=lambda item: item[:2])
+        return [(record, distance) for distance, _, record in found[:k]]
+
+    def is_sparse(self, latitude, longitude, found):
+        """Whether `found` (from nearest) is too thin and the area was not
+        filled from getNearbyCities within `ttl`."""
+        filled_at = self._filled.get(_cell(latitude, longitude), 0)
+        return len(found) < NEARBY_MIN and filled_at < time.time() - self.ttl
+
+    def mark_filled(self, latitude, longitude):
+        self._filled[_cell(latitude, longitude)] = time.time()
+
+    def _load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, encoding="utf-8") as index_file:
+                state = json.load(index_file)
+        except (OSError, ValueError) as e:
+            logger.warning(f"[Destination index unreadable] {e}")
+            return
+        for item in state.get("records", []):
+            self._put(item["data"], item.get("fetched_at", 0), item.get("rank", 0))
+        for query, item in state.get("queries", {}).items():
+            self._queries[query] = (item["fetched_at"], [tuple(key) for key in item["keys"]])
+
+    def _prune(self):
+        """Forget what is older than `ttl`, then the oldest records while
+        more than `max_entries` are left."""
+        oldest = time.time() - self.ttl
+        for query in [query for query, (fetched_at, _) in self._queries.items() if fetched_at < oldest]:
+            del self._queries[query]
+        for cell in [cell for cell, filled_at in self._filled.items() if filled_at < oldest]:
+            del self._filled[cell]
+        for key in [key for key, entry in self._entries.items() if entry.fetched_at < oldest]:
+            self._drop(key)
+        if len(self._entries) > self.max_entries:
+            excess = len(self._entries) - int(self.max_entries * PRUNE_TO)
+            by_age = sorted(self._entries, key=lambda key: self._entries[key].fetched_at)
+            for key in by_age[:excess]:
+                self._drop(key)
+
+    def _snapshot(self):
+        self.dirty = False
+        self._prune()
+        return {"records": [
+            {"fetched_at": entry.fetched_at, "rank": entry.rank, "data": entry.record}
+            for entry in self._entries.values()
+        ], "queries": {
+            query: {"fetched_at": fetched_at, "keys": keys}
+            for query, (fetched_at, keys) in self._queries.items()
+        }}
+
+    def _write(self, snapshot):
+        partial = None
+        try:
+            # A temp file of its own, so two writes never interleave in one file
+            fd, partial = tempfile.mkstemp(
+                dir=os.path.dirname(os.path.abspath(self.path)), prefix=os.path.basename(self.path), suffix=".tmp"
+            )
+            with open(fd, "w", encoding="utf-8") as index_file:
+                json.dump(snapshot, index_file, ensure_ascii=False)
+            os.replace(partial, self.path)
+        except OSError as e:
+            logger.warning(f"[Destination index not saved] {e}")
+            if partial is not None and os.path.exists(partial):
+                os.remove(partial)
+
+    def close(self):
+        if self.path and self.dirty:
+            self._write(self._snapshot())
+
+
+index = DestinationIndex()
+
+
+async def close():
+    index.close()
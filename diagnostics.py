@@ -0,0 +1,194 @@
+"""Event-loop diagnostics.
+
+LoopMonitor checks how late the event loop fires a timer that is due every
+LOOP_LAG_INTERVAL seconds; the delay is exported as event_loop_lag_seconds. A
+watchdog thread watches the same timer from outside the loop. If the loop has
+not come back for LOOP_STALL_THRESHOLD seconds, some call is blocking it, and
+the watchdog logs the loop thread's stack while that call is still running.
+
+profile() samples the loop thread's stack every PROFILE_INTERVAL seconds and
+reports the code paths seen most often. Admins (ADMIN_IDS) run it from
+Telegram with /profile [seconds]. With --workers it profiles the worker that
+handles the admin's updates."""
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import Counter
+from aiogram import types, Router, F
+from aiogram.filters import Command, CommandObject
+import metrics
+from config import LOOP_LAG_INTERVAL, LOOP_STALL_THRESHOLD, PROFILE_INTERVAL, PROFILE_MAX_SECONDS, ADMIN_IDS
+
+logger = logging.getLogger(__name__)
+
+STACK_DEPTH = 12
+PROFILE_DEPTH = 64
+PROFILE_TOP = 10
+MAX_TEXT = 4096
+
+_ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+class LoopMonitor:
+    def __init__(self, interval=LOOP_LAG_INTERVAL, threshold=LOOP_STALL_THRESHOLD):
+        self.interval = interval
+        self.threshold = threshold
+        self.max_lag = 0.0
+        self._heartbeat = None
+        self._loop_thread = None
+        self._task = None
+        self._stopped = threading.Event()
+
+    def start(self):
+        self._loop_thread = threading.get_ident()
+        self._heartbeat = time.monotonic()
+        self._stopped.clear()
+        self._task = asyncio.create_task(self._measure())
+        threading.Thread(target=self._watch, name="loop-watchdog", daemon=True).start()
+
+    async def _measure(self):
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            lag = max(0.0, now - expected)
+            self._heartbeat = now
+            self.max_lag = max(self.max_lag, lag)
+            metrics.loop_lag.observe(lag)
+            if lag >= self.threshold:
+                logger.warning(f"Event loop was blocked for {lag:.2f}s", extra={"lag_ms": round(lag * 1000)})
+
+    def _watch(self):
+        reported = None
+        while not self._stopped.wait(min(self.interval, self.threshold) / 2):
+            heartbeat = self._heartbeat
+            blocked = time.monotonic() - heartbeat - self.interval
+            # One report per stall: the heartbeat moves once the loop is back
+            if blocked < self.threshold or heartbeat == reported:
+                continue
+            reported = heartbeat
+            metrics.loop_stalls.inc()
+            frame = sys._current_frames().get(self._loop_thread)
+            if frame is None:
+                continue
+            stack = "".join(traceback.format_stack(frame, limit=STACK_DEPTH))
+            logger.warning(f"Event loop blocked for {blocked:.2f}s so far, in:\n{stack}")
+
+    async def stop(self):
+        self._stopped.set()
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+
+def _sample(thread_id, seconds, interval):
+    # Runs in a worker thread, so the loop keeps running while it is watched.
+    # The sampler can only look when the loop thread lets go of the GIL; a
+    # short switch interval makes that happen in the middle of Python code
+    # too, not only at the loop's next select()
+    switch_interval = sys.getswitchinterval()
+    sys.setswitchinterval(min(switch_interval, interval / 10))
+    samples = Counter()
+    deadline = time.monotonic() + seconds
+    try:
+        while time.monotonic() < deadline:
+            frame = sys._current_frames().get(thread_id)
+            if frame is not None:
+                stack = tuple(
+                    (f.f_code.co_filename, f.f_code.co_name, lineno)
+                    for f, lineno in traceback.walk_stack(frame)
+                )
+                samples[stack[:PROFILE_DEPTH]] += 1
+            del frame
+            time.sleep(interval)
+    finally:
+        sys.setswitchinterval(switch_interval)
+    return samples
+
+
+def _own(filename):
+    return filename.startswith(_ROOT) and "site-packages" not in filename
+
+
+def _idle(stack):
+    # Waiting in select() for I/O or the next timer
+    return stack[0][0].endswith("selectors.py")
+
+
+def _location(filename, function, lineno):
+    if _own(filename):
+        return f"{os.path.relpath(filename, _ROOT)}:{function}:{lineno}"
+    # Library frames are grouped by function, e.g. json/decoder.py:raw_decode
+    return "/".join(filename.split(os.sep)[-2:]) + f":{function}"
+
+
+def _hot_path(stack):
+    """The bot's own frames of an innermost-first stack, outermost first,
+    followed by the library function they were in."""
+    path = [frame for frame in reversed(stack) if _own(frame[0])]
+    if not path:
+        path = list(reversed(stack[:3]))
+    elif not _own(stack[0][0]):
+        path.append(stack[0])
+    return " › ".join(_location(*frame) for frame in path)
+
+
+def report(samples, seconds, top=PROFILE_TOP):
+    total = sum(samples.values())
+    if not total:
+        return "No samples were taken."
+    paths = Counter()
+    idle = 0
+    for stack, count in samples.items():
+        if _idle(stack):
+            idle += count
+        else:
+            paths[_hot_path(stack)] += count
+    lines = [f"Profiled {seconds}s: {total} samples, event loop busy {(total - idle) / total:.0%} of the time."]
+    if paths:
+        lines += ["", "Hottest paths (share of all samples):"]
+        lines += [f"{i}. {count / total:.1%} {path}" for i, (path, count) in enumerate(paths.most_common(top), 1)]
+    return "\n".join(lines)
+
+
+async def profile(seconds, interval=PROFILE_INTERVAL):
+    """Sample the event loop's thread for `seconds` and report its hot paths."""
+    samples = await asyncio.to_thread(_sample, threading.get_ident(), seconds, interval)
+    return report(samples, seconds)
+
+
+monitor = LoopMonitor()
+_profiling = asyncio.Lock()
+
+router = Router()
+
+
+@router.message(Command("profile"), F.from_user.id.in_(ADMIN_IDS))
+async def profile_command(msg: types.Message, command: CommandObject):
+    try:
+        seconds = int(command.args or 10)
+    except ValueError:
+        await msg.answer("Usage: /profile [seconds]")
+        return
+    seconds = max(1, min(seconds, PROFILE_MAX_SECONDS))
+    if _profiling.locked():
+        await msg.answer("⏱ A profile is already running.")
+        return
+    async with _profiling:
+        await msg.answer(f"⏱ Profiling the event loop for {seconds}s...")
+        text = await profile(seconds)
+    text = f"Worst loop lag since start: {monitor.max_lag:.2f}s\n{text}"
+    logger.info(f"Profile requested by {msg.from_user.id}:\n{text}")
+    await msg.answer(text[:MAX_TEXT])
+
+
+async def start():
+    monitor.start()
+
+
+async def stop():
+    await monitor.stop()
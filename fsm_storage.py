@@ -0,0 +1,84 @@
+"""aiogram FSM storage kept in the session database.
+
+The FSM state and data of a conversation live in the user's sessions row
+(fsm_state, fsm_data, fsm_updated_at), so they survive restarts and are
+flushed together with the rest of the session: every write stores the state
+and the data as one pair, and they can never disagree with the search fields
+the handlers keep next to them. Conversations left alone for longer than
+FSM_STATE_TTL come back empty.
+
+Several bot processes can share users.db as long as each user is always
+handled by the same process (the session cache in db.py is per process).
+Set FSM_STORAGE=redis to use aiogram's RedisStorage instead when the processes
+run on different hosts, or FSM_STORAGE=memory for aiogram's in-memory storage."""
+import json
+import time
+from typing import Any, Dict, Optional
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StorageKey, StateType
+from aiogram.fsm.storage.memory import MemoryStorage
+import db
+from config import FSM_STORAGE, FSM_STATE_TTL, REDIS_URL
+
+
+class SessionStorage(BaseStorage):
+    """Keys conversations by user_id: the bot only talks in private chats,
+    where the chat and the user are the same."""
+
+    def __init__(self, state_ttl=FSM_STATE_TTL):
+        self.state_ttl = state_ttl
+
+    def _expired(self, session):
+        return (
+            session.fsm_updated_at is not None
+            and self.state_ttl > 0
+            and time.time() - session.fsm_updated_at > self.state_ttl
+        )
+
+    async def _load(self, key: StorageKey):
+        session = await db.get_session(key.user_id)
+        if self._expired(session):
+            return None, {}
+        return session.fsm_state, json.loads(session.fsm_data) if session.fsm_data else {}
+
+    async def _save(self, key: StorageKey, state, data):
+        await db.update_session(
+            key.user_id,
+            fsm_state=state,
+            fsm_data=json.dumps(data) if data else None,
+            fsm_updated_at=time.time()
+        )
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        _, data = await self._load(key)
+        await self._save(key, state.state if isinstance(state, State) else state, data)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        state, _ = await self._load(key)
+        return state
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        state, _ = await self._load(key)
+        await self._save(key, state, data)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        _, data = await self._load(key)
+        return data
+
+    async def close(self) -> None:
+        # The connection belongs to db.py and is closed by close_db()
+        pass
+
+
+def create_storage(backend=FSM_STORAGE):
+    if backend == "db":
+        return SessionStorage()
+    if backend == "memory":
+        return MemoryStorage()
+    if backend == "redis":
+        try:
+            from aiogram.fsm.storage.redis import RedisStorage
+        except ImportError as e:
+            raise RuntimeError("FSM_STORAGE=redis needs the redis package: pip install redis") from e
+        return RedisStorage.from_url(REDIS_URL, state_ttl=int(FSM_STATE_TTL) or None, data_ttl=int(FSM_STATE_TTL) or None)
+    raise ValueError(f"Unknown FSM_STORAGE: {backend}")
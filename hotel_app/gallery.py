@@ -0,0 +1,90 @@
+import logging
+from aiogram import types
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import InputMediaPhoto
+from db import get_photo_file_ids, save_photo_file_ids, forget_photo_file_ids
+
+logger = logging.getLogger(__name__)
+
+MEDIA_GROUP_SIZE = 10
+
+
+def _batches(urls):
+    """Split into media groups of 2-10 photos, as even as possible: 11 photos
+    go out as 6 + 5, since Telegram refuses a group of one."""
+    count = -(-len(urls) // MEDIA_GROUP_SIZE)
+    size, bigger = divmod(len(urls), count) if count else (0, 0)
+    batches, start = [], 0
+    for number in range(count):
+        end = start + size + (number < bigger)
+        batches.append(urls[start:end])
+        start = end
+    return batches
+
+
+async def _send_group(message: types.Message, sources, caption):
+    if len(sources) == 1:
+        # A lone photo is not a media group
+        return [await message.answer_photo(photo=sources[0], caption=caption, parse_mode="HTML")]
+    media = [InputMediaPhoto(media=source) for source in sources]
+    if caption:
+        media[-1] = InputMediaPhoto(media=sources[-1], caption=caption, parse_mode="HTML")
+    # Flood control (TelegramRetryAfter) is handled by the send queue, see outbox.py
+    return await message.answer_media_group(media=media)
+
+
+async def _send_one_by_one(message: types.Message, urls, caption):
+    """Last resort when Telegram rejects the whole group, e.g. one URL it
+    cannot fetch. Returns the file_ids of the photos that went through."""
+    uploaded = {}
+    for i, url in enumerate(urls):
+        is_last = i == len(urls) - 1
+        try:
+            sent = await message.answer_photo(photo=url, caption=caption if is_last else None, parse_mode="HTML")
+        except TelegramBadRequest as e:
+            logger.error(f"[Photo send failed] {e}")
+            if is_last and caption:
+                await message.answer(caption, parse_mode="HTML")
+            continue
+        if sent.photo:
+            uploaded[url] = sent.photo[-1].file_id
+    return uploaded
+
+
+async def send_gallery(message: types.Message, photo_urls, caption=None):
+    """Send photos as media groups of up to 10, captioning the last photo.
+
+    Photos Telegram has seen before are sent by their cached file_id instead of
+    the source URL, and the file_ids of newly uploaded photos are remembered."""
+    known = await get_photo_file_ids(photo_urls)
+    batches = _batches(photo_urls)
+
+    for number, urls in enumerate(batches):
+        batch_caption = caption if number == len(batches) - 1 else None
+        sources = [known.get(url, url) for url in urls]
+        try:
+            sent = await _send_group(message, sources, batch_caption)
+        except TelegramBadRequest as e:
+            cached = [url for url in urls if url in known]
+            if not cached:
+                logger.error(f"[Gallery send failed] {e}")
+                await save_photo_file_ids(await _send_one_by_one(message, urls, batch_caption))
+                continue
+            # A stale file_id spoils the whole group; retry from the source URLs
+            logger.warning(f"[Cached photo rejected] {e}")
+            await forget_photo_file_ids(cached)
+            for url in cached:
+                del known[url]
+            try:
+                sent = await _send_group(message, urls, batch_caption)
+            except TelegramBadRequest as e:
+                logger.error(f"[Gallery send failed] {e}")
+                await save_photo_file_ids(await _send_one_by_one(message, urls, batch_caption))
+                continue
+
+        uploaded = {
+            url: sent_message.photo[-1].file_id
+            for url, sent_message in zip(urls, sent)
+            if url not in known and sent_message.photo
+        }
+        await save_photo_file_ids(uploaded)
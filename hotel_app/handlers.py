@@ -1,32 +1,42 @@
 import asyncio
 import logging
+import re
 import webbrowser
+import aiohttp
 from aiogram.fsm.context import FSMContext
 from hotel_app.states import HotelBookingState
-from config import RAPIDAPI_KEY
 from aiogram import types, Router, F
 from aiogram.types import KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery
 from aiogram.filters import CommandStart
+from aiogram.exceptions import TelegramBadRequest
 from db import *
-import time
-import requests
-from requests.exceptions import Timeout, RequestException
+import rapidapi
+import metrics
+import destinations
+import logs
+import usertasks
+import admission
+import outbox
 import hotel_app.keyboards as keyboards
+from hotel_app.gallery import send_gallery
+from hotel_app import results
+from hotel_app.results import HotelResult
 from datetime import datetime
 
 
 router = Router()
+# A handler moving the user to another state cancels their listing and gallery
+router.message.middleware(usertasks.StateChangeMiddleware())
+router.callback_query.middleware(usertasks.StateChangeMiddleware())
 
 logger = logging.getLogger(__name__)
 
-headers = {
-    "x-rapidapi-key": RAPIDAPI_KEY,
-    "x-rapidapi-host": "booking-com15.p.rapidapi.com"
-}
+BUSY_MESSAGE = "⏳ We are handling too many requests right now. Please try again a bit later."
 
 
 @router.message(CommandStart())
 async def welcome(msg: types.Message):
+    usertasks.registry.cancel(msg.from_user.id)
     await msg.answer(
         "Welcome to Globetrotter 365!"
         "\n\nI'll assist you to seek the best, meanwhile the cheapest flight options and top-ranked hotels around the globe. "
@@ -37,11 +47,13 @@ async def welcome(msg: types.Message):
 
 @router.message(F.text == "Continue")
 async def handle_continue(msg: types.Message, state: FSMContext):
+    usertasks.registry.cancel(msg.from_user.id)
     await msg.answer("Please enter your destination:\n\n`City, Country`", parse_mode="Markdown")
     await state.set_state(HotelBookingState.waiting_for_city_country)
 
 @router.message(F.text == "Exit")
 async def handle_exit(msg: types.Message, state: FSMContext):
+    usertasks.registry.cancel(msg.from_user.id)
     await state.clear()
     await msg.answer("Thank you for using Globetrotter 365!\nGoodbye!", parse_mode="Markdown", ReplyKeyboardRemove=True)
 
@@ -57,29 +69,32 @@ async def handle_waiting_for_country(msg: types.Message, state: FSMContext):
 
     user_input_city, user_input_country = parts
     try:
-        url = "https://booking-com15.p.rapidapi.com/api/v1/hotels/searchDestination"
-        querystring = {"query": user_input_city}
-        response = requests.get(url, headers=headers, params=querystring)
-
-        if response.status_code != 200:
-            await msg.answer(f"\u274c API Error: {response.status_code}")
-            return
-
-        result = response.json()
-        logger.info("API result: %s", result)
+        matches = destinations.index.lookup(user_input_city, user_input_country)
+        metrics.destination_lookups.inc(result="miss" if matches is None else "hit")
+        if matches is None:
+            querystring = {"query": user_input_city}
+            result = await rapidapi.get("searchDestination", querystring, user_id)
+            data = result.get("data", [])
+            logger.info(
+                "searchDestination returned %d destinations", len(data) if isinstance(data, list) else 0,
+                extra={"query": user_input_city, "user_id": user_id}
+            )
+            if logger.isEnabledFor(logging.DEBUG) or logs.sampled():
+                logger.info("searchDestination payload: %s", logs.Payload(result))
 
-        data_list = result.get("data", [])
-        matches = [
-            loc for loc in data_list
-            if user_input_city.lower() in loc.get("city_name", "").lower()
-            and user_input_country.lower() in loc.get("country", "").lower()
-        ]
+            destinations.index.add(data, user_input_city)
+            matches = destinations.index.lookup(user_input_city, user_input_country) or []
 
+        prompt = "\U0001F4CD Please choose the correct location:"
+        if not matches:
+            # Perhaps a typo of a city someone looked up before
+            matches = destinations.index.suggest(user_input_city, user_input_country)
+            prompt = "\U0001F50E Did you mean one of these?"
         if not matches:
             await msg.answer("\u274c No matching locations found.")
             return
 
-        set_session(user_id, "locations", matches)
+        await set_locations(user_id, matches)
 
         keyboard = [[KeyboardButton(text=loc.get("label", "Unknown"))] for loc in matches[:10]]
         keyboard.append([KeyboardButton(text="Not listed")])
@@ -90,10 +105,16 @@ async def handle_waiting_for_country(msg: types.Message, state: FSMContext):
             one_time_keyboard=True
         )
 
-        await msg.answer("\U0001F4CD Please choose the correct location:", reply_markup=markup)
+        await msg.answer(prompt, reply_markup=markup)
         await state.set_state(HotelBookingState.waiting_for_city_selection)
 
-    except Timeout:
+    except rapidapi.RapidAPIError as e:
+        await msg.answer(f"\u274c API Error: {e.status}")
+
+    except rapidapi.QuotaExceeded:
+        await msg.answer(BUSY_MESSAGE)
+
+    except asyncio.TimeoutError:
         await msg.answer("\u23f1\ufe0f The server took too long to respond. Please try again.")
 
     except Exception as e:
@@ -103,9 +124,9 @@ async def handle_waiting_for_country(msg: types.Message, state: FSMContext):
 async def handle_waiting_for_city(msg: types.Message, state: FSMContext):
     user_id = msg.from_user.id
     if msg.text == "Not listed":
-        locations = get_session(user_id).get("locations", [])
+        locations = await get_locations(user_id)
         if len(locations[10:]) > 0:
-            keyboard = [[KeyboardButton(text=loc.get("label", "Unknown"))] for loc in get_session("locations")[10:20]]
+            keyboard = [[KeyboardButton(text=loc.label or "Unknown")] for loc in locations[10:20]]
 
             markup = types.ReplyKeyboardMarkup(
                 keyboard=keyboard,
@@ -119,17 +140,20 @@ async def handle_waiting_for_city(msg: types.Message, state: FSMContext):
             await msg.answer("No locations found with this name. Please try to enter the names or consider the nearby destinations...", parse_mode="Markdown")
             return await state.set_state(HotelBookingState.waiting_for_city_country)
     else:
-        for loc in get_session(user_id).get("locations", []):
-            label = loc.get("label", "").strip().lower()
+        for loc in await get_locations(user_id):
+            label = loc.label.strip().lower()
             if label == msg.text.strip().lower():
 
-                set_session(user_id, "city_name", loc.get("city_name", ""))
-                set_session(user_id, "country", loc.get("country", ""))
-                set_session(user_id, "location_photo", loc.get("image_url", ""))
-                set_session(user_id, "latitude", loc.get("latitude", ""))
-                set_session(user_id, "longitude", loc.get("longitude", ""))
-                set_session(user_id, "dest_id", loc.get("dest_id", ""))
-                set_session(user_id, "search_type", loc.get("search_type", "").upper())
+                await update_session(
+                    user_id,
+                    city_name=loc.city_name,
+                    country=loc.country,
+                    location_photo=loc.image_url,
+                    latitude=loc.latitude,
+                    longitude=loc.longitude,
+                    dest_id=loc.dest_id,
+                    search_type=loc.search_type
+                )
                 break
 
         chosen_label = msg.text
@@ -144,7 +168,7 @@ async def handle_waiting_for_checkin(msg: types.Message, state: FSMContext):
         input_checkin_date = msg.text
         await state.update_data(checkin_date=input_checkin_date)
         formatted_checkin = datetime.strptime(input_checkin_date, "%d/%m/%Y").strftime("%Y-%m-%d")
-        set_session(user_id, "checkin", formatted_checkin)
+        await set_session(user_id, "checkin", formatted_checkin)
         await msg.answer("✔️ Check-in date accepted. Now please enter your check-out date in DD/MM/YYYY format:")
         await state.set_state(HotelBookingState.waiting_for_checkout_date)
     except ValueError:
@@ -154,13 +178,13 @@ async def handle_waiting_for_checkin(msg: types.Message, state: FSMContext):
 @router.message(HotelBookingState.waiting_for_checkout_date)
 async def handle_waiting_for_checkout(msg: types.Message, state: FSMContext):
     current_state = await state.get_state()
-    print(f"[DEBUG] Current state: {current_state}")
+    logger.debug("Current state: %s", current_state)
     user_id = msg.from_user.id
     try:
         input_checkout_date = msg.text
         await state.update_data(checkout_date=input_checkout_date)
         formatted_checkout = datetime.strptime(input_checkout_date, "%d/%m/%Y").strftime("%Y-%m-%d")
-        set_session(user_id, "checkout", formatted_checkout)
+        await set_session(user_id, "checkout", formatted_checkout)
         await msg.answer(
             "Clarify a number of adults below (Age above 18 y.o.)...",
                          parse_mode="Markdown",
@@ -187,7 +211,7 @@ async def handle_waiting_for_adults(msg: types.Message, state: FSMContext):
         )
 
         await state.update_data(adults=input_adults)
-        set_session(user_id, "adults", input_adults)
+        await set_session(user_id, "adults", int(input_adults))
         await msg.answer(f"✅ Got it. {input_adults} adult(s)\n\nAre there any children who's age is under 18 years old with you?", reply_markup=markup)
         await state.set_state(HotelBookingState.waiting_for_children_number)
 
@@ -207,7 +231,7 @@ async def handle_waiting_for_children(msg: types.Message, state: FSMContext):
         if user_choice == "yes":
             await msg.answer("🧒 How many children (under 18 y.o) will stay?", reply_markup=keyboards.children_number)
         else:
-            set_session(user_id, "children", "0")
+            await set_session(user_id, "children", "0")
             await msg.answer("🛏️ How many rooms do you need?", reply_markup=keyboards.room_count)
             await state.set_state(HotelBookingState.waiting_for_room_count)
         return
@@ -245,185 +269,346 @@ async def handle_children_ages(msg: types.Message, state: FSMContext):
         await msg.answer("❌ All children's ages must be between 0 and 17.")
         return
 
-    set_session(user_id, "children", ",".join(map(str, ages)))
+    await set_session(user_id, "children", ",".join(map(str, ages)))
 
     await msg.answer("🛏️ How many rooms do you need?", reply_markup=keyboards.room_count)
     await state.set_state(HotelBookingState.waiting_for_room_count)
 
+MAX_ROOMS = 8
+
+def parse_room_count(text):
+    """The number of rooms in a room_count button ("Two(2)") or typed ("2"),
+    None unless it is from 1 to MAX_ROOMS."""
+    text = (text or "").strip()
+    button = re.fullmatch(r"\w*\((\d+)\)", text)
+    digits = button.group(1) if button else text
+    if not digits.isdigit() or not 1 <= int(digits) <= MAX_ROOMS:
+        return None
+    return int(digits)
+
 @router.message(HotelBookingState.waiting_for_room_count)
 async def handle_waiting_for_room_count(msg: types.Message, state: FSMContext):
     user_id = msg.from_user.id
-    room_count = msg.text.strip()[-2]
-    set_session(user_id, "room", room_count)
+    room_count = parse_room_count(msg.text)
+    if room_count is None:
+        await msg.answer(f"❌ Please choose a number of rooms below, or type one from 1 to {MAX_ROOMS}.",
+                         reply_markup=keyboards.room_count)
+        return
+    await set_session(user_id, "room", room_count)
     await state.update_data(room_count=room_count)
-    await msg.answer("Starting checking for available hotels...")
+    with outbox.mergeable():
+        await msg.answer("Starting checking for available hotels...")
     await handle_fetching_results(msg, state)
 
-@router.message(HotelBookingState.fetching_results_from_server)
-async def handle_fetching_results(msg: types.Message, state: FSMContext):
-    user_id = msg.from_user.id
+def hotel_caption(hotel: HotelResult, price_per_night="⏳", price_total="⏳"):
+    price = round(hotel.price, 2) if hotel.price is not None else "N/A"
+    rating = hotel.rating if hotel.rating is not None else "N/A"
+
+    return (
+        f"🏨 <b>{hotel.name}</b>\n"
+        f"💰 Price: {price} {hotel.currency} (taxes and fees included)\n"
+        f"      Price per night: {price_per_night}\n"
+        f"      Price in total: {price_total}\n"
+        f"⭐ Rating: {rating}\n"
+        f"To get more info please click on button below ⬇️"
+    )
 
-    user_data = get_session(user_id)
+def hotel_details_query(user_data: Session, hotel_id):
+    # Search enrichment and the reservation link share one query shape so the
+    # second getHotelDetails call for a hotel is answered from the cache
+    return {
+        "hotel_id": hotel_id,
+        "arrival_date": user_data.checkin,
+        "departure_date": user_data.checkout,
+        "adults": user_data.adults,
+        "children_age": user_data.children,
+        "room_qty": user_data.room,
+        "units": "metric",
+        "temperature_unit": "c",
+        "languagecode": "en-us",
+        "currency_code": "USD"
+    }
 
-    found_hotels_dict = {}
+def price_breakdown(details):
+    breakdown = details.get("data", {}).get("product_price_breakdown", {})
+    price_per_night = breakdown.get("gross_amount_per_night", {}).get("amount_rounded", "N/A")
+    price_total = breakdown.get("all_inclusive_amount", {}).get("amount_rounded", "N/A")
+    return price_per_night, price_total
 
-    url = "https://booking-com15.p.rapidapi.com/api/v1/hotels/searchHotels"
-    querystring = {
-        "dest_id": user_data["dest_id"],
-        "search_type": user_data["search_type"],
-        "arrival_date": user_data["checkin"],
-        "departure_date": user_data["checkout"],
-        "adults": user_data["adults"],
-        "children_age": user_data.get("children", ""),
-        "room_qty": user_data["room"],
+async def update_card(card: types.Message, caption):
+    try:
+        if card.photo:
+            await card.edit_caption(caption=caption, parse_mode="html", reply_markup=card.reply_markup)
+        else:
+            await card.edit_text(caption, parse_mode="html", reply_markup=card.reply_markup)
+    except TelegramBadRequest as e:
+        logger.warning(f"[Card update failed] {e}")
+
+def search_query(user_data: Session, price_max, page=1):
+    return {
+        "dest_id": user_data.dest_id,
+        "search_type": user_data.search_type,
+        "arrival_date": user_data.checkin,
+        "departure_date": user_data.checkout,
+        "adults": user_data.adults,
+        "children_age": user_data.children or "",
+        "room_qty": user_data.room,
         "price_min": "0",
-        "price_max": user_data.get("max_price", ""),
-        "page_number": "1",
+        "price_max": price_max or "",
+        "page_number": str(page),
         "languagecode": "en-us",
         "currency_code": "USD"
     }
 
+async def fetch_next_page(user_id, user_data: Session, search: results.SearchResults, priority=None):
+    query = search_query(user_data, search.price_max, search.pages + 1)
+    response_data = await rapidapi.get("searchHotels", query, user_id, priority)
+    hotels_list = response_data.get("data", {}).get("hotels", [])
+    return search.add_page(hotels_list if isinstance(hotels_list, list) else [])
+
+async def prefetch_next_page(user_id, user_data: Session, search: results.SearchResults):
+    """Fetch and price the page after the one just shown, so "Show More" needs
+    no upstream call. At most one searchHotels page and PAGE_SIZE
+    getHotelDetails calls, all at OPTIONAL priority."""
+    if not rapidapi.limiter.allows(rapidapi.OPTIONAL) or not rapidapi.available("getHotelDetails"):
+        return
     try:
-        response = requests.get(url, headers=headers, params=querystring, timeout=10)
-        try:
-            response_data = response.json()
-        except Exception as e:
-            logger.error(f"Failed to parse hotel JSON: {e} - Raw response: {response.text}")
-            await msg.answer("⚠️ Failed to parse hotel data.")
-            return
+        upcoming = search.upcoming(user_data.max_price)
+        if len(upcoming) < results.PAGE_SIZE and not search.exhausted:
+            await fetch_next_page(user_id, user_data, search, rapidapi.OPTIONAL)
+            upcoming = search.upcoming(user_data.max_price)
+
+        pending = [hotel for hotel in upcoming if hotel.price_per_night is None]
+        details_queries = [hotel_details_query(user_data, hotel.hotel_id) for hotel in pending]
+        async for index, details in rapidapi.iter_many("getHotelDetails", details_queries, user_id, rapidapi.OPTIONAL):
+            if not isinstance(details, Exception):
+                pending[index].price_per_night, pending[index].price_total = price_breakdown(details)
+        metrics.prefetches.inc(result="done")
+    except asyncio.CancelledError:
+        metrics.prefetches.inc(result="cancelled")
+        raise
+    except Exception as e:
+        metrics.prefetches.inc(result="failed")
+        logger.info(f"[Prefetch skipped] {e}")
 
-        hotels_list = response_data.get("data", {}).get("hotels", [])
+async def show_results_page(msg: types.Message, state: FSMContext, user_data: Session, search: results.SearchResults, restart=False):
+    """Send the next page of `search` as hotel cards, then prefetch the one after."""
+    user_id = msg.from_user.id
+    hotels = search.next_page(user_data.max_price, restart)
 
-        if not isinstance(hotels_list, list) or not hotels_list:
-            logger.warning(f"Empty or invalid hotel list: {hotels_list}")
-            await msg.answer("❌ No hotels found or the response was invalid.")
-            return
-        for hotel in hotels_list[:12]:
-            hotel_id = hotel.get("hotel_id", "unknown")
+    if not hotels:
+        if restart:
+            await msg.answer("❌ No hotels found within this price limit.")
+        else:
+            await msg.answer("ℹ️ There are no more hotels for this search.", reply_markup=keyboards.additional_functions)
+        return
 
-            url = "https://booking-com15.p.rapidapi.com/api/v1/hotels/getHotelDetails"
+    # Buttons pressed while the cards go out (Stop Session, Start Over, ...)
+    # reach handling_next_step and can cancel this listing
+    await state.set_state(HotelBookingState.handling_next_step)
 
-            querystring = {
-                "hotel_id": hotel_id,
-                "arrival_date": user_data["checkin"],
-                "departure_date": user_data["checkout"],
-                "adults": user_data["adults"],
-                "children_age": user_data.get("children", ""),
-                "room_qty": user_data["room"],
-                "page_number": "1",
-                "languagecode": "en-us",
-                "currency_code": "USD"
-            }
+    cards = []
+    # Price enrichment is the first thing dropped when the API budget runs low
+    # or getHotelDetails keeps failing; the cards then keep the summary price
+    enrich = rapidapi.limiter.allows(rapidapi.OPTIONAL) and rapidapi.available("getHotelDetails")
 
-            price_per_night = "N/A"
-            price_total = "N/A"
+    # Summary cards go out straight away, priced from the searchHotels payload
+    for hotel in hotels:
+        if hotel.price_per_night is not None:
+            caption = hotel_caption(hotel, hotel.price_per_night, hotel.price_total)
+        else:
+            caption = hotel_caption(hotel) if enrich else hotel_caption(hotel, "N/A", "N/A")
 
-            try:
-                response1 = requests.get(url, headers=headers, params=querystring, timeout=10)
-                if response1.status_code == 200:
-                    price_per_night = response1.json().get("data", {}).get("product_price_breakdown", {}).get(
-                        "gross_amount_per_night", {}).get("amount_rounded", "N/A")
-                    price_total = response1.json().get("data", {}).get("product_price_breakdown", {}).get(
-                        "all_inclusive_amount", {}).get("amount_rounded", "N/A")
+        callback = f"moreinfo_{hotel.hotel_id}"
+        inline_keyboard = InlineKeyboardMarkup(
+            inline_keyboard=[
+                [InlineKeyboardButton(text="More Info 📝", callback_data=callback)],
+            ]
+        )
 
+        card = None
+        try:
+            if hotel.photo_url:
+                card = await msg.answer_photo(photo=hotel.photo_url, caption=caption, parse_mode="html", reply_markup=inline_keyboard)
+            else:
+                card = await msg.answer(caption, parse_mode="html", reply_markup=inline_keyboard)
+        except Exception as e:
+            logger.error(f"[Photo send failed] {e}")
+            try:
+                card = await msg.answer(caption, parse_mode="html", reply_markup=inline_keyboard)
             except Exception as e:
-                logging.error(e)
+                logger.error(f"[Card send failed] {e}")
 
-            name = hotel.get("property", {}).get("name", "N/A")
-            price = hotel.get("property", {}).get("priceBreakdown", {}).get("grossPrice", {}).get("value", "N/A")
-            currency = hotel.get("property", {}).get("priceBreakdown", {}).get("grossPrice", {}).get("currency", "")
-            rating = hotel.get("property", {}).get("reviewScore", "N/A")
-            description = hotel.get("accessibilityLabel", "")
-            session = get_session(user_id)
+        cards.append(card)
 
-            found_hotels_dict[hotel_id] = name
+    # Every card of the listing so far keeps working with More Info and Reserve Room
+    await set_hotels(user_id, [Hotel(hotel.hotel_id, hotel.name, hotel.description) for hotel in search.shown])
 
-            descs = session.get("hotel_descriptions")
-            if not isinstance(descs, dict):
-                descs = {}
+    await msg.answer(
+        "Please clarify the next step by clicking on relevant button below.",
+        reply_markup=keyboards.additional_functions
+    )
 
-            descs[hotel_id] = description
+    if not enrich:
+        return
 
-            set_session(user_id, "hotel_descriptions", descs)
+    # Each card is then edited in place as soon as its price breakdown arrives
+    pending = [i for i, hotel in enumerate(hotels) if hotel.price_per_night is None]
+    details_queries = [hotel_details_query(user_data, hotels[i].hotel_id) for i in pending]
+    async for index, details in rapidapi.iter_many("getHotelDetails", details_queries, user_id):
+        hotel = hotels[pending[index]]
+        card = cards[pending[index]]
+        if isinstance(details, Exception):
+            logger.error(details)
+            price_per_night, price_total = "N/A", "N/A"
+        else:
+            price_per_night, price_total = price_breakdown(details)
+            hotel.price_per_night, hotel.price_total = price_per_night, price_total
+        if card is not None:
+            await update_card(card, hotel_caption(hotel, price_per_night, price_total))
 
-            photos = hotel.get("property", {}).get("photoUrls", [])
+    # A prefetch still running for this search fetches pages this one needs too
+    usertasks.registry.start(user_id, "prefetch", prefetch_next_page(user_id, user_data, search), chain=True)
 
-            photo_urls = [url for url in photos if isinstance(url, str) and ".jpg" in url]
-            photo_url = photo_urls[0] if photo_urls else None
+@router.message(HotelBookingState.fetching_results_from_server)
+async def handle_fetching_results(msg: types.Message, state: FSMContext):
+    # A new listing supersedes the one still being sent (or still queued)
+    await usertasks.registry.run(msg.from_user.id, "listing", admitted(msg, state, list_results))
 
-            caption = (
-                f"🏨 <b>{name}</b>\n"
-                f"💰 Price: {round(price, 2)} {currency} (taxes and fees included)\n"
-                f"      Price per night: {price_per_night}\n"
-                f"      Price in total: {price_total}\n"
-                f"⭐ Rating: {rating}\n"
-                f"To get more info please click on button below ⬇️"
-            )
+async def edit_notice(notice: types.Message, text):
+    try:
+        await notice.edit_text(text)
+    except TelegramBadRequest as e:
+        logger.warning(f"[Notice update failed] {e}")
+
+async def admitted(msg: types.Message, state: FSMContext, listing):
+    """Run `listing(msg, state)` once admission control has a search slot for
+    it. A user who has to wait is told their place in line, and the notice is
+    kept up to date until the search starts."""
+    notice = None
+
+    async def show_position(position):
+        nonlocal notice
+        text = f"⏳ Lots of people are searching right now. You are number {position} in line..."
+        if notice is None:
+            notice = await msg.answer(text)
+        else:
+            await edit_notice(notice, text)
 
-            callback = f"moreinfo_{hotel_id}"
-            inline_keyboard = InlineKeyboardMarkup(
-                inline_keyboard=[
-                    [InlineKeyboardButton(text="More Info 📝", callback_data=callback)],
-                ]
-            )
+    try:
+        async with admission.controller.slot(msg.from_user.id, show_position):
+            if notice is not None:
+                await edit_notice(notice, "🔎 It's your turn! Searching now...")
+            await listing(msg, state)
+    except admission.QueueFull:
+        await msg.answer(BUSY_MESSAGE)
+
+async def list_results(msg: types.Message, state: FSMContext):
+    user_id = msg.from_user.id
+    user_data = await get_session(user_id)
 
+    try:
+        # A lower price limit or a new sort order is answered from the last search
+        search = results.store.get(user_id)
+        hotels = None
+        if search is not None and search.covers(results.search_key(user_data), user_data.max_price):
+            hotels = search.select(user_data.max_price)
+            if len(hotels) < min(results.RESULTS_MIN, len(search.hotels)):
+                hotels = None
+        metrics.results_reused.inc(result="miss" if hotels is None else "hit")
+
+        if hotels is None:
+            # The prefetch belongs to the old search; a reused one keeps it
+            usertasks.registry.cancel(user_id, "prefetch")
             try:
-                if photo_url:
-                    await msg.answer_photo(photo=photo_url, caption=caption, parse_mode="html", reply_markup=inline_keyboard)
-                else:
-                    await msg.answer(caption, parse_mode="html", reply_markup=inline_keyboard)
-            except Exception as e:
-                logging.error(f"[Photo send failed] {e}")
-                await msg.answer(caption, parse_mode="html", reply_markup=inline_keyboard)
+                response_data = await rapidapi.get("searchHotels", search_query(user_data, user_data.max_price), user_id)
+            except ValueError as e:
+                logger.error(f"Failed to parse hotel JSON: {e}")
+                await msg.answer("⚠️ Failed to parse hotel data.")
+                return
 
-            set_session(user_id, "hotels_dict", found_hotels_dict)
+            hotels_list = response_data.get("data", {}).get("hotels", [])
 
-        await msg.answer(
-            "Please clarify the next step by clicking on relevant button below.",
-            reply_markup=keyboards.additional_functions
-        )
-        await state.set_state(HotelBookingState.handling_next_step)
+            if not isinstance(hotels_list, list) or not hotels_list:
+                logger.warning(f"Empty or invalid hotel list: {hotels_list}")
+                await msg.answer("❌ No hotels found or the response was invalid.")
+                return
+
+            search = results.store.put(user_id, user_data, [HotelResult.from_api(hotel) for hotel in hotels_list])
+
+        await show_results_page(msg, state, user_data, search, restart=True)
 
-    except RequestException as e:
-        logging.error(e)
+    except rapidapi.QuotaExceeded:
+        await msg.answer(BUSY_MESSAGE)
+    except (rapidapi.RapidAPIError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logger.error(e)
         await msg.answer("API Error. Please try again later.")
     except Exception as e:
-        logging.error(e)
+        logger.error(e)
         await msg.answer(f"Request failed: {e}")
 
+async def show_more(msg: types.Message, state: FSMContext):
+    await usertasks.registry.run(msg.from_user.id, "listing", list_more_results(msg, state))
+
+async def list_more_results(msg: types.Message, state: FSMContext):
+    user_id = msg.from_user.id
+    user_data = await get_session(user_id)
+    search = results.store.get(user_id)
+
+    if search is None or not search.covers(results.search_key(user_data), user_data.max_price):
+        # The listing expired; start it over from a fresh search
+        await admitted(msg, state, list_results)
+        return
+
+    try:
+        # Usually the prefetch has already done the work below
+        await usertasks.registry.wait(user_id, "prefetch")
+        upcoming = search.upcoming(user_data.max_price)
+        short = len(upcoming) < results.PAGE_SIZE and not search.exhausted
+        if not short and all(hotel.price_per_night is not None for hotel in upcoming):
+            # A fully prefetched page only needs sending
+            await show_results_page(msg, state, user_data, search)
+            return
+
+        # Otherwise it goes upstream like a new search, so it waits its turn too
+        async def more_results(msg, state):
+            if short:
+                await fetch_next_page(user_id, user_data, search)
+            await show_results_page(msg, state, user_data, search)
+
+        await admitted(msg, state, more_results)
+
+    except rapidapi.QuotaExceeded:
+        await msg.answer(BUSY_MESSAGE)
+    except (rapidapi.RapidAPIError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logger.error(e)
+        await msg.answer("API Error. Please try again later.")
+
 @router.callback_query()
 async def moreinfo_callback(call: CallbackQuery):
+    await call.answer()
+    # Another More Info press replaces the gallery still being sent
+    await usertasks.registry.run(call.from_user.id, "gallery", send_hotel_info(call))
+
+async def send_hotel_info(call: CallbackQuery):
     user_id = call.from_user.id
     hotel_id = call.data.split("_")[1]
 
-    await call.answer()
-
-    descs = get_session(user_id).get("hotel_descriptions", {})
-    description = descs.get(hotel_id, "No additional info available.")
+    description = next(
+        (hotel.description for hotel in await get_hotels(user_id) if hotel.hotel_id == hotel_id),
+        "No additional info available."
+    )
 
     # Get hotel photo URLs
-    photo_url = "https://booking-com15.p.rapidapi.com/api/v1/hotels/getHotelPhotos"
-    detail_url = "https://booking-com15.p.rapidapi.com/api/v1/hotels/getHotelDetails"
-
     photo_query = {"hotel_id": hotel_id}
-    detail_query = {
-        "hotel_id": hotel_id,
-        "arrival_date": get_session(user_id).get("checkin"),
-        "departure_date": get_session(user_id).get("checkout"),
-        "adults": get_session(user_id).get("adults"),
-        "children_age": get_session(user_id).get("children"),
-        "room_qty": get_session(user_id).get("room"),
-        "units": "metric",
-        "temperature_unit": "c",
-        "languagecode": "en-us",
-        "currency_code": "USD"
-    }
 
     try:
-        response = requests.get(photo_url, headers=headers, params=photo_query, timeout=10)
+        try:
+            hotel_images = (await rapidapi.get("getHotelPhotos", photo_query, user_id)).get("data", [])
+        except rapidapi.RapidAPIError:
+            hotel_images = None
 
-        if response.status_code == 200:
-            hotel_images = response.json().get("data", [])
+        if hotel_images is not None:
             hotel_photos = [img.get("url") for img in hotel_images if img.get("url") and ".jpg" in img.get("url")]
 
             if not hotel_photos:
@@ -433,21 +618,7 @@ async def moreinfo_callback(call: CallbackQuery):
             max_photos = 15
             hotel_photos = hotel_photos[:max_photos]
 
-            for i, photo_url in enumerate(hotel_photos):
-                try:
-                    if i == len(hotel_photos) - 1:
-                        await call.message.answer_photo(
-                            photo=photo_url,
-                            caption=f"📌 <b>Additional Info:</b>\n{description}",
-                            parse_mode="HTML"
-                        )
-                    else:
-                        await call.message.answer_photo(photo=photo_url)
-                        await asyncio.sleep(0.5)
-                except Exception as e:
-                    logger.error(f"[Photo send failed] {e}")
-                    if i == len(hotel_photos) - 1:
-                        await call.message.answer(f"📌 <b>Additional Info:</b>\n{description}", parse_mode="HTML")
+            await send_gallery(call.message, hotel_photos, f"📌 <b>Additional Info:</b>\n{description}")
         else:
             await call.message.answer("⚠️ API error. Couldn't retrieve photos.")
     except Exception as e:
@@ -462,25 +633,39 @@ async def handling_next_step(msg: types.Message, state: FSMContext):
                          "(just the number, like `1000`. Amount will be accounted in USD)...", parse_mode="Markdown")
         await state.set_state(HotelBookingState.setting_max_price)
 
+    elif msg.text == "Show More":
+        await show_more(msg, state)
+
+    elif msg.text == "Sort Results":
+        await msg.answer("↕️ How should the hotels be ordered?", reply_markup=keyboards.sort_orders)
+        await state.set_state(HotelBookingState.choosing_sort_order)
+
     elif msg.text == "Check Nearby Locations":
-        await msg.answer("🔍 Searching for nearby cities...")
+        usertasks.registry.cancel(user_id, "prefetch")
+        with outbox.mergeable():
+            await msg.answer("🔍 Searching for nearby cities...")
         await state.set_state(HotelBookingState.checking_nearby_locations)
         await checking_nearby_locations(msg, state)
 
     elif msg.text == "Reserve Room":
-        await msg.answer("Great! Proceeding to reservation...")
+        usertasks.registry.cancel(user_id, "prefetch")
+        with outbox.mergeable():
+            await msg.answer("Great! Proceeding to reservation...")
         await state.set_state(HotelBookingState.choosing_hotel)
         await choosing_hotel(msg, state)
 
-    elif msg.text == "Another Search/Start Over":
-        clear_session(user_id)
+    elif msg.text == keyboards.START_OVER:
+        usertasks.registry.cancel(user_id)
+        await clear_session(user_id)
+        results.store.discard(user_id)
         await state.clear()
         await msg.answer("🔄 Starting a new search from the beginning...\nPlease enter your destination:\n\n`City, Country`", parse_mode="Markdown")
         await state.set_state(HotelBookingState.waiting_for_city_country)
-        await handle_waiting_for_country(msg, state)
 
     elif msg.text == "Stop Session":
-        clear_session(user_id)
+        usertasks.registry.cancel(user_id)
+        await clear_session(user_id)
+        results.store.discard(user_id)
         await state.clear()
         await msg.answer("👋 Session ended. Come back any time!")
 
@@ -490,37 +675,74 @@ async def setting_max_price(msg: types.Message, state: FSMContext):
     max_price = msg.text.strip()
 
     if max_price.isdigit():
-        set_session(user_id, "max_price", max_price)
+        await set_session(user_id, "max_price", int(max_price))
         await handle_fetching_results(msg, state)
     else:
         await msg.answer("❌ Please enter digits only (no letters or special characters).")
         await state.set_state(HotelBookingState.setting_max_price)
 
+SORT_BUTTONS = {
+    "Lowest Price": "price",
+    "Best Rating": "rating",
+    "Best Value (Price per Rating)": "value",
+}
+
+@router.message(HotelBookingState.choosing_sort_order)
+async def choosing_sort_order(msg: types.Message, state: FSMContext):
+    user_id = msg.from_user.id
+    sort_by = SORT_BUTTONS.get(msg.text.strip())
+
+    if sort_by is None:
+        await msg.answer("❌ Please choose one of the options below.", reply_markup=keyboards.sort_orders)
+        return
+
+    results.store.set_sort_order(user_id, sort_by)
+    await handle_fetching_results(msg, state)
+
 @router.message(HotelBookingState.checking_nearby_locations)
 async def checking_nearby_locations(msg: types.Message, state: FSMContext):
     user_id = msg.from_user.id
 
-    url = "https://booking-com15.p.rapidapi.com/api/v1/hotels/getNearbyCities"
-    querystring = {
-        "latitude": get_session(user_id).get("latitude"),
-        "longitude": get_session(user_id).get("longitude"),
-        "languagecode": "en-us"
-    }
+    user_data = await get_session(user_id)
+    latitude, longitude = user_data.latitude, user_data.longitude
 
     try:
-        response = requests.get(url=url, headers=headers, params=querystring, timeout=10)
+        nearby = []
+        if latitude is not None and longitude is not None:
+            nearby = destinations.index.nearest(latitude, longitude, exclude=user_data.dest_id)
+        sparse = not nearby or destinations.index.is_sparse(latitude, longitude, nearby)
+        metrics.nearby_lookups.inc(result="miss" if sparse else "hit")
 
-        if response.status_code != 200:
-            await msg.answer(f"❌ API Error: {response.status_code}")
-            return
+        if sparse:
+            querystring = {
+                "latitude": latitude,
+                "longitude": longitude,
+                "languagecode": "en-us"
+            }
+            try:
+                result = await rapidapi.get("getNearbyCities", querystring, user_id)
+            except rapidapi.RapidAPIError as e:
+                await msg.answer(f"❌ API Error: {e.status}")
+                return
 
-        result = response.json()
-        locations = result.get("data", [])
-        if not locations:
+            data = result.get("data", [])
+            if latitude is not None and longitude is not None:
+                destinations.index.add(data)
+                destinations.index.mark_filled(latitude, longitude)
+                nearby = [
+                    (location, destinations.distance_km(latitude, longitude, location["latitude"], location["longitude"]))
+                    if location.get("latitude") is not None else (location, None)
+                    for location in data
+                ]
+            else:
+                nearby = [(location, None) for location in data]
+
+        if not nearby:
             await msg.answer("⚠️ No nearby cities found.")
             return
 
-        set_session(user_id, "locations", locations)
+        locations = [location for location, _ in nearby]
+        await set_locations(user_id, locations)
 
         keyboard = [
             [KeyboardButton(text=location.get("name", "N/A"))] for location in locations[:10]
@@ -532,7 +754,11 @@ async def checking_nearby_locations(msg: types.Message, state: FSMContext):
             one_time_keyboard=True
         )
 
-        await msg.answer("📍 Please choose a nearby city:", reply_markup=markup)
+        distances = "\n".join(
+            f"• {location.get('name', 'N/A')} — {distance:.0f} km"
+            for location, distance in nearby[:10] if distance is not None
+        )
+        await msg.answer(f"📍 Please choose a nearby city:\n{distances}".rstrip(), reply_markup=markup)
         await state.set_state(HotelBookingState.selecting_nearby_location)
 
     except Exception as e:
@@ -544,16 +770,19 @@ async def selecting_nearby_location(msg: types.Message, state: FSMContext):
     user_id = msg.from_user.id
     selected_location = msg.text.strip().lower()
 
-    locations = get_session(user_id).get("locations", [])
+    locations = await get_locations(user_id)
 
     for loc in locations:
-        label = loc.get("name", "").strip().lower()
+        label = loc.name.strip().lower()
         if label == selected_location:
-            set_session(user_id, "city_name", loc.get("name", ""))
-            set_session(user_id, "latitude", loc.get("latitude", ""))
-            set_session(user_id, "longitude", loc.get("longitude", ""))
-            set_session(user_id, "dest_id", loc.get("dest_id", ""))
-            set_session(user_id, "search_type", loc.get("dest_type", "").upper())
+            await update_session(
+                user_id,
+                city_name=loc.name,
+                latitude=loc.latitude,
+                longitude=loc.longitude,
+                dest_id=loc.dest_id,
+                search_type=loc.search_type
+            )
 
             await msg.answer(f"✅ New location selected. Searching hotels in {selected_location}...")
             await handle_fetching_results(msg, state)
@@ -563,12 +792,12 @@ async def selecting_nearby_location(msg: types.Message, state: FSMContext):
 @router.message(HotelBookingState.choosing_hotel)
 async def choosing_hotel(msg: types.Message, state: FSMContext):
     user_id = msg.from_user.id
-    hotels_dict = get_session(user_id).get("hotels_dict", {})
+    hotels = await get_hotels(user_id)
 
     keyboard = []
-    for hotel_id, hotel_name in hotels_dict.items():
-        if isinstance(hotel_name, str):
-            keyboard.append([KeyboardButton(text=hotel_name)])
+    for hotel in hotels:
+        if hotel.name:
+            keyboard.append([KeyboardButton(text=hotel.name)])
 
     if not keyboard:
         await msg.answer("⚠️ No valid hotels to show.")
@@ -582,48 +811,40 @@ async def choosing_hotel(msg: types.Message, state: FSMContext):
 async def sending_reservation_link(msg: types.Message, state: FSMContext):
     user_id = msg.from_user.id
     chosen_hotel_name = msg.text.strip()
-    hotels_dict = get_session(user_id).get("hotels_dict", {})
+    hotels = await get_hotels(user_id)
 
     chosen_hotel_id = ""
-    for hotel_id, hotel_name in hotels_dict.items():
-        if hotel_name.strip().lower() == chosen_hotel_name.lower():
-            chosen_hotel_id = hotel_id
+    for hotel in hotels:
+        if hotel.name.strip().lower() == chosen_hotel_name.lower():
+            chosen_hotel_id = hotel.hotel_id
             break
 
     if not chosen_hotel_id:
         await msg.answer("❌ Could not recognize the hotel you selected. Please try again.")
-        print(f"[DEBUG] User input hotel not found: {chosen_hotel_name}")
+        logger.debug("User input hotel not found: %r", chosen_hotel_name)
         return
 
-    set_session(user_id, "chosen_hotel_id", chosen_hotel_id)
+    await set_session(user_id, "chosen_hotel_id", chosen_hotel_id)
 
-    url = "https://booking-com15.p.rapidapi.com/api/v1/hotels/getHotelDetails"
-    querystring = {
-        "hotel_id": chosen_hotel_id,
-        "arrival_date": get_session(user_id).get("checkin"),
-        "departure_date": get_session(user_id).get("checkout"),
-        "adults": get_session(user_id).get("adults"),
-        "children_age": get_session(user_id).get("children"),
-        "room_qty": get_session(user_id).get("room"),
-        "units": "metric",
-        "temperature_unit": "c",
-        "languagecode": "en-us",
-        "currency_code": "USD"
-    }
+    querystring = hotel_details_query(await get_session(user_id), chosen_hotel_id)
 
     try:
-        response = requests.get(url, headers=headers, params=querystring, timeout=10)
-        if response.status_code == 200:
-            booking_url = response.json().get("data", {}).get("url", None)
-            if booking_url:
+        try:
+            response_data = await rapidapi.get("getHotelDetails", querystring, user_id, rapidapi.CRITICAL)
+        except rapidapi.RapidAPIError as e:
+            await msg.answer(f"⚠️ API error: {e.status} - {e.text}")
+            return
+
+        booking_url = response_data.get("data", {}).get("url", None)
+        if booking_url:
+            with outbox.mergeable():
                 await msg.answer("🔗Wait a bit! You will be redirected to the official room reservation page of booking.com.", parse_mode="HTML")
-                time.sleep(3)
-                webbrowser.open_new_tab(booking_url)
-                await msg.answer(f"Here’s your reservation link:\n{booking_url}")
-            else:
-                await msg.answer("⚠️ No reservation link found.")
+            await asyncio.sleep(3)
+            # Starting a browser blocks; keep it off the event loop
+            await asyncio.to_thread(webbrowser.open_new_tab, booking_url)
+            await msg.answer(f"Here’s your reservation link:\n{booking_url}")
         else:
-            await msg.answer(f"⚠️ API error: {response.status_code} - {response.text}")
+            await msg.answer("⚠️ No reservation link found.")
 
     except Exception as e:
         logger.error(f"[Reservation Link Error] {e}")
@@ -632,4 +853,4 @@ async def sending_reservation_link(msg: types.Message, state: FSMContext):
 @router.message()
 async def fallback(msg: types.Message):
     await msg.answer("❓ I didn't understand that. Please select from the options.")
-    print(f"[UNHANDLED MESSAGE] {msg.text}")
\ No newline at end of file
+    logger.info("Unhandled message: %r", msg.text)
\ No newline at end of file
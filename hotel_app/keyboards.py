@@ -1,6 +1,7 @@
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.utils.keyboard import ReplyKeyboardBuilder, InlineKeyboardBuilder
 
+START_OVER = "Another search/Start Over"
 
 continue_or_exit = ReplyKeyboardMarkup(keyboard=[
     [KeyboardButton(text="Continue"), KeyboardButton(text="Exit")]
@@ -35,11 +36,21 @@ room_count = ReplyKeyboardMarkup(keyboard=[
 )
 
 additional_functions = ReplyKeyboardMarkup(keyboard=[
-    [KeyboardButton(text="Set Price Limit"), KeyboardButton(text="Check Nearby Locations")],
-    [KeyboardButton(text="Reserve Room"), KeyboardButton(text="Another search/Start Over")],
+    [KeyboardButton(text="Show More")],
+    [KeyboardButton(text="Set Price Limit"), KeyboardButton(text="Sort Results")],
+    [KeyboardButton(text="Check Nearby Locations")],
+    [KeyboardButton(text="Reserve Room"), KeyboardButton(text=START_OVER)],
     [KeyboardButton(text="Stop Session")],
 ],
     resize_keyboard=True,
     one_time_keyboard=True,
     input_field_placeholder="Additional Functions:"
-)
\ No newline at end of file
+)
+
+sort_orders = ReplyKeyboardMarkup(keyboard=[
+    [KeyboardButton(text="Lowest Price"), KeyboardButton(text="Best Rating")],
+    [KeyboardButton(text="Best Value (Price per Rating)")],
+],
+    resize_keyboard=True,
+    one_time_keyboard=True
+)
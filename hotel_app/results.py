@@ -0,0 +1,166 @@
+"""Last hotel search of each user, kept in memory so that a lower price limit
+or another sort order is answered locally instead of searching again.
+
+Results are listed PAGE_SIZE hotels at a time. While the user reads one page,
+the next one is prefetched in the background (a "prefetch" task in
+usertasks.py)."""
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from datetime import date
+from typing import Optional
+from config import SESSION_CACHE_SIZE, RESULTS_MAX_AGE
+
+# A filtered set smaller than this is topped up with a fresh upstream search
+RESULTS_MIN = 3
+# Hotel cards per page of the listing
+PAGE_SIZE = 12
+
+
+def _number(value):
+    return float(value) if isinstance(value, (int, float)) else None
+
+
+@dataclass(slots=True)
+class HotelResult:
+    hotel_id: str
+    name: str
+    description: str
+    price: Optional[float]       # whole stay, from searchHotels
+    currency: str
+    rating: Optional[float]
+    photo_url: Optional[str]
+    # Filled in from getHotelDetails once the card has been enriched
+    price_per_night: Optional[str] = None
+    price_total: Optional[str] = None
+
+    @classmethod
+    def from_api(cls, hotel):
+        prop = hotel.get("property", {})
+        gross = prop.get("priceBreakdown", {}).get("grossPrice", {})
+        photos = [url for url in prop.get("photoUrls", []) if isinstance(url, str) and ".jpg" in url]
+        return cls(
+            hotel_id=str(hotel.get("hotel_id", "unknown")),
+            name=prop.get("name", "N/A"),
+            description=hotel.get("accessibilityLabel", ""),
+            price=_number(gross.get("value")),
+            currency=gross.get("currency", ""),
+            rating=_number(prop.get("reviewScore")),
+            photo_url=photos[0] if photos else None,
+        )
+
+
+def _nights(checkin, checkout):
+    try:
+        return max(1, (date.fromisoformat(checkout) - date.fromisoformat(checkin)).days)
+    except (TypeError, ValueError):
+        return 1
+
+
+@dataclass(slots=True)
+class SearchResults:
+    key: tuple
+    price_max: Optional[int]     # limit the upstream search was made with
+    nights: int
+    hotels: list
+    sort_by: Optional[str] = None    # "price", "rating", "value" or None for upstream order
+    pages: int = 1                   # searchHotels pages fetched so far
+    exhausted: bool = False          # the last page fetched added nothing new
+    shown: list = field(default_factory=list)
+    fetched_at: float = field(default_factory=time.monotonic)
+
+    def nightly_price(self, hotel):
+        return hotel.price / self.nights if hotel.price is not None else None
+
+    def covers(self, key, price_max):
+        """Whether this search can answer `key` with limit `price_max` locally."""
+        if key != self.key or time.monotonic() - self.fetched_at > RESULTS_MAX_AGE:
+            return False
+        return self.price_max is None or (price_max is not None and price_max <= self.price_max)
+
+    def select(self, price_max):
+        """Hotels within `price_max` per night, in the chosen sort order."""
+        hotels = [
+            hotel for hotel in self.hotels
+            if price_max is None or (self.nightly_price(hotel) is not None and self.nightly_price(hotel) <= price_max)
+        ]
+        missing = float("inf")
+        if self.sort_by == "price":
+            hotels.sort(key=lambda hotel: hotel.price if hotel.price is not None else missing)
+        elif self.sort_by == "rating":
+            hotels.sort(key=lambda hotel: -(hotel.rating or 0))
+        elif self.sort_by == "value":
+            hotels.sort(key=lambda hotel: hotel.price / hotel.rating if hotel.price is not None and hotel.rating else missing)
+        return hotels
+
+
+    def add_page(self, hotels_list):
+        """Append one more searchHotels page; returns how many hotels were new."""
+        known = {hotel.hotel_id for hotel in self.hotels}
+        added = [
+            hotel for hotel in (HotelResult.from_api(h) for h in hotels_list if isinstance(h, dict))
+            if hotel.hotel_id not in known
+        ]
+        self.pages += 1
+        self.hotels += added
+        self.exhausted = not added
+        return len(added)
+
+    def upcoming(self, price_max):
+        """The next page of the current listing, without marking it shown."""
+        shown = {hotel.hotel_id for hotel in self.shown}
+        return [hotel for hotel in self.select(price_max) if hotel.hotel_id not in shown][:PAGE_SIZE]
+
+    def next_page(self, price_max, restart=False):
+        if restart:
+            self.shown = []
+        page = self.upcoming(price_max)
+        self.shown += page
+        return page
+
+
+def search_key(user_data):
+    """Everything a searchHotels query depends on except the price limit."""
+    return (
+        user_data.dest_id, user_data.search_type, user_data.checkin, user_data.checkout,
+        user_data.adults, user_data.children, user_data.room,
+    )
+
+
+class ResultStore:
+    def __init__(self, max_users=SESSION_CACHE_SIZE):
+        self.max_users = max_users
+        self._results = OrderedDict()
+
+    def get(self, user_id) -> Optional[SearchResults]:
+        results = self._results.get(user_id)
+        if results is not None:
+            self._results.move_to_end(user_id)
+        return results
+
+    def put(self, user_id, user_data, hotels):
+        previous = self._results.get(user_id)
+        self._results[user_id] = results = SearchResults(
+            key=search_key(user_data),
+            price_max=user_data.max_price,
+            nights=_nights(user_data.checkin, user_data.checkout),
+            hotels=hotels,
+            sort_by=previous.sort_by if previous is not None else None,
+        )
+        self._results.move_to_end(user_id)
+        while len(self._results) > self.max_users:
+            self._results.popitem(last=False)
+        return results
+
+    def set_sort_order(self, user_id, sort_by):
+        results = self.get(user_id)
+        if results is None:
+            # Nothing to reorder yet; the next search starts out in this order
+            results = self._results[user_id] = SearchResults(key=None, price_max=None, nights=1, hotels=[])
+        results.sort_by = sort_by
+
+    def discard(self, user_id):
+        self._results.pop(user_id, None)
+
+
+store = ResultStore()
@@ -12,6 +12,7 @@ class HotelBookingState(StatesGroup):
     fetching_results_from_server = State()
     handling_next_step = State()
     setting_max_price = State()
+    choosing_sort_order = State()
     checking_nearby_locations = State()
     selecting_nearby_location = State()
     choosing_hotel = State()
@@ -0,0 +1,133 @@
+"""Logging setup: records are handed to a queue on the calling thread and
+formatted and written by a QueueListener thread, so the event loop never
+waits on disk or spends time rendering messages.
+
+bot.log gets one JSON object per line with the request id of the update being
+handled (see RequestContextMiddleware) and any `extra` fields such as
+latency_ms; every field is truncated to LOG_MAX_FIELD characters. The console
+keeps the plain text format. LOG_DEBUG_MODULES lists loggers to run at DEBUG,
+e.g. "rapidapi,hotel_app.handlers"."""
+import atexit
+import contextvars
+import json
+import logging
+import queue
+import random
+import time
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from aiogram import BaseMiddleware
+from config import LOG_PATH, LOG_LEVEL, LOG_DEBUG_MODULES, LOG_MAX_FIELD, LOG_PAYLOAD_SAMPLE
+
+logger = logging.getLogger(__name__)
+
+request_id = contextvars.ContextVar("request_id", default=None)
+
+# Attributes every LogRecord has; anything else came in through `extra`
+_STANDARD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+
+def truncate(text, limit=LOG_MAX_FIELD):
+    text = str(text)
+    if len(text) <= limit:
+        return text
+    return f"{text[:limit]}...[{len(text) - limit} more chars]"
+
+
+class Payload:
+    """Deferred, truncated rendering of a large object for a log call; the
+    repr is only built by the listener thread, and only if the record is
+    actually written."""
+    __slots__ = ("value", "limit")
+
+    def __init__(self, value, limit=LOG_MAX_FIELD):
+        self.value = value
+        self.limit = limit
+
+    def __str__(self):
+        return truncate(repr(self.value), self.limit)
+
+
+def sampled(rate=LOG_PAYLOAD_SAMPLE):
+    """Whether to log one more payload at INFO, `rate` of the time."""
+    return rate >= 1 or random.random() < rate
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": self.formatTime(record, "%Y-%m-%dT%H:%M:%S") + f".{int(record.msecs):03d}",
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": truncate(record.getMessage()),
+        }
+        for key, value in vars(record).items():
+            if key not in _STANDARD_ATTRIBUTES and value is not None:
+                entry[key] = value if isinstance(value, (int, float, bool)) else truncate(value)
+        if record.exc_info:
+            entry["exc"] = truncate(self.formatException(record.exc_info), LOG_MAX_FIELD * 4)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class _ContextFilter(logging.Filter):
+    def filter(self, record):
+        record.request_id = request_id.get()
+        return True
+
+
+class _DeferredQueueHandler(QueueHandler):
+    # The stock prepare() renders the message on the calling thread; the
+    # listener formats it instead (the queue never leaves this process)
+    def prepare(self, record):
+        return record
+
+
+_listener = None
+
+
+def setup(path=LOG_PATH, level=LOG_LEVEL, debug_modules=LOG_DEBUG_MODULES):
+    global _listener
+    if _listener is not None:
+        return
+
+    file_handler = RotatingFileHandler(path, maxBytes=2*1024*1024, backupCount=3, encoding="utf-8")
+    file_handler.setFormatter(JsonFormatter())
+    console_handler = logging.StreamHandler()
+    console_handler.setFormatter(logging.Formatter("%(asctime)s [%(levelname)s] %(name)s: %(message)s"))
+
+    records = queue.SimpleQueue()
+    handler = _DeferredQueueHandler(records)
+    handler.addFilter(_ContextFilter())
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(level)
+    for name in filter(None, (module.strip() for module in debug_modules.split(","))):
+        logging.getLogger(name).setLevel(logging.DEBUG)
+
+    _listener = QueueListener(records, file_handler, console_handler, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop)
+
+
+def stop():
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+class RequestContextMiddleware(BaseMiddleware):
+    """Outer middleware on dp.update: tags every record logged while handling
+    an update with its update_id, and logs the update's latency at DEBUG."""
+
+    async def __call__(self, handler, event, data):
+        token = request_id.set(event.update_id)
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            logger.debug(
+                "update handled",
+                extra={"update_type": event.event_type, "latency_ms": round((time.perf_counter() - started) * 1000, 1)}
+            )
+            request_id.reset(token)
+
@@ -1,36 +1,79 @@
-from db import init_db
+from db import init_db, close_db, start_maintenance, stop_maintenance
 from aiogram import Bot, Dispatcher
-from config import BOT_TOKEN
+from config import BOT_TOKEN, BOT_MODE, SHARD_WORKERS
+import argparse
 import asyncio
 import logging
-from logging.handlers import RotatingFileHandler
+import logs
+import outbox
 from hotel_app.handlers import router
+import rapidapi
+import usertasks
+import destinations
+import metrics
+import webhook
+import fsm_storage
+import sharding
+import diagnostics
 
 """Loging a bot to the further actions"""
 
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s [%(levelname)s] %(message)s",
-    handlers=[
-        RotatingFileHandler("bot.log", maxBytes=2*1024*1024, backupCount=3),
-        logging.StreamHandler()
-    ]
-)
+logs.setup()
 
 logger = logging.getLogger(__name__)
 
 
 bot = Bot(token=BOT_TOKEN)
-dp = Dispatcher()
+bot.session.middleware(outbox.queue)
+dp = Dispatcher(storage=fsm_storage.create_storage())
 
 
-async def main():
-    init_db()
+def setup_dispatcher():
+    # Before the handlers, whose states would take /profile as input
+    dp.include_router(diagnostics.router)
     dp.include_router(router)
+    dp.update.outer_middleware(logs.RequestContextMiddleware())
+    metrics.setup(dp, bot, [router])
+    dp.startup.register(init_db)
+    dp.startup.register(start_maintenance)
+    dp.startup.register(metrics.start)
+    dp.startup.register(diagnostics.start)
+    dp.shutdown.register(diagnostics.stop)
+    dp.shutdown.register(metrics.stop)
+    dp.shutdown.register(stop_maintenance)
+    dp.shutdown.register(usertasks.close)
+    dp.shutdown.register(outbox.close)
+    dp.shutdown.register(rapidapi.close)
+    dp.shutdown.register(destinations.close)
+    dp.shutdown.register(close_db)
+
+
+def create_worker():
+    """Dispatcher of one shard worker process (see sharding.py)."""
+    setup_dispatcher()
+    return dp, bot
+
+
+async def main():
+    setup_dispatcher()
+    await webhook.delete_for_polling(bot)
     await dp.start_polling(bot)
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mode", choices=("polling", "webhook"), default=BOT_MODE)
+    parser.add_argument("--workers", type=int, default=SHARD_WORKERS,
+                        help="handle updates in this many worker processes, sharded by user")
+    args = parser.parse_args()
+
     try:
-        asyncio.run(main())
+        if args.workers > 1:
+            dp.include_router(router)
+            sharding.run(dp, bot, args.workers, create_worker, args.mode)
+        elif args.mode == "webhook":
+            setup_dispatcher()
+            webhook.run(dp, bot)
+        else:
+            asyncio.run(main())
     except KeyboardInterrupt:
-        print("Exiting...")
\ No newline at end of file
+        logger.info("Exiting...")
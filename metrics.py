@@ -0,0 +1,329 @@
+"""In-process metrics: counters and latency histograms, exposed in the
+Prometheus text format on METRICS_HOST:METRICS_PORT and summarized in a log
+line every METRICS_LOG_INTERVAL seconds."""
+import asyncio
+import logging
+import time
+from collections import defaultdict
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiohttp import web
+from config import METRICS_HOST, METRICS_PORT, METRICS_LOG_INTERVAL
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+REGISTRY = []
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [*zip(names, values), *extra]
+    if not pairs:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = defaultdict(float)
+        REGISTRY.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels.get(label, "")) for label in self.labels)
+
+    def inc(self, amount=1, **labels):
+        self._values[self._key(labels)] += amount
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0.0)
+
+    def total(self):
+        return sum(self._values.values())
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for key, value in sorted(self._values.items()):
+            lines.append(f"{self.name}{_format_labels(self.labels, key)} {value:g}")
+        return lines
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        self._values[self._key(labels)] = value
+
+
+class _Series:
+    __slots__ = ("buckets", "count", "sum")
+
+    def __init__(self, size):
+        self.buckets = [0] * size
+        self.count = 0
+        self.sum = 0.0
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.bounds = tuple(buckets)
+        self._series = {}
+        REGISTRY.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(label, "")) for label in self.labels)
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = _Series(len(self.bounds))
+        series.count += 1
+        series.sum += value
+        for i, bound in enumerate(self.bounds):
+            if value <= bound:
+                series.buckets[i] += 1
+                break
+
+    def time(self, **labels):
+        return _Timer(self, labels)
+
+    def quantile(self, q, key):
+        """Estimate a quantile of one series from its buckets (upper bound)."""
+        series = self._series.get(key)
+        if not series or not series.count:
+            return 0.0
+        target = q * series.count
+        seen = 0
+        for bound, count in zip(self.bounds, series.buckets):
+            seen += count
+            if seen >= target:
+                return bound
+        return float("inf")
+
+    def series(self):
+        return {key: (s.count, s.sum) for key, s in self._series.items()}
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for key, series in sorted(self._series.items()):
+            cumulative = 0
+            for bound, count in zip(self.bounds, series.buckets):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, [('le', f'{bound:g}')])} {cumulative}")
+            lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, [('le', '+Inf')])} {series.count}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {series.sum:g}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {series.count}")
+        return lines
+
+
+class _Timer:
+    __slots__ = ("histogram", "labels", "started")
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None and "status" in self.histogram.labels and "status" not in self.labels:
+            self.labels["status"] = exc_type.__name__
+        self.histogram.observe(time.perf_counter() - self.started, **self.labels)
+
+
+update_duration = Histogram(
+    "bot_update_duration_seconds", "Time to handle one Telegram update", ("update_type", "state")
+)
+handler_duration = Histogram(
+    "bot_handler_duration_seconds", "Time spent in each handler", ("handler",)
+)
+upstream_duration = Histogram(
+    "rapidapi_request_duration_seconds", "booking-com15 request latency", ("endpoint", "status")
+)
+upstream_cache = Counter(
+    "rapidapi_cache_total", "Response cache lookups", ("endpoint", "result")
+)
+upstream_coalesced = Counter(
+    "rapidapi_coalesced_total", "Calls answered by an identical request already in flight", ("endpoint",)
+)
+destination_lookups = Counter(
+    "destination_index_total", "City lookups answered locally (hit) or sent upstream (miss)", ("result",)
+)
+nearby_lookups = Counter(
+    "nearby_index_total", "Nearby-city lookups answered by the grid index (hit) or upstream (miss)", ("result",)
+)
+results_reused = Counter(
+    "search_results_reused_total", "Result lists served from the last search (hit) or a new searchHotels (miss)", ("result",)
+)
+prefetches = Counter(
+    "search_prefetch_total", "Background next-page prefetches by outcome", ("result",)
+)
+upstream_retries = Counter(
+    "rapidapi_retries_total", "Calls repeated after a timeout, 429 or 5xx", ("endpoint",)
+)
+upstream_hedged = Counter(
+    "rapidapi_hedged_total", "Duplicate requests sent for calls slower than their p95, by which one answered", ("endpoint", "winner")
+)
+breaker_state = Gauge(
+    "rapidapi_breaker_state", "Circuit breaker per endpoint: 0 closed, 1 open, 2 half-open", ("endpoint",)
+)
+breaker_rejected = Counter(
+    "rapidapi_breaker_rejected_total", "Calls failed fast because the endpoint's circuit was open", ("endpoint",)
+)
+upstream_cancelled = Counter(
+    "rapidapi_cancelled_total", "Calls aborted because every caller waiting for them was cancelled", ("endpoint",)
+)
+user_tasks_cancelled = Counter(
+    "user_tasks_cancelled_total", "Listings, galleries and prefetches cancelled because the user moved on", ("kind",)
+)
+searches_running = Gauge(
+    "searches_running", "Hotel searches holding an admission slot"
+)
+searches_queued = Gauge(
+    "searches_queued", "Hotel searches waiting for an admission slot"
+)
+searches_rejected = Counter(
+    "searches_rejected_total", "Hotel searches refused because the admission queue was full"
+)
+admission_wait = Histogram(
+    "search_admission_wait_seconds", "Time a hotel search waited for an admission slot"
+)
+upstream_limited = Counter(
+    "rapidapi_quota_rejected_total", "Calls refused because the quota budget was too low", ("endpoint",)
+)
+sessions_expired = Counter(
+    "db_sessions_expired_total", "Sessions deleted after SESSION_TTL without activity"
+)
+db_duration = Histogram(
+    "db_operation_duration_seconds", "Session store operation latency", ("operation",)
+)
+telegram_duration = Histogram(
+    "telegram_request_duration_seconds", "Bot API request latency", ("method", "status")
+)
+telegram_merged = Counter(
+    "telegram_merged_messages_total", "Text messages folded into the message queued before them"
+)
+telegram_retry_after = Counter(
+    "telegram_retry_after_total", "Bot API calls Telegram answered with RetryAfter"
+)
+loop_lag = Histogram(
+    "event_loop_lag_seconds", "How late the event loop woke up a timer",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+)
+loop_stalls = Counter(
+    "event_loop_stalls_total", "Times the event loop was blocked for longer than LOOP_STALL_THRESHOLD"
+)
+
+
+def render():
+    lines = []
+    for metric in REGISTRY:
+        lines += metric.render()
+    return "\n".join(lines) + "\n"
+
+
+def summary():
+    """One-line digest: count and approximate p95 of each latency histogram."""
+    parts = []
+    for metric in REGISTRY:
+        if not isinstance(metric, Histogram):
+            continue
+        series = metric.series()
+        if not series:
+            continue
+        count = sum(c for c, _ in series.values())
+        worst = max(series, key=lambda key: metric.quantile(0.95, key))
+        parts.append(
+            f"{metric.name}: n={count} slowest[{'/'.join(worst)}] p95<={metric.quantile(0.95, worst):g}s"
+        )
+    return "; ".join(parts)
+
+
+class UpdateMetricsMiddleware(BaseMiddleware):
+    """Outer middleware on dp.update: latency per update type and the FSM state
+    the user was in when the update arrived."""
+
+    async def __call__(self, handler, event, data):
+        state = data.get("state")
+        current_state = (await state.get_state() if state is not None else None) or "none"
+        with update_duration.time(update_type=event.event_type, state=current_state):
+            return await handler(event, data)
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Inner middleware on router observers: latency per matched handler."""
+
+    async def __call__(self, handler, event, data):
+        handler_object = data.get("handler")
+        name = getattr(getattr(handler_object, "callback", None), "__name__", "unknown")
+        with handler_duration.time(handler=name):
+            return await handler(event, data)
+
+
+class TelegramMetricsMiddleware(BaseRequestMiddleware):
+    """Bot session middleware timing every outgoing Bot API call."""
+
+    async def __call__(self, make_request, bot, method):
+        with telegram_duration.time(method=type(method).__name__) as timer:
+            response = await make_request(bot, method)
+            timer.labels["status"] = "ok"
+            return response
+
+
+def setup(dp, bot, routers=()):
+    dp.update.outer_middleware(UpdateMetricsMiddleware())
+    for router in routers:
+        router.message.middleware(HandlerMetricsMiddleware())
+        router.callback_query.middleware(HandlerMetricsMiddleware())
+    bot.session.middleware(TelegramMetricsMiddleware())
+
+
+async def _handle_metrics(request):
+    return web.Response(text=render(), content_type="text/plain", charset="utf-8",
+                        headers={"X-Content-Type-Options": "nosniff"})
+
+
+async def _log_periodically():
+    while True:
+        await asyncio.sleep(METRICS_LOG_INTERVAL)
+        digest = summary()
+        if digest:
+            logger.info("Metrics summary: %s", digest)
+
+
+_runner = None
+_logger_task = None
+
+
+async def start():
+    global _runner, _logger_task
+    if METRICS_PORT:
+        app = web.Application()
+        app.router.add_get("/metrics", _handle_metrics)
+        _runner = web.AppRunner(app, access_log=None)
+        await _runner.setup()
+        await web.TCPSite(_runner, METRICS_HOST, METRICS_PORT).start()
+        logger.info(f"Metrics available at http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    if METRICS_LOG_INTERVAL > 0:
+        _logger_task = asyncio.create_task(_log_periodically())
+
+
+async def stop():
+    global _runner, _logger_task
+    if _logger_task is not None:
+        _logger_task.cancel()
+        _logger_task = None
+    if _runner is not None:
+        await _runner.cleanup()
+        _runner = None
@@ -0,0 +1,184 @@
+"""Outbound flood control for Bot API calls.
+
+SendQueue is a request middleware on the bot session, so every message the
+handlers send goes through it without the handlers changing. Calls that
+target a chat are queued per chat and delivered in order by one worker per
+chat. Each call takes a token from that chat's bucket and from a global
+bucket sized to Telegram's limits (about 30 messages per second overall and
+one per second per chat, with a short burst allowed).
+
+A TelegramRetryAfter answer drains the chat's bucket for the time Telegram
+asked for, and the call is retried from the head of the queue. Plain text
+messages sent inside mergeable() and waiting for the same chat are merged
+into one message, which leaves more of the budget for photos and edits.
+Calls without a chat, such as getUpdates or answerCallbackQuery, pass
+straight through."""
+import asyncio
+import contextvars
+import logging
+from collections import deque
+from contextlib import contextmanager
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import SendMessage
+from aiogram.types import InlineKeyboardMarkup
+import metrics
+from ratelimit import TokenBucket, KeyedBuckets
+from config import TELEGRAM_RATE, TELEGRAM_BURST, TELEGRAM_CHAT_RATE, TELEGRAM_CHAT_BURST
+
+logger = logging.getLogger(__name__)
+
+MAX_RETRIES = 3
+MAX_TEXT = 4096
+MERGE_SEPARATOR = "\n\n"
+
+_merge_allowed = contextvars.ContextVar("merge_allowed", default=False)
+
+
+@contextmanager
+def mergeable():
+    """Let the text messages sent in this block be merged with their
+    neighbours. Only for messages nobody edits later: an edit of a merged
+    message overwrites the texts merged into it, and every caller gets the
+    same Message back."""
+    token = _merge_allowed.set(True)
+    try:
+        yield
+    finally:
+        _merge_allowed.reset(token)
+
+
+class _Pending:
+    __slots__ = ("make_request", "method", "futures", "mergeable")
+
+    def __init__(self, make_request, method):
+        self.make_request = make_request
+        self.method = method
+        self.futures = [asyncio.get_running_loop().create_future()]
+        self.mergeable = _merge_allowed.get()
+
+    @property
+    def abandoned(self):
+        # Every caller waiting for it was cancelled
+        return all(future.done() for future in self.futures)
+
+
+def _cost(method):
+    # Towards the global limit a media group counts as one message per photo
+    return len(getattr(method, "media", None) or ()) or 1
+
+
+def _mergeable(first, second):
+    """Whether queued text message `second` can be appended to `first`.
+
+    Both must have been sent inside mergeable(). Only the last message of a
+    merged run may carry a keyboard, and never an inline one: inline
+    keyboards belong to cards the handlers edit later."""
+    if not first.mergeable or not second.mergeable:
+        return False
+    first, second = first.method, second.method
+    if not isinstance(first, SendMessage) or not isinstance(second, SendMessage):
+        return False
+    if first.reply_markup is not None or isinstance(second.reply_markup, InlineKeyboardMarkup):
+        return False
+    if first.entities or second.entities:
+        return False
+    if len(first.text) + len(MERGE_SEPARATOR) + len(second.text) > MAX_TEXT:
+        return False
+    ignored = {"text", "reply_markup"}
+    return first.model_dump(exclude=ignored) == second.model_dump(exclude=ignored)
+
+
+class SendQueue(BaseRequestMiddleware):
+    def __init__(self, rate=TELEGRAM_RATE, burst=TELEGRAM_BURST,
+                 chat_rate=TELEGRAM_CHAT_RATE, chat_burst=TELEGRAM_CHAT_BURST, max_chats=10000):
+        self.global_bucket = TokenBucket(rate, burst)
+        self.chat_buckets = KeyedBuckets(chat_rate, chat_burst, max_chats)
+        self._queues = {}
+        self._workers = {}
+
+    async def __call__(self, make_request, bot, method):
+        chat_id = getattr(method, "chat_id", None)
+        if chat_id is None:
+            return await make_request(bot, method)
+
+        pending = _Pending(make_request, method)
+        self._queues.setdefault(chat_id, deque()).append(pending)
+        if chat_id not in self._workers:
+            self._workers[chat_id] = asyncio.create_task(self._drain(chat_id, bot))
+        return await pending.futures[0]
+
+    def _merge(self, pending, waiting):
+        """Fold the text messages queued right behind `pending` into it."""
+        while waiting and not waiting[0].abandoned and _mergeable(pending, waiting[0]):
+            following = waiting.popleft()
+            pending.method = pending.method.model_copy(update={
+                "text": pending.method.text + MERGE_SEPARATOR + following.method.text,
+                "reply_markup": following.method.reply_markup,
+            })
+            pending.futures += following.futures
+            metrics.telegram_merged.inc()
+
+    async def _drain(self, chat_id, bot):
+        waiting = self._queues[chat_id]
+        try:
+            while waiting:
+                pending = waiting.popleft()
+                if pending.abandoned:
+                    continue
+                self._merge(pending, waiting)
+                await self._deliver(chat_id, bot, pending)
+        finally:
+            del self._workers[chat_id]
+            if waiting:
+                # Cancelled while calls were still queued; fail them instead of hanging
+                for pending in waiting:
+                    for future in pending.futures:
+                        if not future.done():
+                            future.cancel()
+            del self._queues[chat_id]
+
+    async def _deliver(self, chat_id, bot, pending):
+        bucket = self.chat_buckets.get(chat_id)
+        cost = min(_cost(pending.method), self.global_bucket.capacity)
+        for attempt in range(MAX_RETRIES + 1):
+            await bucket.acquire()
+            await self.global_bucket.acquire(cost)
+            try:
+                result = await pending.make_request(bot, pending.method)
+            except TelegramRetryAfter as e:
+                metrics.telegram_retry_after.inc()
+                bucket.drain(e.retry_after)
+                if attempt < MAX_RETRIES:
+                    logger.warning(f"[Telegram flood control] chat {chat_id}: retrying in {e.retry_after}s")
+                    continue
+                self._settle(pending, error=e)
+                return
+            except Exception as e:
+                self._settle(pending, error=e)
+                return
+            self._settle(pending, result=result)
+            return
+
+    @staticmethod
+    def _settle(pending, result=None, error=None):
+        for future in pending.futures:
+            if future.done():
+                continue
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+    async def close(self):
+        """Let the queued messages go out before the bot session closes."""
+        workers = list(self._workers.values())
+        if workers:
+            await asyncio.wait(workers, timeout=10)
+
+
+queue = SendQueue()
+
+
+async def close():
+    await queue.close()
@@ -0,0 +1,333 @@
+"""Async client for the booking-com15 RapidAPI endpoints.
+
+All handlers share one pooled aiohttp session (keep-alive connections to the
+RapidAPI host) and one semaphore, so a burst of requests never exceeds
+RAPIDAPI_CONCURRENCY calls in flight and never blocks the event loop. Calls
+that reach the network first pass the shared rate limiter (see ratelimit.py).
+Identical calls made while one is already in flight share its response
+instead of reaching the network again (single-flight).
+
+Timeouts, 429s and 5xx answers are retried with jittered exponential backoff.
+A call still unanswered after its endpoint's p95 latency gets a hedged
+duplicate, and whichever answers first wins. Each endpoint has a circuit
+breaker (see breaker.py): while it is open, calls fail fast with CircuitOpen,
+or return the last cached response even when it has expired."""
+import asyncio
+import logging
+import random
+import time
+from collections import defaultdict
+import aiohttp
+import cache
+import metrics
+import ratelimit
+import breaker
+from ratelimit import CRITICAL, NORMAL, OPTIONAL, QuotaExceeded
+from config import (
+    RAPIDAPI_KEY, RAPIDAPI_HOST, RAPIDAPI_BASE_URL, RAPIDAPI_TIMEOUT, RAPIDAPI_CONCURRENCY,
+    RAPIDAPI_RETRIES, RAPIDAPI_RETRY_BACKOFF, RAPIDAPI_HEDGE_QUANTILE
+)
+
+logger = logging.getLogger(__name__)
+
+BASE_URL = RAPIDAPI_BASE_URL
+
+headers = {
+    "x-rapidapi-key": RAPIDAPI_KEY or "",
+    "x-rapidapi-host": RAPIDAPI_HOST
+}
+
+# Seconds a successful response stays cached; endpoints not listed are never cached
+CACHE_TTLS = {
+    "searchDestination": 3 * 24 * 3600,
+    "getNearbyCities": 3 * 24 * 3600,
+    "getHotelPhotos": 12 * 3600,
+    "searchHotels": 10 * 60,
+    "getHotelDetails": 10 * 60,
+}
+
+# Default priority of each endpoint when the quota budget runs low
+ENDPOINT_PRIORITY = {
+    "searchDestination": CRITICAL,
+    "searchHotels": CRITICAL,
+    "getHotelPhotos": NORMAL,
+    "getNearbyCities": NORMAL,
+    "getHotelDetails": OPTIONAL,
+}
+
+limiter = ratelimit.RateLimiter()
+breakers = {}
+latencies = defaultdict(breaker.LatencyWindow)
+
+_session = None
+_semaphore = None
+_cache = None
+# cache key -> task fetching it, shared by every caller asking for the same thing
+_in_flight = {}
+# fetch task -> number of callers waiting for it
+_waiters = {}
+
+
+class RapidAPIError(Exception):
+    def __init__(self, status, text=""):
+        super().__init__(f"{status} - {text}" if text else str(status))
+        self.status = status
+        self.text = text
+
+
+class CircuitOpen(RapidAPIError):
+    """The endpoint failed too often recently; the call was not attempted."""
+
+    def __init__(self, endpoint):
+        super().__init__(503, f"{endpoint} is unavailable (circuit open)")
+        self.endpoint = endpoint
+
+
+def _client():
+    global _session, _semaphore
+    if _session is None or _session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=RAPIDAPI_CONCURRENCY,
+            keepalive_timeout=60,
+            ttl_dns_cache=300
+        )
+        _session = aiohttp.ClientSession(
+            headers=headers,
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=RAPIDAPI_TIMEOUT)
+        )
+        _semaphore = asyncio.Semaphore(RAPIDAPI_CONCURRENCY)
+    return _session
+
+
+def _response_cache():
+    global _cache
+    if _cache is None:
+        _cache = cache.create_cache()
+    return _cache
+
+
+def _breaker(endpoint):
+    if endpoint not in breakers:
+        breakers[endpoint] = breaker.CircuitBreaker(endpoint)
+    return breakers[endpoint]
+
+
+def available(endpoint):
+    """False while the endpoint's circuit is open, so optional work such as
+    price enrichment can be skipped up front."""
+    return endpoint not in breakers or breakers[endpoint].state != breaker.OPEN
+
+
+def _retry_after(response, default=1.0):
+    try:
+        return float(response.headers.get("Retry-After", default))
+    except ValueError:
+        return default
+
+
+def _clean_params(params):
+    # aiohttp only accepts str/int/float query values, requests used to drop None
+    return {k: str(v) for k, v in (params or {}).items() if v is not None}
+
+
+async def get(endpoint, params=None, user_id=None, priority=None):
+    """Call `endpoint` (e.g. "searchHotels") and return the decoded JSON body.
+
+    Responses are served from the response cache while fresh (see CACHE_TTLS).
+    Network calls are charged to `user_id`'s rate limit bucket and admitted by
+    `priority` (ENDPOINT_PRIORITY by default). Raises QuotaExceeded when the
+    quota budget is too low for that priority, RapidAPIError on a non-200
+    response (CircuitOpen while the endpoint's breaker is open) and
+    asyncio.TimeoutError when the request exceeds RAPIDAPI_TIMEOUT, in each
+    case only once the retries are spent and no expired cached response is
+    left to fall back on.
+
+    While an identical call (same endpoint and normalized params) is in
+    flight, this one waits for it and gets the same result or exception; the
+    shared call is charged to the user and priority of whoever made it first.
+    When every caller waiting for a call is cancelled, the call is aborted."""
+    params = _clean_params(params)
+    ttl = CACHE_TTLS.get(endpoint)
+    key = cache.make_key(endpoint, params)
+    if ttl:
+        cached = await _response_cache().get(key)
+        metrics.upstream_cache.inc(endpoint=endpoint, result="miss" if cached is None else "hit")
+        if cached is not None:
+            return cached
+
+    task = _in_flight.get(key)
+    if task is not None:
+        metrics.upstream_coalesced.inc(endpoint=endpoint)
+    else:
+        task = _in_flight[key] = asyncio.create_task(_fetch(endpoint, params, key, ttl, user_id, priority))
+        task.add_done_callback(lambda done: _settle(key, done))
+    # Shielded, so a caller going away does not cancel the call for the others
+    _waiters[task] = _waiters.get(task, 0) + 1
+    try:
+        return await asyncio.shield(task)
+    finally:
+        _waiters[task] -= 1
+        if not _waiters[task]:
+            del _waiters[task]
+            if not task.done():
+                # Nobody is left to read the answer; stop waiting for it. It
+                # leaves _in_flight now, so no new caller joins a cancelled call
+                if _in_flight.get(key) is task:
+                    del _in_flight[key]
+                task.cancel()
+                metrics.upstream_cancelled.inc(endpoint=endpoint)
+
+
+def _settle(key, task):
+    if _in_flight.get(key) is task:
+        del _in_flight[key]
+    if not task.cancelled():
+        # Mark the exception retrieved even if every caller was cancelled meanwhile
+        task.exception()
+
+
+async def _fetch(endpoint, params, key, ttl, user_id, priority):
+    if priority is None:
+        priority = ENDPOINT_PRIORITY.get(endpoint, NORMAL)
+    try:
+        result = await _attempt(endpoint, params, user_id, priority)
+    except (RapidAPIError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+        stale = await _response_cache().get(key, stale=True) if ttl else None
+        if stale is None:
+            raise
+        metrics.upstream_cache.inc(endpoint=endpoint, result="stale")
+        logger.warning(f"[{endpoint} failed, serving expired cache] {e}")
+        return stale
+
+    if ttl:
+        await _response_cache().set(key, result, ttl)
+    return result
+
+
+async def _attempt(endpoint, params, user_id, priority):
+    """Call the endpoint through its breaker, retrying transient failures."""
+    circuit = _breaker(endpoint)
+    for attempt in range(RAPIDAPI_RETRIES + 1):
+        if not circuit.allow():
+            raise CircuitOpen(endpoint)
+        try:
+            result = await _hedged(endpoint, params, user_id, priority)
+        except CircuitOpen:
+            raise
+        except RapidAPIError as e:
+            if e.status != 429 and e.status < 500:
+                # The endpoint is up; the request itself is wrong
+                circuit.record_success()
+                raise
+            if e.status != 429:
+                circuit.record_failure()
+            error = e
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            circuit.record_failure()
+            error = e
+        else:
+            circuit.record_success()
+            return result
+
+        if attempt == RAPIDAPI_RETRIES:
+            raise error
+        metrics.upstream_retries.inc(endpoint=endpoint)
+        # Full jitter keeps retries of many callers from arriving together
+        await asyncio.sleep(random.uniform(0, RAPIDAPI_RETRY_BACKOFF * 2 ** attempt))
+
+
+async def _hedged(endpoint, params, user_id, priority):
+    """One request, plus a duplicate if it outlasts the endpoint's p95.
+
+    Optional calls are never hedged, nor is any call while the limiter has
+    no slot to spare right away."""
+    try:
+        await limiter.acquire(user_id, priority)
+    except QuotaExceeded:
+        metrics.upstream_limited.inc(endpoint=endpoint)
+        raise
+
+    delay = latencies[endpoint].quantile(RAPIDAPI_HEDGE_QUANTILE)
+    if delay is None or priority == OPTIONAL:
+        return await _request(endpoint, params)
+
+    primary = asyncio.create_task(_request(endpoint, params))
+    hedge = None
+    try:
+        done, _ = await asyncio.wait([primary], timeout=delay)
+        if done or not limiter.try_acquire(priority):
+            return await primary
+        hedge = asyncio.create_task(_request(endpoint, params))
+        pending = {primary, hedge}
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    metrics.upstream_hedged.inc(endpoint=endpoint, winner="hedge" if task is hedge else "primary")
+                    return task.result()
+        # Both failed; report the original request's error
+        raise primary.exception()
+    finally:
+        primary.cancel()
+        if hedge is not None:
+            hedge.cancel()
+
+
+async def _request(endpoint, params):
+    session = _client()
+    async with _semaphore:
+        # The circuit may have opened while this call queued for a slot
+        if not available(endpoint):
+            metrics.breaker_rejected.inc(endpoint=endpoint)
+            raise CircuitOpen(endpoint)
+        with metrics.upstream_duration.time(endpoint=endpoint) as timer:
+            started = time.perf_counter()
+            async with session.get(BASE_URL + endpoint, params=params) as response:
+                timer.labels["status"] = response.status
+                logger.debug(
+                    "%s answered %d", endpoint, response.status,
+                    extra={"endpoint": endpoint, "status": response.status,
+                           "latency_ms": round((time.perf_counter() - started) * 1000, 1)}
+                )
+                if response.status == 429:
+                    limiter.penalize(_retry_after(response))
+                if response.status != 200:
+                    raise RapidAPIError(response.status, await response.text())
+                result = await response.json(content_type=None)
+    latencies[endpoint].observe(time.perf_counter() - started)
+    return result
+
+
+async def iter_many(endpoint, params_list, user_id=None, priority=None):
+    """Fan out one call per params dict concurrently and yield (index, result)
+    pairs in completion order, so callers can act on the fastest responses
+    first.
+
+    Failed calls are yielded as exception instances instead of raising, so one
+    slow or broken hotel does not discard the others. Calls still pending when
+    the consumer stops iterating are cancelled."""
+    async def call(index, params):
+        try:
+            return index, await get(endpoint, params, user_id, priority)
+        except Exception as e:
+            return index, e
+
+    tasks = [asyncio.create_task(call(i, params)) for i, params in enumerate(params_list)]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            yield await next_done
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+async def close():
+    global _session, _cache
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
+    if _cache is not None:
+        await _cache.close()
+    _cache = None
+    limiter.close()
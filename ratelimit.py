@@ -0,0 +1,213 @@
+"""Outbound rate limiting and quota budgeting for RapidAPI calls.
+
+Every upstream call takes a token from a global bucket and from the calling
+user's own bucket, so one user's search cannot starve everybody else. A
+daily/monthly quota budget sits in front of both: when it runs low, calls are
+admitted by priority, and optional enrichment is the first thing dropped."""
+import asyncio
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+from config import (
+    RAPIDAPI_RATE, RAPIDAPI_BURST, RAPIDAPI_USER_RATE, RAPIDAPI_USER_BURST,
+    RAPIDAPI_DAILY_QUOTA, RAPIDAPI_MONTHLY_QUOTA, RAPIDAPI_QUOTA_STATE
+)
+
+logger = logging.getLogger(__name__)
+
+# Priorities, most important first
+CRITICAL = 0   # destination lookup, hotel search, reservation link
+NORMAL = 1     # gallery photos, nearby cities
+OPTIONAL = 2   # per-hotel price enrichment
+
+# Share of the budget that must remain for a priority to still be admitted
+RESERVED_SHARE = {
+    CRITICAL: 0.0,
+    NORMAL: 0.10,
+    OPTIONAL: 0.25,
+}
+
+
+class QuotaExceeded(Exception):
+    def __init__(self, priority):
+        super().__init__(f"RapidAPI quota budget too low for priority {priority}")
+        self.priority = priority
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self, tokens=1):
+        self._refill()
+        if self.tokens >= tokens:
+            self.tokens -= tokens
+            return True
+        return False
+
+    async def acquire(self, tokens=1):
+        while not self.try_acquire(tokens):
+            await asyncio.sleep((tokens - self.tokens) / self.rate)
+
+    def drain(self, seconds):
+        """Empty the bucket so that no token is available for `seconds`."""
+        self._refill()
+        self.tokens = min(self.tokens, -seconds * self.rate)
+
+    @property
+    def idle(self):
+        self._refill()
+        return self.tokens >= self.capacity
+
+
+class KeyedBuckets:
+    """TokenBuckets made on demand, one per key (a user, a chat), keeping at
+    most `max_keys` of them."""
+
+    def __init__(self, rate, capacity, max_keys=10000):
+        self.rate = rate
+        self.capacity = capacity
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def get(self, key):
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(self.rate, self.capacity)
+            # Full buckets carry no state, so the least recently used can be dropped
+            while len(self._buckets) > self.max_keys:
+                oldest_key, oldest = next(iter(self._buckets.items()))
+                if not oldest.idle:
+                    break
+                del self._buckets[oldest_key]
+        self._buckets.move_to_end(key)
+        return bucket
+
+
+class QuotaBudget:
+    """Counts upstream calls per UTC day and month against configured limits
+    (0 means unlimited) and persists the counts across restarts."""
+
+    def __init__(self, daily=RAPIDAPI_DAILY_QUOTA, monthly=RAPIDAPI_MONTHLY_QUOTA, path=RAPIDAPI_QUOTA_STATE):
+        self.daily = daily
+        self.monthly = monthly
+        self.path = path
+        self.day, self.month = self._periods()
+        self.used_today = 0
+        self.used_this_month = 0
+        self.saved_at = time.monotonic()
+        self._load()
+
+    @staticmethod
+    def _periods():
+        now = datetime.now(timezone.utc)
+        return now.strftime("%Y-%m-%d"), now.strftime("%Y-%m")
+
+    def _roll(self):
+        day, month = self._periods()
+        if day != self.day:
+            self.day, self.used_today = day, 0
+        if month != self.month:
+            self.month, self.used_this_month = month, 0
+
+    def _load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, encoding="utf-8") as state_file:
+                state = json.load(state_file)
+        except (OSError, ValueError) as e:
+            logger.warning(f"[Quota state unreadable] {e}")
+            return
+        if state.get("day") == self.day:
+            self.used_today = state.get("used_today", 0)
+        if state.get("month") == self.month:
+            self.used_this_month = state.get("used_this_month", 0)
+
+    def save(self):
+        self.saved_at = time.monotonic()
+        if not self.path:
+            return
+        with open(self.path, "w", encoding="utf-8") as state_file:
+            json.dump({
+                "day": self.day,
+                "month": self.month,
+                "used_today": self.used_today,
+                "used_this_month": self.used_this_month,
+            }, state_file)
+
+    def remaining_share(self):
+        """Fraction of the tighter of the two budgets still unused (1.0 when unlimited)."""
+        self._roll()
+        shares = [1.0]
+        if self.daily:
+            shares.append(max(0.0, 1 - self.used_today / self.daily))
+        if self.monthly:
+            shares.append(max(0.0, 1 - self.used_this_month / self.monthly))
+        return min(shares)
+
+    def allows(self, priority):
+        share = self.remaining_share()
+        return share > 0 and share > RESERVED_SHARE[priority]
+
+    def spend(self):
+        self._roll()
+        self.used_today += 1
+        self.used_this_month += 1
+
+
+class RateLimiter:
+    def __init__(self, rate=RAPIDAPI_RATE, burst=RAPIDAPI_BURST,
+                 user_rate=RAPIDAPI_USER_RATE, user_burst=RAPIDAPI_USER_BURST,
+                 budget=None, max_users=10000):
+        self.global_bucket = TokenBucket(rate, burst)
+        self.user_buckets = KeyedBuckets(user_rate, user_burst, max_users)
+        self.budget = budget if budget is not None else QuotaBudget()
+
+    def allows(self, priority):
+        return self.budget.allows(priority)
+
+    async def acquire(self, user_id=None, priority=CRITICAL):
+        """Wait for a slot for one upstream call; raises QuotaExceeded when the
+        quota budget is too low for `priority`."""
+        if not self.budget.allows(priority):
+            raise QuotaExceeded(priority)
+        if user_id is not None:
+            await self.user_buckets.get(user_id).acquire()
+        await self.global_bucket.acquire()
+        self.budget.spend()
+        if time.monotonic() - self.budget.saved_at > 60:
+            self.budget.saved_at = time.monotonic()
+            asyncio.get_running_loop().run_in_executor(None, self.close)
+
+    def try_acquire(self, priority=CRITICAL):
+        """Take a global slot only if one is free right now (no waiting), e.g.
+        for a hedged duplicate of a slow call."""
+        if not self.budget.allows(priority) or not self.global_bucket.try_acquire():
+            return False
+        self.budget.spend()
+        return True
+
+    def penalize(self, seconds):
+        """Stop all calls for `seconds`, e.g. after the upstream answered 429."""
+        self.global_bucket.drain(seconds)
+
+    def close(self):
+        try:
+            self.budget.save()
+        except OSError as e:
+            logger.warning(f"[Quota state not saved] {e}")
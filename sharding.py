@@ -0,0 +1,348 @@
+"""Sharded runtime: one front process receives updates and N worker processes
+handle them.
+
+The front process only long-polls getUpdates (or serves the webhook) and
+forwards each raw update to worker `crc32(user_id) % N` over a
+multiprocessing queue, so every update of a user lands in the same worker and
+that worker's session cache stays authoritative. A worker runs the usual
+Dispatcher and processes updates of different users concurrently but the
+updates of one user in arrival order: each waits for the one before to finish
+or to hand its long work (a listing) to a usertasks task, so Stop Session or
+Start Over can still cancel it.
+
+The front process restarts workers that exit unexpectedly (with backoff if
+they keep crashing). Upstream rate limits and quotas are split evenly between
+the workers. Everything runs on one box; no broker is needed."""
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import signal
+import time
+import zlib
+from collections import deque
+from aiohttp import web
+from aiogram.methods import GetUpdates
+from aiogram.types import Update
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler
+import db
+import usertasks
+import webhook
+from config import (
+    RAPIDAPI_RATE, RAPIDAPI_BURST, RAPIDAPI_USER_RATE, RAPIDAPI_USER_BURST, RAPIDAPI_DAILY_QUOTA,
+    RAPIDAPI_MONTHLY_QUOTA, RAPIDAPI_QUOTA_STATE, RAPIDAPI_CONCURRENCY, METRICS_PORT, SHARD_MAX_IN_FLIGHT,
+    WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_SECRET, LOG_PATH, DESTINATION_INDEX_PATH,
+    SEARCH_CONCURRENCY, SEARCH_QUEUE_MAX, TELEGRAM_RATE, TELEGRAM_BURST
+)
+
+logger = logging.getLogger(__name__)
+
+# spawn, not fork: the parent may already hold an event loop and open sockets
+_context = multiprocessing.get_context("spawn")
+
+MAX_RESTART_DELAY = 30
+
+
+def user_id_of(update):
+    """The user an update (as a raw dict) belongs to, 0 if it has none."""
+    for field, payload in update.items():
+        if isinstance(payload, dict):
+            user = payload.get("from") or payload.get("user") or {}
+            if "id" in user:
+                return user["id"]
+            chat = payload.get("chat") or (payload.get("message") or {}).get("chat") or {}
+            if "id" in chat:
+                return chat["id"]
+    return 0
+
+
+def shard_of(user_id, shards):
+    return zlib.crc32(str(user_id).encode()) % shards
+
+
+def _worker_environment(index, shards):
+    """Config overrides of one worker: its share of the limits and its own
+    metrics port, log, quota and destination index files."""
+    quota_base, quota_ext = os.path.splitext(RAPIDAPI_QUOTA_STATE)
+    log_base, log_ext = os.path.splitext(LOG_PATH)
+    index_base, index_ext = os.path.splitext(DESTINATION_INDEX_PATH)
+    return {
+        "SHARD_INDEX": str(index),
+        "RAPIDAPI_RATE": str(RAPIDAPI_RATE / shards),
+        "RAPIDAPI_BURST": str(max(1, RAPIDAPI_BURST // shards)),
+        # Users are pinned to one worker, so their own bucket stays whole
+        "RAPIDAPI_USER_RATE": str(RAPIDAPI_USER_RATE),
+        "RAPIDAPI_USER_BURST": str(RAPIDAPI_USER_BURST),
+        "RAPIDAPI_CONCURRENCY": str(max(1, RAPIDAPI_CONCURRENCY // shards)),
+        "SEARCH_CONCURRENCY": str(max(1, SEARCH_CONCURRENCY // shards)),
+        "SEARCH_QUEUE_MAX": str(max(1, SEARCH_QUEUE_MAX // shards)),
+        # Telegram's global flood limit is per bot, so the workers share it;
+        # a chat belongs to one worker and keeps its whole bucket
+        "TELEGRAM_RATE": str(TELEGRAM_RATE / shards),
+        "TELEGRAM_BURST": str(max(1, TELEGRAM_BURST // shards)),
+        "RAPIDAPI_DAILY_QUOTA": str(RAPIDAPI_DAILY_QUOTA // shards),
+        "RAPIDAPI_MONTHLY_QUOTA": str(RAPIDAPI_MONTHLY_QUOTA // shards),
+        "RAPIDAPI_QUOTA_STATE": f"{quota_base}.{index}{quota_ext}" if RAPIDAPI_QUOTA_STATE else "",
+        "METRICS_PORT": str(METRICS_PORT + 1 + index) if METRICS_PORT else "0",
+        # One writer per file: RotatingFileHandler cannot be shared between processes
+        "LOG_PATH": f"{log_base}.{index}{log_ext}",
+        "DESTINATION_INDEX_PATH": f"{index_base}.{index}{index_ext}" if DESTINATION_INDEX_PATH else "",
+    }
+
+
+class _UserQueue:
+    """Runs coroutines concurrently across users but one at a time per user,
+    in submission order. One that hands its long work to a usertasks task
+    (a listing, a gallery) lets the user's next one start, so that one can
+    cancel it."""
+
+    def __init__(self):
+        # user_id -> set once the last coroutine submitted lets the next start
+        self._turns = {}
+        self._tasks = set()
+
+    def submit(self, user_id, coroutine):
+        previous = self._turns.get(user_id)
+        turn = self._turns[user_id] = asyncio.Event()
+        task = asyncio.create_task(self._after(previous, turn, coroutine))
+        self._tasks.add(task)
+        task.add_done_callback(lambda done: self._forget(user_id, turn, done))
+        return task
+
+    @staticmethod
+    async def _after(previous, turn, coroutine):
+        try:
+            if previous is not None:
+                await previous.wait()
+            usertasks.handed_off.set(turn.set)
+            return await coroutine
+        finally:
+            turn.set()
+
+    def _forget(self, user_id, turn, task):
+        self._tasks.discard(task)
+        if self._turns.get(user_id) is turn:
+            del self._turns[user_id]
+
+    async def drain(self):
+        while self._tasks:
+            await asyncio.wait(list(self._tasks))
+
+
+async def _serve(queue, received, create_dispatcher):
+    dp, bot = create_dispatcher()
+    loop = asyncio.get_running_loop()
+    users = _UserQueue()
+    in_flight = asyncio.Semaphore(SHARD_MAX_IN_FLIGHT)
+
+    async def handle(update):
+        try:
+            await dp.feed_update(bot, update)
+        except Exception as e:
+            logger.exception(f"[Update failed] {e}")
+        finally:
+            in_flight.release()
+
+    await dp.emit_startup(bot=bot, dispatcher=dp)
+    try:
+        while True:
+            await in_flight.acquire()
+            item = await loop.run_in_executor(None, queue.get)
+            if item is None:
+                in_flight.release()
+                break
+            received.value, raw = item
+            update = Update.model_validate_json(raw, context={"bot": bot})
+            users.submit(user_id_of(json.loads(raw)), handle(update))
+        await users.drain()
+    finally:
+        await dp.emit_shutdown(bot=bot, dispatcher=dp)
+        await bot.session.close()
+
+
+def _worker_main(index, queue, received, create_dispatcher):
+    # Ctrl+C reaches the whole process group; the front process stops workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    logger.info(f"Shard worker {index} started (pid {os.getpid()})")
+    asyncio.run(_serve(queue, received, create_dispatcher))
+
+
+class _Worker:
+    def __init__(self, index, shards, create_dispatcher):
+        self.index = index
+        self.shards = shards
+        self.create_dispatcher = create_dispatcher
+        self.queue = None
+        self.process = None
+        self.restarts = 0
+        self.started_at = 0.0
+        # Sequence number of the last update the worker took off its queue
+        self.received = _context.RawValue("q", 0)
+        self._sent = 0
+        # (sequence number, update) sent but maybe not yet taken
+        self._pending = deque()
+
+    def _prune(self):
+        received = self.received.value
+        while self._pending and self._pending[0][0] <= received:
+            self._pending.popleft()
+
+    def send(self, raw):
+        self._sent += 1
+        self._pending.append((self._sent, raw))
+        self._prune()
+        self.queue.put((self._sent, raw))
+
+    def start(self):
+        # A process killed inside queue.get() dies holding the queue's reader
+        # lock, so every process gets a fresh queue. Updates its predecessor
+        # never took are sent again; one it took but did not finish is lost
+        if self.queue is not None:
+            self.queue.cancel_join_thread()
+            self.queue.close()
+        self.queue = _context.Queue()
+        self._prune()
+        for item in self._pending:
+            self.queue.put(item)
+        # Children read their config from the environment at import time
+        overrides = _worker_environment(self.index, self.shards)
+        saved = {key: os.environ.get(key) for key in overrides}
+        os.environ.update(overrides)
+        try:
+            self.process = _context.Process(
+                target=_worker_main, args=(self.index, self.queue, self.received, self.create_dispatcher),
+                name=f"shard-{self.index}", daemon=False
+            )
+            self.process.start()
+        finally:
+            for key, value in saved.items():
+                if value is None:
+                    os.environ.pop(key, None)
+                else:
+                    os.environ[key] = value
+        self.started_at = time.monotonic()
+
+    def restart_delay(self):
+        # A worker that ran for a while restarts at once; a crash loop backs off
+        if time.monotonic() - self.started_at > MAX_RESTART_DELAY:
+            self.restarts = 0
+        return min(MAX_RESTART_DELAY, 2 ** self.restarts - 1)
+
+
+class ShardedRuntime:
+    def __init__(self, shards, create_dispatcher):
+        self.workers = [_Worker(i, shards, create_dispatcher) for i in range(shards)]
+        self.stopping = False
+        self.stopped = False
+
+    def dispatch(self, update):
+        """Forward one raw update (dict) to the worker owning its user."""
+        worker = self.workers[shard_of(user_id_of(update), len(self.workers))]
+        worker.send(json.dumps(update))
+
+    async def supervise(self):
+        while not self.stopping:
+            await asyncio.sleep(1)
+            for worker in self.workers:
+                if self.stopping or worker.process.is_alive():
+                    continue
+                delay = worker.restart_delay()
+                logger.error(
+                    f"Shard worker {worker.index} exited with code {worker.process.exitcode}; "
+                    f"restarting in {delay}s"
+                )
+                await asyncio.sleep(delay)
+                worker.restarts += 1
+                if not self.stopping:
+                    worker.start()
+
+    def start(self):
+        for worker in self.workers:
+            worker.start()
+
+    def stop(self, timeout=30):
+        """Let each worker finish what it has queued, then shut it down."""
+        if self.stopped:
+            return
+        self.stopping = self.stopped = True
+        for worker in self.workers:
+            worker.queue.put(None)
+        deadline = time.monotonic() + timeout
+        for worker in self.workers:
+            worker.process.join(max(0.0, deadline - time.monotonic()))
+            if worker.process.is_alive():
+                logger.warning(f"Shard worker {worker.index} did not stop in time; terminating")
+                worker.process.terminate()
+
+
+async def _poll(runtime, dp, bot):
+    await webhook.delete_for_polling(bot)
+    allowed_updates = dp.resolve_used_update_types()
+    offset = None
+    while True:
+        try:
+            updates = await bot(GetUpdates(offset=offset, timeout=30, allowed_updates=allowed_updates))
+        except Exception as e:
+            logger.error(f"[getUpdates failed] {e}")
+            await asyncio.sleep(1)
+            continue
+        for update in updates:
+            offset = update.update_id + 1
+            runtime.dispatch(update.model_dump(mode="json", exclude_unset=True, by_alias=True))
+
+
+class _ForwardingRequestHandler(SimpleRequestHandler):
+    """Hands each verified webhook update to the worker owning its user."""
+
+    def __init__(self, runtime, dp, bot):
+        super().__init__(dp, bot, handle_in_background=True, secret_token=WEBHOOK_SECRET)
+        self.runtime = runtime
+
+    async def _handle_request_background(self, bot, request):
+        self.runtime.dispatch(await request.json())
+        return web.json_response({})
+
+
+async def _serve_webhook(runtime, dp, bot):
+    app = webhook.create_app(dp, bot, _ForwardingRequestHandler(runtime, dp, bot))
+    runner = web.AppRunner(app, access_log=None)
+    # Runs dp's startup, which sets the webhook
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
+async def _front(runtime, dp, bot, mode):
+    runtime.start()
+    supervisor = asyncio.create_task(runtime.supervise())
+    receiver = _serve_webhook if mode == "webhook" else _poll
+    loop = asyncio.get_running_loop()
+    stopped = asyncio.Event()
+    loop.add_signal_handler(signal.SIGTERM, stopped.set)
+    receiving = asyncio.create_task(receiver(runtime, dp, bot))
+    try:
+        await asyncio.wait([receiving, asyncio.create_task(stopped.wait())], return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        receiving.cancel()
+        supervisor.cancel()
+        await loop.run_in_executor(None, runtime.stop)
+        await bot.session.close()
+    if receiving.done() and not receiving.cancelled() and receiving.exception():
+        raise receiving.exception()
+
+
+def run(dp, bot, shards, create_dispatcher, mode="polling"):
+    """Run the front process with `shards` workers. `dp` only tells the front
+    which update types to ask for. `create_dispatcher` must be a module-level
+    function returning a ready (dispatcher, bot) pair; each worker calls it
+    once."""
+    if mode == "webhook":
+        webhook.check_config()
+    db.prepare()
+    runtime = ShardedRuntime(shards, create_dispatcher)
+    logger.info(f"Starting {shards} shard workers ({mode} front)")
+    asyncio.run(_front(runtime, dp, bot, mode))
@@ -0,0 +1,28 @@
+import pytest
+
+import db
+from load_bench import LoadBench
+
+
+@pytest.fixture
+def make_bench():
+    """Makes a LoadBench with instant Telegram, no rate limits and a fast,
+    steady mock API; keyword arguments override any of those."""
+    def make(**options):
+        options = {
+            "users": 2, "telegram_latency": 0, "rate_limit": False,
+            "latency": 0.01, "jitter": 0, "hotels": 12, **options,
+        }
+        return LoadBench(**options)
+
+    return make
+
+
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+    """A fresh users.db in a temporary directory, with an empty session cache."""
+    monkeypatch.setattr(db, "DB_PATH", str(tmp_path / "users.db"))
+    monkeypatch.setattr(db, "_cache", db.SessionCache())
+    db._executor.submit(db._init_db).result()
+    yield db._cache
+    db._executor.submit(db._close_db).result()
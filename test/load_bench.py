@@ -0,0 +1,385 @@
+"""End-to-end load benchmark for the hotel booking flow.
+
+Starts the mock booking-com15 server in-process, then drives N simulated users
+concurrently through the `router` in hotel_app/handlers.py by feeding
+synthetic Telegram updates to a Dispatcher. Telegram itself is replaced by
+an in-memory session that records what the bot sends.
+
+    python test/load_bench.py --users 50 --api-latency 0.3
+
+Reports p50/p95/p99 latency per conversation step and overall throughput."""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import sys
+import tempfile
+import time
+import webbrowser
+from collections import defaultdict
+from aiohttp import web
+from aiogram import Bot, Dispatcher
+from aiogram.client.session.base import BaseSession
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+from aiogram.types import Message, Update
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import admission
+import db
+import destinations
+import fsm_storage
+import outbox
+import rapidapi
+import ratelimit
+import usertasks
+from hotel_app import keyboards, results
+from hotel_app.handlers import router
+from mock_rapidapi import MockRapidAPI
+
+ERROR_MARKERS = ("Error", "error", "failed", "Failed")
+
+
+class FakeTelegramSession(BaseSession):
+    """Answers Bot API calls locally after `latency` seconds and keeps the
+    messages sent to each chat. With `flood_every`, every n-th send is refused
+    with RetryAfter first, like Telegram's flood control does."""
+
+    def __init__(self, latency=0.05, flood_every=0):
+        super().__init__()
+        self.latency = latency
+        self.flood_every = flood_every
+        self.calls = defaultdict(int)
+        self.sent = defaultdict(list)
+        self._message_ids = itertools.count(1)
+
+    def _message(self, method, **extra):
+        chat_id = getattr(method, "chat_id", None) or 0
+        message = {
+            "message_id": getattr(method, "message_id", None) or next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": 1, "is_bot": True, "first_name": "Bot"},
+            **extra
+        }
+        for field in ("text", "caption"):
+            if getattr(method, field, None) is not None:
+                message[field] = getattr(method, field)
+        markup = getattr(method, "reply_markup", None)
+        if markup is not None and hasattr(markup, "inline_keyboard"):
+            message["reply_markup"] = markup.model_dump(exclude_none=True)
+        self.sent[chat_id].append(method)
+        return message
+
+    async def make_request(self, bot, method, timeout=None):
+        name = type(method).__name__
+        self.calls[name] += 1
+        await asyncio.sleep(self.latency)
+        if self.flood_every and name.startswith("Send") and sum(self.calls.values()) % self.flood_every == 0:
+            self.calls["RetryAfter"] += 1
+            raise TelegramRetryAfter(method=method, message="Too Many Requests", retry_after=0)
+
+        if name == "SendMediaGroup":
+            if not 2 <= len(method.media) <= 10:
+                raise TelegramBadRequest(method=method, message="Bad Request: wrong number of media")
+            return [
+                Message.model_validate(self._message(method, photo=self._photo()), context={"bot": bot})
+                for _ in method.media
+            ]
+        if name.startswith(("Send", "Edit")):
+            extra = {"photo": self._photo()} if name in ("SendPhoto", "EditMessageCaption") else {}
+            return Message.model_validate(self._message(method, **extra), context={"bot": bot})
+        return True
+
+    def _photo(self):
+        file_id = f"file-{next(self._message_ids)}"
+        return [{"file_id": file_id, "file_unique_id": file_id, "width": 1, "height": 1}]
+
+    async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+        yield b""
+
+    async def close(self):
+        pass
+
+    def last_keyboard(self, chat_id):
+        """Button texts of the latest reply keyboard sent to the chat."""
+        for method in reversed(self.sent[chat_id]):
+            markup = getattr(method, "reply_markup", None)
+            if markup is not None and hasattr(markup, "keyboard"):
+                return [button.text for row in markup.keyboard for button in row]
+        return []
+
+    def callbacks(self, chat_id, prefix):
+        found = []
+        for method in self.sent[chat_id]:
+            markup = getattr(method, "reply_markup", None)
+            for row in getattr(markup, "inline_keyboard", None) or []:
+                found += [b.callback_data for b in row if (b.callback_data or "").startswith(prefix)]
+        return found
+
+    def error_replies(self, chat_id):
+        return [
+            text for text in (getattr(m, "text", None) or getattr(m, "caption", None) for m in self.sent[chat_id])
+            if text and any(marker in text for marker in ERROR_MARKERS)
+        ]
+
+
+class SimulatedUser:
+    _update_ids = itertools.count(1)
+
+    def __init__(self, bench, user_id, destination):
+        self.bench = bench
+        self.user_id = user_id
+        self.destination = destination
+        self._message_ids = itertools.count(1)
+
+    def _user(self):
+        return {"id": self.user_id, "is_bot": False, "first_name": f"user{self.user_id}"}
+
+    def _message(self, text):
+        return {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": self.user_id, "type": "private"},
+            "from": self._user(),
+            "text": text
+        }
+
+    async def _feed(self, step, payload):
+        update = Update.model_validate({"update_id": next(self._update_ids), **payload}, context={"bot": self.bench.bot})
+        started = time.perf_counter()
+        try:
+            await self.bench.dp.feed_update(self.bench.bot, update)
+        except Exception as e:
+            self.bench.errors[step] += 1
+            self.bench.exceptions.append(f"{step}: {e!r}")
+        self.bench.latencies[step].append(time.perf_counter() - started)
+
+    async def send(self, step, text):
+        await self._feed(step, {"message": self._message(text)})
+
+    async def press(self, step, data):
+        await self._feed(step, {"callback_query": {
+            "id": str(next(self._update_ids)),
+            "from": self._user(),
+            "chat_instance": str(self.user_id),
+            "message": self._message("card"),
+            "data": data
+        }})
+
+    async def run(self, gallery=True, reserve=True, refine=False, stop_after=None, stop_with="Stop Session"):
+        telegram = self.bench.telegram
+        await self.send("start", "/start")
+        await self.send("continue", "Continue")
+        await self.send("destination", self.destination)
+        labels = [label for label in telegram.last_keyboard(self.user_id) if label != "Not listed"]
+        if not labels:
+            self.bench.errors["destination"] += 1
+            return
+        await self.send("location", labels[0])
+        await self.send("checkin", "01/08/2026")
+        await self.send("checkout", "05/08/2026")
+        await self.send("adults", "2")
+        await self.send("children", "No")
+        if stop_after is not None:
+            # Walk away while the results are still arriving
+            search = asyncio.create_task(self.send("search", "One(1)"))
+            await asyncio.sleep(stop_after)
+            await self.send("stop", stop_with)
+            await search
+            if stop_with == keyboards.START_OVER:
+                await self.send("destination", self.destination)
+            return
+        await self.send("search", "One(1)")
+
+        if refine:
+            await self.send("price_limit", "Set Price Limit")
+            await self.send("refine", "100")
+            await self.send("sort", "Sort Results")
+            await self.send("resort", "Best Rating")
+            await self.send("show_more", "Show More")
+
+        more_info = telegram.callbacks(self.user_id, "moreinfo_")
+        if gallery and more_info:
+            await self.press("more_info", more_info[0])
+        if reserve:
+            await self.send("reserve", "Reserve Room")
+            hotels = telegram.last_keyboard(self.user_id)
+            if hotels:
+                await self.send("reservation_link", hotels[0])
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, max(0, round(fraction * len(ordered) + 0.5) - 1))
+    return ordered[index]
+
+
+class LoadBench:
+    def __init__(self, users=10, telegram_latency=0.05, destinations=None, rate_limit=True, flood_every=0,
+                 search_slots=None, **mock_options):
+        self.users = users
+        self.rate_limit = rate_limit
+        self.search_slots = search_slots
+        self.destinations = destinations or ["Paris, France", "Rome, Mockland", "Oslo, Mockland"]
+        self.mock = MockRapidAPI(**mock_options)
+        self.telegram = FakeTelegramSession(telegram_latency, flood_every)
+        self.bot = Bot(token="123456:BENCH", session=self.telegram)
+        # Sends go through the same queue as in production, Telegram's limits included
+        self.outbox = outbox.SendQueue() if rate_limit else outbox.SendQueue(1e6, 1e6, 1e6, 1e6)
+        self.telegram.middleware(self.outbox)
+        self.dp = Dispatcher(storage=fsm_storage.SessionStorage())
+        self.dp.include_router(router)
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.exceptions = []
+        self.elapsed = 0.0
+
+    async def run(self, gallery=True, reserve=True, refine=False, stop_after=None, stop_with="Stop Session"):
+        runner = web.AppRunner(self.mock.app())
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+
+        workdir = tempfile.mkdtemp(prefix="bench-")
+        original = (
+            rapidapi.BASE_URL, rapidapi.limiter, destinations.index, results.store, db.DB_PATH, db._cache,
+            admission.controller, webbrowser.open_new_tab
+        )
+        rapidapi.BASE_URL = f"http://127.0.0.1:{port}/api/v1/hotels/"
+        # A fresh limiter per run, with a budget that is never written to disk
+        budget = ratelimit.QuotaBudget(path=None)
+        if self.rate_limit:
+            rapidapi.limiter = ratelimit.RateLimiter(budget=budget)
+        else:
+            unlimited = float("inf")
+            rapidapi.limiter = ratelimit.RateLimiter(unlimited, unlimited, unlimited, unlimited, budget=budget)
+        # Breakers and hedging delays learned in an earlier run do not apply
+        rapidapi.breakers.clear()
+        rapidapi.latencies.clear()
+        # Destinations resolve locally once the first user has looked them up
+        destinations.index = destinations.DestinationIndex(path=None)
+        results.store = results.ResultStore()
+        if self.search_slots:
+            admission.controller = admission.AdmissionController(limit=self.search_slots)
+        else:
+            admission.controller = admission.AdmissionController()
+        db.DB_PATH = os.path.join(workdir, "users.db")
+        # Sessions cached by an earlier bench belong to its database, not this one
+        db._cache = db.SessionCache()
+        # The reservation step must not open browsers on the benchmarking machine
+        webbrowser.open_new_tab = lambda url: True
+        try:
+            await db.init_db()
+            users = [
+                SimulatedUser(self, 1000 + i, self.destinations[i % len(self.destinations)])
+                for i in range(self.users)
+            ]
+            started = time.perf_counter()
+            await asyncio.gather(*(user.run(gallery, reserve, refine, stop_after, stop_with) for user in users))
+            self.elapsed = time.perf_counter() - started
+        finally:
+            await usertasks.registry.close()
+            await self.outbox.close()
+            await db.close_db()
+            await rapidapi.close()
+            (
+                rapidapi.BASE_URL, rapidapi.limiter, destinations.index, results.store, db.DB_PATH, db._cache,
+                admission.controller, webbrowser.open_new_tab
+            ) = original
+            # aiogram has no public way to detach a router; free it for the next bench
+            self.dp.sub_routers.remove(router)
+            router._parent_router = None
+            await runner.cleanup()
+        return self.report()
+
+    def report(self):
+        steps = {}
+        for step, values in self.latencies.items():
+            steps[step] = {
+                "count": len(values),
+                "errors": self.errors.get(step, 0),
+                "p50_ms": round(percentile(values, 0.50) * 1000, 1),
+                "p95_ms": round(percentile(values, 0.95) * 1000, 1),
+                "p99_ms": round(percentile(values, 0.99) * 1000, 1),
+            }
+        updates = sum(len(values) for values in self.latencies.values())
+        return {
+            "users": self.users,
+            "elapsed_s": round(self.elapsed, 3),
+            "updates": updates,
+            "throughput_updates_per_s": round(updates / self.elapsed, 2) if self.elapsed else 0.0,
+            "upstream_requests": dict(self.mock.requests),
+            "telegram_calls": dict(self.telegram.calls),
+            "error_replies": sum(len(self.telegram.error_replies(1000 + i)) for i in range(self.users)),
+            "steps": steps,
+        }
+
+
+def format_report(report):
+    lines = [
+        f"users={report['users']} updates={report['updates']} elapsed={report['elapsed_s']}s "
+        f"throughput={report['throughput_updates_per_s']} updates/s error_replies={report['error_replies']}",
+        f"{'step':<18}{'count':>7}{'errors':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}",
+    ]
+    for step, stats in report["steps"].items():
+        lines.append(
+            f"{step:<18}{stats['count']:>7}{stats['errors']:>8}"
+            f"{stats['p50_ms']:>10}{stats['p95_ms']:>10}{stats['p99_ms']:>10}"
+        )
+    lines.append(f"upstream requests: {report['upstream_requests']}")
+    lines.append(f"telegram calls: {report['telegram_calls']}")
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=10, help="concurrent simulated users")
+    parser.add_argument("--api-latency", type=float, default=0.2, help="mock RapidAPI latency in seconds")
+    parser.add_argument("--api-jitter", type=float, default=0.05)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--hotels", type=int, default=20)
+    parser.add_argument("--photos", type=int, default=15)
+    parser.add_argument("--padding", type=int, default=0)
+    parser.add_argument("--telegram-latency", type=float, default=0.05)
+    parser.add_argument("--flood-every", type=int, default=0,
+                        help="refuse every n-th Telegram send with RetryAfter once")
+    parser.add_argument("--no-gallery", action="store_true", help="skip the More Info step")
+    parser.add_argument("--no-reserve", action="store_true", help="skip the reservation steps")
+    parser.add_argument("--search-slots", type=int, default=None,
+                        help="concurrent searches admitted (default SEARCH_CONCURRENCY)")
+    parser.add_argument("--refine", action="store_true", help="also set a price limit and re-sort the results")
+    parser.add_argument("--stop-after", type=float, default=None,
+                        help="stop the session this many seconds into the search instead of going on")
+    parser.add_argument("--no-cache", action="store_true", help="disable the RapidAPI response cache")
+    parser.add_argument("--no-rate-limit", action="store_true", help="disable the RapidAPI rate limiter")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args()
+
+    if args.no_cache:
+        rapidapi.CACHE_TTLS = {}
+
+    bench = LoadBench(
+        users=args.users,
+        telegram_latency=args.telegram_latency,
+        rate_limit=not args.no_rate_limit,
+        flood_every=args.flood_every,
+        search_slots=args.search_slots,
+        latency=args.api_latency,
+        jitter=args.api_jitter,
+        error_rate=args.error_rate,
+        hotels=args.hotels,
+        photos=args.photos,
+        padding=args.padding,
+    )
+    report = asyncio.run(bench.run(gallery=not args.no_gallery, reserve=not args.no_reserve, refine=args.refine,
+                                 stop_after=args.stop_after))
+    print(json.dumps(report, indent=2) if args.json else format_report(report))
+
+
+if __name__ == "__main__":
+    main()
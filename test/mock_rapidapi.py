@@ -0,0 +1,180 @@
+"""Local stand-in for the booking-com15 RapidAPI endpoints used by the handlers.
+
+Run it and point the bot at it:
+
+    python test/mock_rapidapi.py --port 8081 --latency 0.3 --error-rate 0.05
+    RAPIDAPI_BASE_URL=http://127.0.0.1:8081/api/v1/hotels/ python main.py
+
+searchDestination answers for the cities in recorded_destinations.json are
+real responses once logged by the bot; queries that were never recorded get a
+synthetic destination list.
+Every other endpoint returns generated payloads whose size is configurable."""
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import random
+import time
+from aiohttp import web
+
+RECORDED_DESTINATIONS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "recorded_destinations.json")
+
+
+def load_recorded_destinations(path=RECORDED_DESTINATIONS):
+    """Map a lower-cased city name to a recorded searchDestination response."""
+    with open(path, encoding="utf-8") as recorded:
+        return json.load(recorded)
+
+
+class MockRapidAPI:
+    def __init__(self, latency=0.2, jitter=0.1, error_rate=0.0, hotels=20, photos=20,
+                 padding=0, recorded=None, seed=None, pages=None, broken=()):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.broken = set(broken)
+        self.hotels = hotels
+        self.pages = pages
+        self.photos = photos
+        self.padding = "x" * padding
+        self.recorded = load_recorded_destinations() if recorded is None else recorded
+        self.random = random.Random(seed)
+        self.requests = {}
+
+    def app(self):
+        app = web.Application()
+        app.router.add_get("/api/v1/hotels/{endpoint}", self.handle)
+        return app
+
+    async def handle(self, request):
+        endpoint = request.match_info["endpoint"]
+        builder = getattr(self, f"_{endpoint}", None)
+        if builder is None:
+            return web.json_response({"status": False, "message": "Endpoint not found"}, status=404)
+
+        self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+        await asyncio.sleep(max(0.0, self.latency + self.random.uniform(-self.jitter, self.jitter)))
+        if endpoint in self.broken:
+            return web.json_response({"status": False, "message": "Mock outage"}, status=503)
+        if self.random.random() < self.error_rate:
+            status = self.random.choice((429, 500, 503))
+            return web.json_response({"status": False, "message": "Mock failure"}, status=status)
+
+        return web.json_response({
+            "status": True,
+            "message": "Success",
+            "timestamp": int(time.time() * 1000),
+            "data": builder(request.query)
+        })
+
+    def _searchDestination(self, query):
+        city = query.get("query", "").strip()
+        if city.casefold() in self.recorded:
+            return self.recorded[city.casefold()]["data"]
+        return [
+            {
+                "dest_id": str(-1000000 - i),
+                "search_type": search_type,
+                "dest_type": search_type,
+                "name": name,
+                "label": f"{name}, {city}, Mockland",
+                "city_name": city,
+                "country": "Mockland",
+                "region": "Mock Region",
+                "latitude": 40.0 + i * 0.01,
+                "longitude": 10.0 + i * 0.01,
+                "image_url": f"https://cf.bstatic.com/xdata/images/city/150x150/{i}.jpg",
+                "nr_hotels": 100 * (i + 1),
+            }
+            for i, (name, search_type) in enumerate([(city, "city"), (f"{city} Centre", "district")])
+        ]
+
+    def _searchHotels(self, query):
+        page = int(query.get("page_number", "1") or 1)
+        price_max = float(query.get("price_max") or "inf")
+        nights = self._nights(query)
+        hotels = []
+        for i in range(self.hotels if self.pages is None or page <= self.pages else 0):
+            hotel_id = int(query.get("dest_id", "0").lstrip("-") or 0) * 100 + page * 1000 + i
+            price = round(60 + (hotel_id * 37) % 400 + 0.49, 2)
+            if price / nights > price_max:
+                continue
+            hotels.append({
+                "hotel_id": hotel_id,
+                "accessibilityLabel": f"Mock Hotel {hotel_id}. {self.padding}",
+                "property": {
+                    "name": f"Mock Hotel {hotel_id}",
+                    "reviewScore": round(6 + (hotel_id % 40) / 10, 1),
+                    "priceBreakdown": {"grossPrice": {"value": price, "currency": "USD"}},
+                    "photoUrls": [f"https://cf.bstatic.com/xdata/images/hotel/square60/{hotel_id}.jpg"],
+                },
+            })
+        return {"hotels": hotels, "meta": [{"title": f"{len(hotels)} properties"}]}
+
+    @staticmethod
+    def _nights(query):
+        try:
+            arrival = datetime.date.fromisoformat(query.get("arrival_date", ""))
+            departure = datetime.date.fromisoformat(query.get("departure_date", ""))
+        except ValueError:
+            return 1
+        return max(1, (departure - arrival).days)
+
+    def _getHotelDetails(self, query):
+        hotel_id = query.get("hotel_id", "0")
+        return {
+            "hotel_id": hotel_id,
+            "url": f"https://www.booking.com/hotel/mock/{hotel_id}.html",
+            "product_price_breakdown": {
+                "gross_amount_per_night": {"amount_rounded": "$120"},
+                "all_inclusive_amount": {"amount_rounded": "$480"},
+            },
+            "description": self.padding,
+        }
+
+    def _getHotelPhotos(self, query):
+        hotel_id = query.get("hotel_id", "0")
+        return [
+            {"id": i, "url": f"https://cf.bstatic.com/xdata/images/hotel/max1280/{hotel_id}_{i}.jpg"}
+            for i in range(self.photos)
+        ]
+
+    def _getNearbyCities(self, query):
+        latitude = float(query.get("latitude") or 0)
+        longitude = float(query.get("longitude") or 0)
+        return [
+            {
+                "name": f"Nearby Town {i}",
+                "dest_id": str(-2000000 - i),
+                "dest_type": "city",
+                "latitude": latitude + 0.1 * (i + 1),
+                "longitude": longitude - 0.1 * (i + 1),
+                "image_url": "",
+                "country": "Mockland",
+            }
+            for i in range(10)
+        ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency", type=float, default=0.2, help="mean response latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.1, help="uniform latency jitter in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests failing with 429/5xx")
+    parser.add_argument("--hotels", type=int, default=20, help="hotels per searchHotels page")
+    parser.add_argument("--photos", type=int, default=20, help="photos per getHotelPhotos response")
+    parser.add_argument("--padding", type=int, default=0, help="extra bytes per hotel payload")
+    parser.add_argument("--pages", type=int, default=None, help="searchHotels pages with results (default unlimited)")
+    parser.add_argument("--broken", nargs="*", default=(), help="endpoints that always answer 503")
+    args = parser.parse_args()
+
+    mock = MockRapidAPI(args.latency, args.jitter, args.error_rate, args.hotels, args.photos, args.padding,
+                        pages=args.pages, broken=args.broken)
+    web.run_app(mock.app(), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
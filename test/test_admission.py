@@ -0,0 +1,97 @@
+import asyncio
+
+import pytest
+
+import admission
+
+
+def run_searches(controller, users, hold=0.02):
+    """Start one search per entry of `users` (a user_id each) in that order.
+    Returns the users in the order their searches started and every position
+    each one was told."""
+    started = []
+    positions = {index: [] for index in range(len(users))}
+
+    async def search(index, user_id):
+        async def on_position(position):
+            positions[index].append(position)
+
+        async with controller.slot(user_id, on_position):
+            started.append(user_id)
+            await asyncio.sleep(hold)
+
+    async def scenario():
+        tasks = []
+        for index, user_id in enumerate(users):
+            tasks.append(asyncio.create_task(search(index, user_id)))
+            # Queue them in order
+            await asyncio.sleep(0)
+        await asyncio.gather(*tasks)
+
+    asyncio.run(scenario())
+    return started, positions
+
+
+def test_waiting_searches_start_in_arrival_order(monkeypatch):
+    monkeypatch.setattr(admission, "POSITION_UPDATE_INTERVAL", 0)
+    controller = admission.AdmissionController(limit=1, per_user=1, max_queue=10)
+
+    started, positions = run_searches(controller, [1, 2, 3, 4])
+
+    assert started == [1, 2, 3, 4]
+    assert positions[0] == []
+    assert positions[1] == [1]
+    # Told where they stand, then again as they move up
+    assert positions[3] == [3, 2, 1]
+    assert controller.running == 0
+
+
+def test_a_user_at_their_limit_lets_others_go_first():
+    controller = admission.AdmissionController(limit=2, per_user=1, max_queue=10)
+
+    started, _ = run_searches(controller, [1, 1, 2])
+
+    assert started == [1, 2, 1]
+
+
+def test_a_full_queue_refuses_new_searches():
+    controller = admission.AdmissionController(limit=1, per_user=1, max_queue=1)
+
+    async def scenario():
+        async def hold(user_id):
+            async with controller.slot(user_id):
+                await asyncio.sleep(0.05)
+
+        first = asyncio.create_task(hold(1))
+        second = asyncio.create_task(hold(2))
+        await asyncio.sleep(0.01)
+        try:
+            with pytest.raises(admission.QueueFull):
+                async with controller.slot(3):
+                    pass
+        finally:
+            await asyncio.gather(first, second)
+
+    asyncio.run(scenario())
+    assert controller.running == 0
+
+
+def test_a_cancelled_waiter_leaves_the_queue():
+    controller = admission.AdmissionController(limit=1, per_user=1, max_queue=10)
+
+    async def scenario():
+        async def hold(user_id):
+            async with controller.slot(user_id):
+                await asyncio.sleep(0.05)
+
+        first = asyncio.create_task(hold(1))
+        waiting = asyncio.create_task(hold(2))
+        await asyncio.sleep(0.01)
+        waiting.cancel()
+        await asyncio.sleep(0)
+        queued = len(controller._queue)
+        await first
+        return queued
+
+    assert asyncio.run(scenario()) == 0
+    assert controller.running == 0
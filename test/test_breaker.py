@@ -0,0 +1,65 @@
+import pytest
+
+import breaker
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(breaker.time, "monotonic", lambda: now[0])
+    return now
+
+
+def test_opens_after_consecutive_failures_only(clock):
+    circuit = breaker.CircuitBreaker("test", failures=3, reset_after=30)
+
+    circuit.record_failure()
+    circuit.record_failure()
+    circuit.record_success()
+    circuit.record_failure()
+    circuit.record_failure()
+    assert circuit.state == breaker.CLOSED
+    circuit.record_failure()
+    assert circuit.state == breaker.OPEN
+    assert not circuit.allow()
+
+
+def test_lets_one_probe_through_after_the_reset_time(clock):
+    circuit = breaker.CircuitBreaker("test", failures=1, reset_after=30)
+    circuit.record_failure()
+
+    clock[0] += 30
+    assert circuit.state == breaker.HALF_OPEN
+    assert circuit.allow()
+    assert not circuit.allow()
+    # A probe that never reports back does not hold the breaker forever
+    clock[0] += 31
+    assert circuit.allow()
+
+
+def test_probe_result_closes_or_reopens(clock):
+    circuit = breaker.CircuitBreaker("test", failures=1, reset_after=30)
+    circuit.record_failure()
+
+    clock[0] += 30
+    assert circuit.allow()
+    circuit.record_failure()
+    assert circuit.state == breaker.OPEN
+
+    clock[0] += 30
+    assert circuit.allow()
+    circuit.record_success()
+    assert circuit.state == breaker.CLOSED
+    assert circuit.allow() and circuit.allow()
+
+
+def test_latency_quantile_needs_enough_samples():
+    window = breaker.LatencyWindow(size=100, min_samples=10)
+    for i in range(9):
+        window.observe(i / 100)
+    assert window.quantile(0.95) is None
+
+    for i in range(9, 100):
+        window.observe(i / 100)
+    assert window.quantile(0.95) == 0.94
+    assert window.quantile(0.5) == 0.49
@@ -0,0 +1,61 @@
+import asyncio
+
+import pytest
+
+import cache
+import rapidapi
+
+
+def test_key_ignores_param_order_blanks_and_spacing():
+    assert cache.make_key("searchHotels", {"b": 2, "a": "x  y", "c": None, "d": ""}) == \
+        cache.make_key("searchHotels", {"a": " x y ", "b": "2"})
+    assert cache.make_key("searchHotels", {"dest_id": "1"}) != cache.make_key("getHotelDetails", {"dest_id": "1"})
+
+
+def test_key_folds_case_only_for_free_text():
+    assert cache.make_key("searchDestination", {"query": "PARIS"}) == \
+        cache.make_key("searchDestination", {"query": "paris"})
+    assert cache.make_key("searchHotels", {"dest_id": "AB"}) != cache.make_key("searchHotels", {"dest_id": "ab"})
+
+
+def test_volatile_endpoints_expire_sooner():
+    ttls = rapidapi.CACHE_TTLS
+    assert ttls["searchDestination"] == ttls["getNearbyCities"] == 3 * 24 * 3600
+    assert ttls["searchHotels"] < ttls["getHotelPhotos"] < ttls["searchDestination"]
+    assert "getHotelDetails" in ttls
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def backend(request, tmp_path):
+    if request.param == "memory":
+        backend = cache.MemoryCache(max_entries=2)
+    else:
+        backend = cache.SqliteCache(str(tmp_path / "cache.db"), max_entries=2)
+    yield backend
+    asyncio.run(backend.close())
+
+
+def test_expired_entries_are_only_served_stale(backend, monkeypatch):
+    asyncio.run(backend.set("k", {"v": 1}, ttl=10))
+    assert asyncio.run(backend.get("k")) == {"v": 1}
+
+    now = cache.time.time()
+    monkeypatch.setattr(cache.time, "time", lambda: now + 11)
+    assert asyncio.run(backend.get("k")) is None
+    assert asyncio.run(backend.get("k", stale=True)) == {"v": 1}
+
+
+def test_least_recently_used_entries_are_evicted(backend, monkeypatch):
+    clock = [cache.time.time()]
+    monkeypatch.setattr(cache.time, "time", lambda: clock[0])
+
+    async def scenario():
+        for key in ("a", "b"):
+            await backend.set(key, key, ttl=60)
+            clock[0] += 1
+        await backend.get("a")
+        clock[0] += 1
+        await backend.set("c", "c", ttl=60)
+        return [await backend.get(key) for key in ("a", "b", "c")]
+
+    assert asyncio.run(scenario()) == ["a", None, "c"]
@@ -0,0 +1,171 @@
+import asyncio
+import time
+
+import pytest
+
+import db
+
+
+def on_db_thread(func, *args):
+    return db._executor.submit(func, *args).result()
+
+
+def query(sql, *args):
+    return on_db_thread(lambda: db._connection().execute(sql, args).fetchall())
+
+
+def execute(sql, rows):
+    def run():
+        with db._connection() as conn:
+            conn.executemany(sql, rows)
+    on_db_thread(run)
+
+
+def location(i):
+    return {"label": f"City {i}", "name": f"City {i}", "dest_id": str(i), "search_type": "city"}
+
+
+def store(user_id, **fields):
+    async def scenario():
+        await db.update_session(user_id, **fields)
+        await db.set_locations(user_id, [location(1), location(2)])
+        await db._cache.flush()
+    asyncio.run(scenario())
+
+
+def age(user_id, seconds):
+    execute("UPDATE sessions SET last_activity = ? WHERE user_id = ?", [(time.time() - seconds, user_id)])
+
+
+def test_expired_sessions_go_with_their_child_rows(database):
+    store(1, city_name="Paris")
+    store(2, city_name="Rome")
+    age(1, db.SESSION_TTL + 60)
+
+    expired = on_db_thread(db._expire_sessions, time.time() - db.SESSION_TTL)
+
+    assert expired == [1]
+    assert query("SELECT user_id FROM sessions") == [(2,)]
+    assert query("SELECT DISTINCT user_id FROM session_locations") == [(2,)]
+
+
+def test_clean_expired_sessions_leave_the_cache(database):
+    store(1, city_name="Paris")
+    age(1, db.SESSION_TTL + 60)
+    expired = on_db_thread(db._expire_sessions, time.time() - db.SESSION_TTL)
+
+    database.forget(expired)
+
+    session = asyncio.run(db.get_session(1))
+    assert session.city_name is None
+
+
+def test_a_session_written_during_expiry_is_written_whole(database):
+    store(1, city_name="Paris", adults=2)
+    age(1, db.SESSION_TTL + 60)
+    expired = on_db_thread(db._expire_sessions, time.time() - db.SESSION_TTL)
+    # The user is back between the scan and forget()
+    asyncio.run(db.set_session(1, "adults", 3))
+
+    database.forget(expired)
+    asyncio.run(database.flush())
+
+    assert query("SELECT city_name, adults FROM sessions WHERE user_id = 1") == [("Paris", 3)]
+    assert len(query("SELECT * FROM session_locations WHERE user_id = 1")) == 2
+
+
+def test_trim_limits_rows_drops_orphans_and_shortens_descriptions(database):
+    store(1, city_name="Paris")
+    asyncio.run(db.set_hotels(1, [db.Hotel(str(i), f"Hotel {i}", "x" * 5000) for i in range(3)]))
+    asyncio.run(database.flush())
+    columns = "user_id, position, label, name, city_name, country, image_url, latitude, longitude, dest_id, search_type"
+    execute(
+        f"INSERT INTO session_locations ({columns}) VALUES (?, ?, '', '', '', '', '', NULL, NULL, '', '')",
+        [(1, position) for position in range(2, db.MAX_CHILD_ROWS + 10)] + [(99, 0), (99, 1)]
+    )
+
+    changed = on_db_thread(db._trim_sessions)
+
+    assert query("SELECT COUNT(*) FROM session_locations WHERE user_id = 1") == [(db.MAX_CHILD_ROWS,)]
+    assert query("SELECT COUNT(*) FROM session_locations WHERE user_id = 99") == [(0,)]
+    assert query("SELECT MAX(length(description)) FROM session_hotels") == [(db.MAX_DESCRIPTION,)]
+    assert changed == 10 + 2 + 3
+
+
+def test_flush_writes_only_the_batch_and_keeps_it_when_it_fails(database, monkeypatch):
+    asyncio.run(db.update_session(1, city_name="Paris"))
+    assert query("SELECT * FROM sessions") == []
+
+    def broken(*args):
+        raise OSError("disk full")
+
+    flush = db._flush
+    monkeypatch.setattr(db, "_flush", broken)
+    with pytest.raises(OSError):
+        asyncio.run(database.flush())
+    monkeypatch.setattr(db, "_flush", flush)
+    asyncio.run(database.flush())
+
+    assert query("SELECT city_name FROM sessions WHERE user_id = 1") == [("Paris",)]
+
+
+def test_a_cleared_session_is_written_empty(database):
+    store(1, city_name="Paris")
+    asyncio.run(db.clear_session(1))
+    asyncio.run(database.flush())
+
+    assert query("SELECT * FROM sessions WHERE user_id = 1") == []
+    assert query("SELECT * FROM session_locations WHERE user_id = 1") == []
+
+
+def test_evict_drops_idle_and_excess_clean_sessions_only(database):
+    database.max_sessions = 3
+    store(1, city_name="Paris")
+    store(2, city_name="Rome")
+    asyncio.run(db.update_session(3, city_name="Oslo"))
+    asyncio.run(db.update_session(4, city_name="Bern"))
+
+    # Over capacity: the least recently used clean session made room
+    assert list(database._sessions) == [2, 3, 4]
+
+    database.idle_ttl = 0
+    database.evict()
+    assert list(database._sessions) == [3, 4]
+    # An evicted session is read back from the database
+    assert asyncio.run(db.get_session(1)).city_name == "Paris"
+
+
+def test_a_session_being_flushed_is_not_evicted(database, monkeypatch):
+    flush = db._flush
+
+    def slow_failure(*args):
+        time.sleep(0.05)
+        raise OSError("disk full")
+
+    async def scenario():
+        await db.update_session(1, city_name="Paris")
+        monkeypatch.setattr(db, "_flush", slow_failure)
+        failed = asyncio.create_task(database.flush())
+        await asyncio.sleep(0.01)
+        database.idle_ttl = 0
+        database.evict()
+        with pytest.raises(OSError):
+            await failed
+        monkeypatch.setattr(db, "_flush", flush)
+        await database.flush()
+
+    asyncio.run(scenario())
+    assert query("SELECT city_name FROM sessions WHERE user_id = 1") == [("Paris",)]
+
+
+def test_dirty_keys_without_a_cached_session_do_not_block_the_flush(database):
+    asyncio.run(db.update_session(1, city_name="Paris"))
+    asyncio.run(db.set_locations(1, [location(1)]))
+    asyncio.run(db.update_session(2, city_name="Rome"))
+    database._drop(1)
+
+    asyncio.run(database.flush())
+    asyncio.run(database.flush())
+
+    assert query("SELECT user_id, city_name FROM sessions") == [(2, "Rome")]
+    assert not database._dirty and not database._dirty_children
@@ -0,0 +1,143 @@
+import time
+
+import pytest
+
+import destinations
+
+NEW_YORK = {"dest_id": "20088325", "search_type": "city", "city_name": "New York", "country": "United States",
+            "label": "New York, New York State, United States", "latitude": 40.71, "longitude": -74.0}
+YORK = {"dest_id": "20127504", "search_type": "city", "city_name": "York", "country": "United States",
+        "label": "York, Pennsylvania, United States", "latitude": 39.96, "longitude": -76.73}
+HAMBURG = {"dest_id": "-1785434", "search_type": "city", "city_name": "Hamburg", "country": "Germany",
+           "label": "Hamburg, Germany", "latitude": 53.55, "longitude": 9.99}
+ZURICH = {"dest_id": "-2554935", "search_type": "city", "city_name": "Zürich", "country": "Switzerland",
+          "label": "Zürich, Canton of Zurich, Switzerland", "latitude": 47.37, "longitude": 8.54}
+
+
+@pytest.fixture
+def index():
+    index = destinations.DestinationIndex(path=None)
+    index.add([NEW_YORK], "New York")
+    index.add([HAMBURG], "Hamburg")
+    index.add([ZURICH], "Zürich")
+    return index
+
+
+def test_a_city_asked_for_before_is_answered_locally(index):
+    assert index.lookup("New York", "United States") == [NEW_YORK]
+    assert index.lookup("new  york", "united states") == [NEW_YORK]
+    assert index.lookup("Zurich", "Switzerland") == [ZURICH]
+
+
+@pytest.mark.parametrize("city, country", [
+    ("New", "United States"),
+    ("Ham", "Germany"),
+    ("Hamb", "Germany"),
+])
+def test_a_prefix_goes_upstream(index, city, country):
+    assert index.lookup(city, country) is None
+
+
+@pytest.mark.parametrize("city, country", [
+    ("York", "United States"),
+    ("burg", "Germany"),
+])
+def test_a_substring_goes_upstream(index, city, country):
+    assert index.lookup(city, country) is None
+
+
+def test_a_typo_goes_upstream_and_is_offered_as_a_suggestion(index):
+    assert index.lookup("Hamburgg", "Germany") is None
+    assert index.suggest("Hamburgg", "Germany") == [HAMBURG]
+    assert index.suggest("Zurichh", "Switzerland") == [ZURICH]
+    assert index.suggest("Hamburgg", "France") == []
+
+
+def test_upstream_answer_is_kept_in_its_order(index):
+    index.add([YORK, NEW_YORK], "York")
+
+    assert index.lookup("York", "United States") == [YORK, NEW_YORK]
+    assert index.lookup("York", "Germany") == []
+
+
+def test_an_exact_name_from_another_search_is_answered(index):
+    index.add([YORK, NEW_YORK], "Yor")
+
+    # Named exactly by a fresh record, though never asked for as such
+    assert index.lookup("York", "United States") == [YORK]
+
+
+def test_stale_answers_go_upstream(index):
+    index.add([HAMBURG], "Hamburg", fetched_at=time.time() - index.ttl - 1)
+
+    assert index.lookup("Hamburg", "Germany") is None
+
+
+def test_queries_survive_a_restart(tmp_path, index):
+    index.path = str(tmp_path / "destinations.json")
+    index.close()
+
+    reloaded = destinations.DestinationIndex(path=index.path)
+    assert reloaded.lookup("Hamburg", "Germany") == [HAMBURG]
+    assert reloaded.lookup("Ham", "Germany") is None
+
+
+def city(dest_id, name, latitude, longitude):
+    return {"dest_id": dest_id, "search_type": "city", "city_name": name, "country": "France",
+            "label": f"{name}, France", "latitude": latitude, "longitude": longitude}
+
+
+PARIS = city("-1456928", "Paris", 48.86, 2.35)
+VERSAILLES = city("-1475811", "Versailles", 48.80, 2.13)
+CHARTRES = city("-1418516", "Chartres", 48.45, 1.49)
+LYON = city("-1448468", "Lyon", 45.76, 4.84)
+
+
+def test_nearest_cities_come_closest_first_within_the_radius():
+    index = destinations.DestinationIndex(path=None)
+    index.add([LYON, CHARTRES, PARIS, VERSAILLES])
+
+    found = index.nearest(48.86, 2.35, radius_km=100, exclude=PARIS["dest_id"])
+
+    assert [record["city_name"] for record, _ in found] == ["Versailles", "Chartres"]
+    assert found[0][1] == pytest.approx(17.3, abs=0.5)
+    assert [record for record, _ in index.nearest(48.86, 2.35, k=1, radius_km=100)] == [PARIS]
+
+
+def test_nearest_skips_stale_cities():
+    index = destinations.DestinationIndex(path=None)
+    index.add([PARIS])
+    index.add([VERSAILLES], fetched_at=time.time() - index.ttl - 1)
+
+    assert [record for record, _ in index.nearest(48.86, 2.35, radius_km=100)] == [PARIS]
+
+
+def test_only_the_fields_in_use_are_kept():
+    index = destinations.DestinationIndex(path=None)
+    index.add([{**HAMBURG, "hotels": 1200, "roundtrip": "x" * 500, "cc1": "de"}], "Hamburg")
+
+    assert index.lookup("Hamburg", "Germany") == [HAMBURG]
+
+
+def test_stale_records_are_dropped_when_saved(tmp_path):
+    index = destinations.DestinationIndex(path=str(tmp_path / "destinations.json"))
+    index.add([HAMBURG], "Hamburg", fetched_at=time.time() - index.ttl - 1)
+    index.add([ZURICH], "Zürich")
+    index.close()
+
+    assert len(index) == 1
+    reloaded = destinations.DestinationIndex(path=index.path)
+    assert len(reloaded) == 1
+    assert reloaded.lookup("Zurich", "Switzerland") == [ZURICH]
+
+
+def test_the_oldest_records_go_past_the_size_cap():
+    index = destinations.DestinationIndex(path=None, max_entries=10)
+    now = time.time()
+    for i in range(11):
+        index.add([city(str(i), f"Town {i}", 48.0, 2.0 + i / 100)], f"Town {i}", fetched_at=now - 100 + i)
+
+    assert len(index) == 9
+    # An answer with pruned records goes upstream again
+    assert index.lookup("Town 0", "France") is None
+    assert index.lookup("Town 10", "France") == [city("10", "Town 10", 48.0, 2.1)]
@@ -0,0 +1,53 @@
+import asyncio
+import logging
+import time
+
+import diagnostics
+import metrics
+
+
+def block_the_loop():
+    time.sleep(0.4)
+
+
+def test_stall_is_logged_with_the_blocking_stack(caplog):
+    async def scenario():
+        monitor = diagnostics.LoopMonitor(interval=0.05, threshold=0.15)
+        monitor.start()
+        await asyncio.sleep(0.1)
+        block_the_loop()
+        await asyncio.sleep(0.1)
+        await monitor.stop()
+        return monitor
+
+    stalls = metrics.loop_stalls.value()
+    with caplog.at_level(logging.WARNING, logger="diagnostics"):
+        monitor = asyncio.run(scenario())
+
+    assert metrics.loop_stalls.value() == stalls + 1
+    assert monitor.max_lag >= 0.3
+    assert any("block_the_loop" in record.getMessage() for record in caplog.records)
+
+
+def busy_work():
+    return sum(i * i for i in range(20000))
+
+
+def test_profile_reports_the_hot_path():
+    async def scenario():
+        async def keep_busy():
+            while True:
+                busy_work()
+                await asyncio.sleep(0)
+
+        worker = asyncio.create_task(keep_busy())
+        try:
+            return await diagnostics.profile(0.3, interval=0.002)
+        finally:
+            worker.cancel()
+
+    text = asyncio.run(scenario())
+
+    hottest = text.split("\n")[3]
+    assert hottest.startswith("1. ")
+    assert "test_diagnostics.py:busy_work" in hottest
@@ -0,0 +1,47 @@
+import asyncio
+
+from aiogram.fsm.storage.base import StorageKey
+
+import db
+import fsm_storage
+from hotel_app.states import HotelBookingState
+
+KEY = StorageKey(bot_id=1, chat_id=7, user_id=7)
+
+
+def test_state_and_data_are_kept_in_the_session(database):
+    storage = fsm_storage.SessionStorage(state_ttl=60)
+
+    async def scenario():
+        await storage.set_state(KEY, HotelBookingState.handling_next_step)
+        await storage.set_data(KEY, {"page": 2})
+        await database.flush()
+        return await storage.get_state(KEY), await storage.get_data(KEY), await db.get_session(7)
+
+    state, data, session = asyncio.run(scenario())
+    assert state == HotelBookingState.handling_next_step.state
+    assert data == {"page": 2}
+    assert session.fsm_state == state
+
+
+def test_a_conversation_left_alone_past_the_ttl_comes_back_empty(database, monkeypatch):
+    storage = fsm_storage.SessionStorage(state_ttl=60)
+    asyncio.run(storage.set_state(KEY, HotelBookingState.handling_next_step))
+    asyncio.run(storage.set_data(KEY, {"page": 2}))
+
+    now = fsm_storage.time.time()
+    monkeypatch.setattr(fsm_storage.time, "time", lambda: now + 59)
+    assert asyncio.run(storage.get_state(KEY)) == HotelBookingState.handling_next_step.state
+
+    monkeypatch.setattr(fsm_storage.time, "time", lambda: now + 61)
+    assert asyncio.run(storage.get_state(KEY)) is None
+    assert asyncio.run(storage.get_data(KEY)) == {}
+
+
+def test_no_ttl_keeps_conversations_forever(database, monkeypatch):
+    storage = fsm_storage.SessionStorage(state_ttl=0)
+    asyncio.run(storage.set_state(KEY, HotelBookingState.handling_next_step))
+
+    now = fsm_storage.time.time()
+    monkeypatch.setattr(fsm_storage.time, "time", lambda: now + 365 * 24 * 3600)
+    assert asyncio.run(storage.get_state(KEY)) == HotelBookingState.handling_next_step.state
@@ -0,0 +1,70 @@
+import asyncio
+
+import pytest
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import Message
+
+from hotel_app import gallery
+from load_bench import FakeTelegramSession
+
+
+@pytest.fixture
+def file_ids(monkeypatch):
+    """An in-memory photo_file_ids table in place of the database."""
+    table = {}
+
+    async def get(urls):
+        return {url: table[url] for url in urls if url in table}
+
+    async def save(found):
+        table.update(found)
+
+    async def forget(urls):
+        for url in urls:
+            table.pop(url, None)
+
+    monkeypatch.setattr(gallery, "get_photo_file_ids", get)
+    monkeypatch.setattr(gallery, "save_photo_file_ids", save)
+    monkeypatch.setattr(gallery, "forget_photo_file_ids", forget)
+    return table
+
+
+def send(photos, telegram=None, caption="Hotel"):
+    telegram = telegram or FakeTelegramSession(latency=0)
+    bot = Bot(token="123456:TEST", session=telegram)
+    message = Message.model_validate({
+        "message_id": 1, "date": 0, "chat": {"id": 7, "type": "private"}, "text": "card"
+    }, context={"bot": bot})
+    urls = [f"https://photos.example/{i}.jpg" for i in range(photos)]
+    asyncio.run(gallery.send_gallery(message, urls, caption=caption))
+    return telegram, urls
+
+
+@pytest.mark.parametrize("photos, groups", [(1, []), (2, [2]), (10, [10]), (11, [6, 5]), (21, [7, 7, 7])])
+def test_photos_are_split_into_valid_media_groups(file_ids, photos, groups):
+    telegram, urls = send(photos)
+
+    # The fake session records a media group once per photo
+    sent = list({id(method): method for method in telegram.sent[7]}.values())
+    assert [len(method.media) for method in sent if type(method).__name__ == "SendMediaGroup"] == groups
+    assert telegram.calls.get("SendPhoto", 0) == (1 if photos == 1 else 0)
+    # Nothing was rejected, so every upload is remembered and captioned once
+    assert set(file_ids) == set(urls)
+    assert sum(1 for method in sent for item in getattr(method, "media", None) or [method] if item.caption) == 1
+
+
+def test_photos_sent_one_by_one_are_remembered(file_ids):
+    telegram = FakeTelegramSession(latency=0)
+    original = telegram.make_request
+
+    async def refuse_groups(bot, method, timeout=None):
+        if type(method).__name__ == "SendMediaGroup":
+            raise TelegramBadRequest(method=method, message="Bad Request: failed to get HTTP URL content")
+        return await original(bot, method, timeout)
+
+    telegram.make_request = refuse_groups
+    telegram, urls = send(3, telegram)
+
+    assert telegram.calls["SendPhoto"] == 3
+    assert set(file_ids) == set(urls)
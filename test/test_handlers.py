@@ -0,0 +1,52 @@
+import asyncio
+
+import pytest
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.storage.base import StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+
+import db
+from hotel_app import handlers
+from hotel_app.states import HotelBookingState
+
+
+@pytest.mark.parametrize("text, rooms", [
+    ("One(1)", 1),
+    ("Four(4)", 4),
+    ("2", 2),
+    (" 3 ", 3),
+    ("two", None),
+    ("0", None),
+    ("99", None),
+    ("", None),
+    (None, None),
+])
+def test_parse_room_count(text, rooms):
+    assert handlers.parse_room_count(text) == rooms
+
+
+class Message:
+    def __init__(self, text, user_id=7):
+        self.text = text
+        self.from_user = type("User", (), {"id": user_id})()
+        self.answers = []
+
+    async def answer(self, text, **kwargs):
+        self.answers.append(text)
+
+
+def test_bad_room_count_is_asked_again(database):
+    state = FSMContext(MemoryStorage(), StorageKey(bot_id=1, chat_id=7, user_id=7))
+    msg = Message("two")
+
+    async def scenario():
+        await state.set_state(HotelBookingState.waiting_for_room_count)
+        await handlers.handle_waiting_for_room_count(msg, state)
+        return await state.get_state(), await state.get_data(), await db.get_session(7)
+
+    current, data, session = asyncio.run(scenario())
+
+    assert current == HotelBookingState.waiting_for_room_count.state
+    assert data == {}
+    assert session.room is None
+    assert "number of rooms" in msg.answers[0]
@@ -0,0 +1,124 @@
+import asyncio
+
+import metrics
+from hotel_app import keyboards
+from mock_rapidapi import load_recorded_destinations
+
+
+def test_recorded_destinations_are_loaded():
+    recorded = load_recorded_destinations()
+    assert "paris" in recorded
+    assert recorded["paris"]["data"][0]["label"] == "Paris, Ile de France, France"
+
+
+def test_search_flow_completes_for_concurrent_users(make_bench):
+    bench = make_bench(users=4)
+    report = asyncio.run(bench.run(gallery=False, reserve=False))
+
+    assert not bench.exceptions
+    assert report["error_replies"] == 0
+    assert report["steps"]["search"]["count"] == 4
+    assert report["telegram_calls"]["EditMessageCaption"] == 4 * 12
+
+
+def test_price_limit_and_sort_reuse_the_last_search(make_bench):
+    bench = make_bench(pages=1)
+    report = asyncio.run(bench.run(gallery=False, reserve=False, refine=True))
+
+    assert not bench.exceptions
+    assert report["error_replies"] == 0
+    # Page 1, then the prefetch of the empty page 2; refining and re-sorting add none
+    assert report["upstream_requests"]["searchHotels"] == 2 * 2
+    assert report["upstream_requests"]["getHotelDetails"] == 2 * 12
+
+
+def test_sends_survive_telegram_flood_control(make_bench):
+    bench = make_bench(users=3, flood_every=4)
+    report = asyncio.run(bench.run(gallery=True, reserve=False))
+
+    assert not bench.exceptions
+    assert report["error_replies"] == 0
+    assert report["telegram_calls"]["RetryAfter"] > 0
+    # Every card still arrives and is enriched, in the order it was sent
+    assert report["telegram_calls"]["EditMessageCaption"] == 3 * 12
+
+
+def test_broken_endpoint_trips_its_breaker(make_bench):
+    bench = make_bench(broken=["getHotelDetails"])
+    report = asyncio.run(bench.run(gallery=False, reserve=False))
+
+    assert not bench.exceptions
+    assert report["error_replies"] == 0
+    assert report["steps"]["search"]["count"] == 2
+    # Without the breaker every card would be tried 1 + RAPIDAPI_RETRIES times
+    assert report["upstream_requests"]["getHotelDetails"] < 2 * 12
+
+
+def test_stopping_cancels_the_listing_in_flight(make_bench):
+    cancelled = metrics.user_tasks_cancelled.value(kind="listing")
+    bench = make_bench(telegram_latency=0.02)
+    report = asyncio.run(bench.run(gallery=False, reserve=False, stop_after=0.1))
+
+    assert not bench.exceptions
+    assert report["steps"]["stop"]["count"] == 2
+    assert metrics.user_tasks_cancelled.value(kind="listing") == cancelled + 2
+    # The cards still queued when the users left were never sent
+    assert report["telegram_calls"]["SendPhoto"] < 2 * 12
+
+
+def test_starting_over_cancels_the_listing_and_asks_for_a_destination(make_bench):
+    cancelled = metrics.user_tasks_cancelled.value(kind="listing")
+    bench = make_bench(telegram_latency=0.02)
+    report = asyncio.run(bench.run(gallery=False, reserve=False, stop_after=0.1, stop_with=keyboards.START_OVER))
+
+    assert not bench.exceptions
+    assert report["error_replies"] == 0
+    assert metrics.user_tasks_cancelled.value(kind="listing") == cancelled + 2
+    for user in (1000, 1001):
+        # The destination typed after starting over is looked up again
+        assert any(label.startswith(bench.destinations[user - 1000].split(",")[0])
+                   for label in bench.telegram.last_keyboard(user))
+
+
+def test_moving_to_another_step_cancels_the_listing(make_bench):
+    cancelled = metrics.user_tasks_cancelled.value(kind="listing")
+    bench = make_bench(telegram_latency=0.02)
+    report = asyncio.run(bench.run(gallery=False, reserve=False, stop_after=0.1, stop_with="Set Price Limit"))
+
+    assert not bench.exceptions
+    assert metrics.user_tasks_cancelled.value(kind="listing") == cancelled + 2
+    assert report["telegram_calls"]["SendPhoto"] < 2 * 12
+
+
+def test_searches_beyond_the_limit_wait_in_line(make_bench):
+    bench = make_bench(users=4, telegram_latency=0.005, search_slots=1)
+    report = asyncio.run(bench.run(gallery=False, reserve=False))
+
+    assert not bench.exceptions
+    assert report["error_replies"] == 0
+    assert report["telegram_calls"]["EditMessageCaption"] == 4 * 12
+    # Everyone but the first user was told their place in line
+    queued = [
+        user for user in range(1000, 1004)
+        if any("in line" in (getattr(method, "text", None) or "") for method in bench.telegram.sent[user])
+    ]
+    assert len(queued) >= 3
+
+
+def test_show_more_waits_in_line_only_when_it_goes_upstream(make_bench):
+    def admitted():
+        return sum(count for count, _ in metrics.admission_wait.series().values())
+
+    # Search, refine and re-sort are admitted; the prefetched next page is not
+    before = admitted()
+    bench = make_bench()
+    asyncio.run(bench.run(gallery=False, reserve=False, refine=True))
+    assert not bench.exceptions
+    assert admitted() == before + 2 * 3
+
+    # Without prices the next page still needs getHotelDetails, so it queues too
+    before = admitted()
+    bench = make_bench(broken=["getHotelDetails"])
+    asyncio.run(bench.run(gallery=False, reserve=False, refine=True))
+    assert not bench.exceptions
+    assert admitted() == before + 2 * 4
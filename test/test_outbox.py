@@ -0,0 +1,58 @@
+import asyncio
+
+from aiogram import Bot
+
+import outbox
+import ratelimit
+from load_bench import FakeTelegramSession
+
+
+def send_all(texts):
+    """Send `texts` to one chat while the first is still in flight; an entry
+    (text, True) is sent inside outbox.mergeable()."""
+    telegram = FakeTelegramSession(latency=0.05)
+    telegram.middleware(outbox.SendQueue(1e6, 1e6, 1e6, 1e6))
+    bot = Bot(token="123456:TEST", session=telegram)
+
+    async def send(text, mergeable):
+        if mergeable:
+            with outbox.mergeable():
+                return await bot.send_message(7, text)
+        return await bot.send_message(7, text)
+
+    async def scenario():
+        first = asyncio.create_task(send("first", False))
+        await asyncio.sleep(0.01)
+        rest = [asyncio.create_task(send(text, mergeable)) for text, mergeable in texts]
+        return await asyncio.gather(first, *rest)
+
+    results = asyncio.run(scenario())
+    return [method.text for method in telegram.sent[7]], results
+
+
+def test_only_mergeable_texts_are_merged():
+    sent, results = send_all([("a", True), ("b", True), ("notice", False), ("c", True)])
+
+    assert sent == ["first", "a\n\nb", "notice", "c"]
+    # The notice is its own message, so editing it later touches nothing else
+    assert results[3].text == "notice"
+    assert results[1] is results[2]
+
+
+def test_texts_are_not_merged_by_default():
+    sent, _ = send_all([("a", False), ("b", False)])
+
+    assert sent == ["first", "a", "b"]
+
+
+def test_keyed_buckets_drop_only_idle_least_recent_keys():
+    buckets = ratelimit.KeyedBuckets(rate=1, capacity=2, max_keys=2)
+    busy = buckets.get("busy")
+    busy.try_acquire()
+    buckets.get("idle")
+    assert buckets.get("busy") is busy
+
+    buckets.get("new")
+    # "idle" was the least recently used full bucket
+    assert len(buckets) == 2
+    assert buckets.get("busy") is busy
@@ -0,0 +1,144 @@
+import asyncio
+import time
+from collections import defaultdict
+
+import pytest
+
+import breaker
+import rapidapi
+import ratelimit
+
+
+@pytest.fixture
+def upstream(monkeypatch):
+    """Replaces the network call with one that takes 50 ms and counts calls."""
+    calls = []
+
+    async def fetch(endpoint, params, key, ttl, user_id, priority):
+        calls.append(params)
+        await asyncio.sleep(0.05)
+        return {"data": params}
+
+    monkeypatch.setattr(rapidapi, "_fetch", fetch)
+    monkeypatch.setattr(rapidapi, "CACHE_TTLS", {})
+    return calls
+
+
+def test_identical_calls_share_one_request(upstream):
+    async def scenario():
+        return await asyncio.gather(*(rapidapi.get("searchHotels", {"dest_id": "1"}, user) for user in range(3)))
+
+    results = asyncio.run(scenario())
+
+    assert results == [{"data": {"dest_id": "1"}}] * 3
+    assert len(upstream) == 1
+
+
+def test_one_caller_leaving_does_not_cancel_the_others(upstream):
+    async def scenario():
+        first = asyncio.create_task(rapidapi.get("searchHotels", {"dest_id": "1"}, 1))
+        second = asyncio.create_task(rapidapi.get("searchHotels", {"dest_id": "1"}, 2))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        return await second
+
+    assert asyncio.run(scenario()) == {"data": {"dest_id": "1"}}
+    assert len(upstream) == 1
+
+
+def test_a_call_aborted_by_its_last_caller_is_not_joined(upstream):
+    async def scenario():
+        first = asyncio.create_task(rapidapi.get("searchHotels", {"dest_id": "1"}, 1))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        # Same key, right after: must start a new call, not join the cancelled one
+        second = asyncio.create_task(rapidapi.get("searchHotels", {"dest_id": "1"}, 2))
+        return await second
+
+    assert asyncio.run(scenario()) == {"data": {"dest_id": "1"}}
+    assert len(upstream) == 2
+
+
+@pytest.fixture
+def network(monkeypatch):
+    """Replaces the HTTP request with `network.answers`, one per request in
+    order: an exception to raise or a (delay, body) pair. Retries do not wait,
+    the limiter is unlimited and no breaker or latency history carries over."""
+    class Network:
+        answers = []
+        requests = 0
+
+    async def request(endpoint, params):
+        answer = Network.answers[Network.requests]
+        Network.requests += 1
+        if isinstance(answer, Exception):
+            raise answer
+        delay, body = answer
+        await asyncio.sleep(delay)
+        return body
+
+    unlimited = float("inf")
+    monkeypatch.setattr(rapidapi, "_request", request)
+    monkeypatch.setattr(rapidapi, "CACHE_TTLS", {})
+    monkeypatch.setattr(rapidapi, "RAPIDAPI_RETRY_BACKOFF", 0)
+    monkeypatch.setattr(rapidapi, "limiter", ratelimit.RateLimiter(
+        unlimited, unlimited, unlimited, unlimited, budget=ratelimit.QuotaBudget(path=None)))
+    monkeypatch.setattr(rapidapi, "breakers", {})
+    monkeypatch.setattr(rapidapi, "latencies", defaultdict(breaker.LatencyWindow))
+    return Network
+
+
+def test_server_errors_are_retried(network):
+    network.answers = [rapidapi.RapidAPIError(502), asyncio.TimeoutError(), (0, {"ok": True})]
+
+    assert asyncio.run(rapidapi.get("searchHotels", {"dest_id": "1"})) == {"ok": True}
+    assert network.requests == 3
+
+
+def test_client_errors_are_not_retried(network):
+    network.answers = [rapidapi.RapidAPIError(400, "bad dest_id"), (0, {"ok": True})]
+
+    with pytest.raises(rapidapi.RapidAPIError):
+        asyncio.run(rapidapi.get("searchHotels", {"dest_id": "1"}))
+    assert network.requests == 1
+    # The endpoint answered, so its breaker does not count it
+    assert rapidapi.breakers["searchHotels"].consecutive_failures == 0
+
+
+def test_open_breaker_fails_fast(network, monkeypatch):
+    monkeypatch.setitem(rapidapi.breakers, "searchHotels", breaker.CircuitBreaker("searchHotels", failures=2))
+    network.answers = [rapidapi.RapidAPIError(503)] * 3
+
+    with pytest.raises(rapidapi.CircuitOpen):
+        asyncio.run(rapidapi.get("searchHotels", {"dest_id": "1"}))
+    # Opened after two failures; the last retry was never sent
+    assert network.requests == 2
+    assert not rapidapi.available("searchHotels")
+
+
+def slow_history(endpoint, seconds=0.01):
+    for _ in range(rapidapi.latencies[endpoint].min_samples):
+        rapidapi.latencies[endpoint].observe(seconds)
+
+
+def test_a_slow_call_is_hedged_and_the_first_answer_wins(network):
+    slow_history("searchHotels")
+    network.answers = [(0.5, {"from": "primary"}), (0, {"from": "hedge"})]
+
+    async def scenario():
+        started = time.perf_counter()
+        result = await rapidapi.get("searchHotels", {"dest_id": "1"})
+        return result, time.perf_counter() - started
+
+    result, elapsed = asyncio.run(scenario())
+    assert result == {"from": "hedge"}
+    assert network.requests == 2
+    assert elapsed < 0.25
+
+
+def test_optional_calls_are_never_hedged(network):
+    slow_history("getHotelDetails")
+    network.answers = [(0.05, {"from": "primary"}), (0, {"from": "hedge"})]
+
+    assert asyncio.run(rapidapi.get("getHotelDetails", {"hotel_id": "1"})) == {"from": "primary"}
+    assert network.requests == 1
@@ -0,0 +1,115 @@
+import asyncio
+import json
+
+import pytest
+
+import ratelimit
+from ratelimit import CRITICAL, NORMAL, OPTIONAL
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(ratelimit.time, "monotonic", clock)
+    return clock
+
+
+def test_bucket_allows_a_burst_then_refills_at_its_rate(clock):
+    bucket = ratelimit.TokenBucket(rate=2, capacity=3)
+
+    assert [bucket.try_acquire() for _ in range(4)] == [True, True, True, False]
+    clock.now += 0.5
+    assert bucket.try_acquire()
+    assert not bucket.try_acquire()
+    # Never more than the capacity, however long it was idle
+    clock.now += 60
+    assert bucket.idle
+    assert [bucket.try_acquire() for _ in range(4)] == [True, True, True, False]
+
+
+def test_drained_bucket_stays_empty_for_the_penalty(clock):
+    bucket = ratelimit.TokenBucket(rate=2, capacity=3)
+
+    bucket.drain(5)
+    clock.now += 5
+    assert not bucket.try_acquire()
+    clock.now += 0.5
+    assert bucket.try_acquire()
+
+
+def test_keyed_buckets_drop_only_idle_ones(clock):
+    buckets = ratelimit.KeyedBuckets(rate=1, capacity=1, max_keys=2)
+
+    buckets.get("a").try_acquire()
+    buckets.get("b")
+    buckets.get("c")
+    # "a" still has to refill, so it is kept
+    assert len(buckets) == 3
+    clock.now += 1
+    buckets.get("d")
+    assert list(buckets._buckets) == ["c", "d"]
+
+
+def test_budget_keeps_a_reserve_for_important_calls():
+    budget = ratelimit.QuotaBudget(daily=100, monthly=0, path=None)
+
+    for _ in range(76):
+        budget.spend()
+    assert not budget.allows(OPTIONAL)
+    assert budget.allows(NORMAL)
+    for _ in range(15):
+        budget.spend()
+    assert not budget.allows(NORMAL)
+    assert budget.allows(CRITICAL)
+    for _ in range(9):
+        budget.spend()
+    assert not budget.allows(CRITICAL)
+
+
+def test_budget_is_unlimited_without_quotas():
+    budget = ratelimit.QuotaBudget(daily=0, monthly=0, path=None)
+
+    for _ in range(1000):
+        budget.spend()
+    assert budget.remaining_share() == 1.0
+
+
+def test_budget_counts_survive_a_restart_of_the_same_day(tmp_path):
+    path = str(tmp_path / "quota.json")
+    budget = ratelimit.QuotaBudget(daily=100, monthly=1000, path=path)
+    for _ in range(30):
+        budget.spend()
+    budget.save()
+
+    assert ratelimit.QuotaBudget(daily=100, monthly=1000, path=path).used_today == 30
+
+    with open(path, encoding="utf-8") as state_file:
+        state = json.load(state_file)
+    state["day"] = "2000-01-01"
+    with open(path, "w", encoding="utf-8") as state_file:
+        json.dump(state, state_file)
+    reloaded = ratelimit.QuotaBudget(daily=100, monthly=1000, path=path)
+    # A new day starts from zero; the month's count carries over
+    assert (reloaded.used_today, reloaded.used_this_month) == (0, 30)
+
+
+def test_limiter_refuses_calls_the_budget_cannot_cover():
+    unlimited = float("inf")
+    budget = ratelimit.QuotaBudget(daily=4, monthly=0, path=None)
+    limiter = ratelimit.RateLimiter(unlimited, unlimited, unlimited, unlimited, budget=budget)
+
+    async def scenario():
+        for _ in range(4):
+            await limiter.acquire(1, OPTIONAL)
+
+    with pytest.raises(ratelimit.QuotaExceeded):
+        asyncio.run(scenario())
+    assert budget.used_today == 3
@@ -0,0 +1,281 @@
+import asyncio
+import os
+import signal
+import socket
+import time
+
+import aiohttp
+import pytest
+from aiogram import Bot, Dispatcher, Router
+from aiogram.types import Update, WebhookInfo
+
+import sharding
+import usertasks
+import webhook
+from config import TELEGRAM_RATE, TELEGRAM_BURST, SEARCH_CONCURRENCY
+from load_bench import FakeTelegramSession
+
+
+def test_workers_split_the_shared_limits():
+    shards = 3
+    environments = [sharding._worker_environment(index, shards) for index in range(shards)]
+
+    assert sum(float(env["TELEGRAM_RATE"]) for env in environments) == TELEGRAM_RATE
+    assert sum(int(env["TELEGRAM_BURST"]) for env in environments) <= TELEGRAM_BURST
+    assert sum(int(env["SEARCH_CONCURRENCY"]) for env in environments) <= SEARCH_CONCURRENCY
+    # One file of each kind per worker
+    for name in ("LOG_PATH", "DESTINATION_INDEX_PATH", "RAPIDAPI_QUOTA_STATE", "METRICS_PORT"):
+        assert len({env[name] for env in environments}) == shards
+
+
+@pytest.mark.parametrize("update, user_id", [
+    ({"update_id": 1, "message": {"from": {"id": 42}, "chat": {"id": 42}}}, 42),
+    ({"update_id": 1, "edited_message": {"from": {"id": 7}, "chat": {"id": 7}}}, 7),
+    ({"update_id": 1, "callback_query": {"id": "1", "from": {"id": 9}, "message": {"chat": {"id": 9}}}}, 9),
+    ({"update_id": 1, "my_chat_member": {"chat": {"id": -100}, "from": {"id": 5}}}, 5),
+    ({"update_id": 1, "channel_post": {"chat": {"id": -200}}}, -200),
+    ({"update_id": 1}, 0),
+])
+def test_user_id_of(update, user_id):
+    assert sharding.user_id_of(update) == user_id
+
+
+def test_shard_of_is_stable_and_spreads_users():
+    shards = 4
+    assignments = [sharding.shard_of(user_id, shards) for user_id in range(1000)]
+
+    assert assignments == [sharding.shard_of(user_id, shards) for user_id in range(1000)]
+    counts = [assignments.count(shard) for shard in range(shards)]
+    assert min(counts) > 1000 / shards * 0.8
+
+
+def test_updates_of_one_user_run_in_order_and_users_run_concurrently():
+    handled = []
+
+    async def handle(user_id, number, delay):
+        await asyncio.sleep(delay)
+        handled.append((user_id, number))
+
+    async def scenario():
+        users = sharding._UserQueue()
+        started = time.monotonic()
+        for number, delay in enumerate([0.05, 0.01, 0.03]):
+            users.submit(1, handle(1, number, delay))
+            users.submit(2, handle(2, number, delay))
+        await users.drain()
+        return time.monotonic() - started
+
+    elapsed = asyncio.run(scenario())
+
+    assert [number for user_id, number in handled if user_id == 1] == [0, 1, 2]
+    assert [number for user_id, number in handled if user_id == 2] == [0, 1, 2]
+    # Both users' updates ran side by side, not one after the other
+    assert elapsed < 0.15
+
+
+def test_a_handed_off_listing_can_be_cancelled_by_the_next_update():
+    registry = usertasks.UserTasks()
+    events = []
+
+    async def listing():
+        await asyncio.sleep(5)
+        events.append("listing done")
+
+    async def search():
+        await registry.run(1, "listing", listing())
+        events.append("search handler done")
+
+    async def stop():
+        events.append("stop")
+        registry.cancel(1)
+
+    async def scenario():
+        users = sharding._UserQueue()
+        started = time.monotonic()
+        users.submit(1, search())
+        users.submit(1, stop())
+        await users.drain()
+        return time.monotonic() - started
+
+    assert asyncio.run(scenario()) < 1
+    # Stop ran while the listing was still going, and cut it short
+    assert events == ["stop", "search handler done"]
+
+
+def create_recording_worker():
+    """Dispatcher of a real shard worker that appends each message's text to
+    the file named by SHARDING_TEST_OUTPUT."""
+    router = Router()
+
+    @router.message()
+    async def record(msg):
+        with open(os.environ["SHARDING_TEST_OUTPUT"], "a", encoding="utf-8") as output:
+            output.write(msg.text + "\n")
+
+    dp = Dispatcher()
+    dp.include_router(router)
+    return dp, Bot(token="123456:TEST", session=FakeTelegramSession(latency=0))
+
+
+def _message(update_id, text):
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id, "date": 0, "text": text,
+            "chat": {"id": 5, "type": "private"}, "from": {"id": 5, "is_bot": False, "first_name": "A"},
+        },
+    }
+
+
+def test_a_killed_worker_is_restarted_and_gets_its_updates(tmp_path, monkeypatch):
+    output = tmp_path / "handled.txt"
+    output.touch()
+    monkeypatch.setenv("SHARDING_TEST_OUTPUT", str(output))
+
+    def handled():
+        return output.read_text(encoding="utf-8").split()
+
+    async def wait_for(texts, timeout=15):
+        deadline = time.monotonic() + timeout
+        while handled() != texts and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        return handled()
+
+    async def scenario():
+        runtime = sharding.ShardedRuntime(1, create_recording_worker)
+        runtime.start()
+        supervisor = asyncio.create_task(runtime.supervise())
+        worker = runtime.workers[0]
+        try:
+            runtime.dispatch(_message(1, "one"))
+            assert await wait_for(["one"]) == ["one"]
+            # Idle, so it dies blocked in queue.get()
+            await asyncio.sleep(0.2)
+            old = worker.process
+            os.kill(old.pid, signal.SIGKILL)
+            old.join()
+            runtime.dispatch(_message(2, "two"))
+            assert await wait_for(["one", "two"]) == ["one", "two"]
+            assert worker.process is not old
+            runtime.dispatch(_message(3, "three"))
+            assert await wait_for(["one", "two", "three"]) == ["one", "two", "three"]
+        finally:
+            supervisor.cancel()
+            await asyncio.get_running_loop().run_in_executor(None, runtime.stop)
+        return worker
+
+    worker = asyncio.run(scenario())
+
+    assert worker.restarts == 1
+    assert worker.process.exitcode == 0
+
+
+def test_a_crash_loop_backs_off():
+    worker = sharding._Worker(0, 1, None)
+    worker.started_at = time.monotonic()
+
+    delays = []
+    for _ in range(7):
+        delays.append(worker.restart_delay())
+        worker.restarts += 1
+    assert delays == [0, 1, 3, 7, 15, 30, 30]
+
+
+def test_polled_callbacks_are_routed_by_their_sender():
+    update = Update.model_validate({
+        "update_id": 1,
+        "callback_query": {
+            "id": "1", "chat_instance": "c", "inline_message_id": "m", "data": "moreinfo_1",
+            "from": {"id": 9, "is_bot": False, "first_name": "A"},
+        },
+    })
+
+    class PollingBot:
+        async def get_webhook_info(self):
+            return WebhookInfo(url="", has_custom_certificate=False, pending_update_count=0)
+
+        async def __call__(self, method):
+            if method.offset is None:
+                return [update]
+            await asyncio.Event().wait()
+
+    class Runtime:
+        def __init__(self):
+            self.updates = []
+
+        def dispatch(self, raw):
+            self.updates.append(raw)
+
+    runtime = Runtime()
+
+    async def scenario():
+        dp = Dispatcher()
+        dp.include_router(Router())
+        poll = asyncio.create_task(sharding._poll(runtime, dp, PollingBot()))
+        while not runtime.updates:
+            await asyncio.sleep(0.01)
+        poll.cancel()
+        await asyncio.wait([poll])
+
+    asyncio.run(asyncio.wait_for(scenario(), 5))
+
+    assert [sharding.user_id_of(raw) for raw in runtime.updates] == [9]
+    assert runtime.updates[0]["callback_query"]["from"]["id"] == 9
+
+
+def _free_port():
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+
+def test_webhook_front_forwards_only_verified_updates(monkeypatch):
+    port = _free_port()
+    monkeypatch.setattr(webhook, "WEBHOOK_BASE_URL", "https://bot.example")
+    monkeypatch.setattr(webhook, "WEBHOOK_SECRET", "s3cret")
+    monkeypatch.setattr(sharding, "WEBHOOK_SECRET", "s3cret")
+    monkeypatch.setattr(sharding, "WEBHOOK_HOST", "127.0.0.1")
+    monkeypatch.setattr(sharding, "WEBHOOK_PORT", port)
+
+    class Runtime:
+        def __init__(self):
+            self.updates = []
+
+        def dispatch(self, update):
+            self.updates.append(update)
+
+    async def scenario():
+        runtime = Runtime()
+        telegram = FakeTelegramSession(latency=0)
+        bot = Bot(token="123456:TEST", session=telegram)
+        dp = Dispatcher()
+        dp.include_router(Router())
+        server = asyncio.create_task(sharding._serve_webhook(runtime, dp, bot))
+        url = f"http://127.0.0.1:{port}{webhook.WEBHOOK_PATH}"
+        update = {"update_id": 1, "message": {"from": {"id": 3}, "chat": {"id": 3}}}
+        try:
+            async with aiohttp.ClientSession() as session:
+                for _ in range(50):
+                    try:
+                        async with session.get(f"http://127.0.0.1:{port}/healthz") as response:
+                            if response.status == 200:
+                                break
+                    except aiohttp.ClientError:
+                        await asyncio.sleep(0.02)
+                async with session.post(url, json=update) as unsigned:
+                    assert unsigned.status == 401
+                headers = {"X-Telegram-Bot-Api-Secret-Token": "wrong"}
+                async with session.post(url, json=update, headers=headers) as forged:
+                    assert forged.status == 401
+                headers = {"X-Telegram-Bot-Api-Secret-Token": "s3cret"}
+                async with session.post(url, json=update, headers=headers) as signed:
+                    assert signed.status == 200
+        finally:
+            server.cancel()
+            await asyncio.wait([server])
+        return runtime, telegram
+
+    runtime, telegram = asyncio.run(scenario())
+
+    assert runtime.updates == [{"update_id": 1, "message": {"from": {"id": 3}, "chat": {"id": 3}}}]
+    assert telegram.calls["SetWebhook"] == 1
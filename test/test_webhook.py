@@ -0,0 +1,28 @@
+import pytest
+
+import webhook
+
+
+@pytest.fixture
+def configured(monkeypatch):
+    monkeypatch.setattr(webhook, "WEBHOOK_BASE_URL", "https://bot.example")
+    monkeypatch.setattr(webhook, "WEBHOOK_SECRET", "s3cret_token-1")
+
+
+def test_a_complete_config_passes(configured):
+    webhook.check_config()
+
+
+@pytest.mark.parametrize("secret", [None, "", "has spaces", "x" * 257])
+def test_webhook_mode_needs_a_valid_secret(configured, monkeypatch, secret):
+    monkeypatch.setattr(webhook, "WEBHOOK_SECRET", secret)
+
+    with pytest.raises(RuntimeError, match="WEBHOOK_SECRET"):
+        webhook.check_config()
+
+
+def test_webhook_mode_needs_a_base_url(configured, monkeypatch):
+    monkeypatch.setattr(webhook, "WEBHOOK_BASE_URL", "")
+
+    with pytest.raises(RuntimeError, match="WEBHOOK_BASE_URL"):
+        webhook.check_config()
@@ -0,0 +1,142 @@
+"""Registry of the long-running work each user has in flight.
+
+Search listings, galleries and prefetches run as tasks registered under the
+user and a kind ("listing", "gallery", "prefetch"). Starting a task of a kind
+cancels the user's previous task of that kind, and cancel() drops everything
+a user was still waiting for when they move on, e.g. start over or stop.
+Moving to another conversation state (Reserve Room, Set Price Limit, ...)
+cancels the listing and gallery being sent, through the FSMContext that
+StateChangeMiddleware gives the handlers; a prefetch belongs to the search,
+not the step, and is kept. A
+cancelled task stops at its next await. Telegram sends it had queued are
+dropped (see outbox.py), and upstream calls nobody else waits for are
+aborted (see rapidapi.get)."""
+import asyncio
+import contextvars
+from collections import defaultdict
+from aiogram import BaseMiddleware
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.state import State
+import metrics
+
+# Set by a runtime that runs a user's updates one after another (see
+# sharding.py): called once a handler has handed its long work to a task, so
+# the user's next update, e.g. Stop Session, can start and cancel it
+handed_off = contextvars.ContextVar("handed_off", default=None)
+
+
+class UserTasks:
+    def __init__(self):
+        self._tasks = defaultdict(dict)
+
+    def start(self, user_id, kind, coroutine, chain=False):
+        """Run `coroutine` in the background as the user's `kind` task,
+        replacing (and cancelling) the one already running. With `chain` the
+        running one is not cancelled but finishes first, for work the new
+        task can build on."""
+        previous = self._tasks.get(user_id, {}).get(kind)
+        if chain and previous is not None and not previous.done():
+            coroutine = self._after(previous, coroutine)
+        else:
+            self._cancel(user_id, kind)
+        task = self._tasks[user_id][kind] = asyncio.create_task(coroutine)
+        task.add_done_callback(lambda done: self._forget(user_id, kind, done))
+        return task
+
+    @staticmethod
+    async def _after(previous, coroutine):
+        try:
+            await asyncio.wait([previous])
+        except asyncio.CancelledError:
+            # Cancelling the chain cancels all of it
+            previous.cancel()
+            coroutine.close()
+            raise
+        return await coroutine
+
+    async def run(self, user_id, kind, coroutine):
+        """Like start(), but wait for the task. Returns None when the task was
+        superseded; a cancellation of the caller itself still propagates."""
+        task = self.start(user_id, kind, coroutine)
+        release = handed_off.get()
+        if release is not None:
+            release()
+        try:
+            return await task
+        except asyncio.CancelledError:
+            if task.cancelled() and not asyncio.current_task().cancelling():
+                return None
+            raise
+
+    async def wait(self, user_id, kind):
+        task = self._tasks.get(user_id, {}).get(kind)
+        if task is not None:
+            await asyncio.wait([task])
+
+    def cancel(self, user_id, *kinds):
+        """Cancel the user's tasks of `kinds`, or all of them."""
+        for kind in kinds or list(self._tasks.get(user_id, ())):
+            self._cancel(user_id, kind)
+
+    def leave(self, user_id):
+        """The user moved to another step: cancel what is being sent to them.
+        One of the tasks moving its own user along, like a listing showing its
+        results, cancels nothing."""
+        if asyncio.current_task() in self._tasks.get(user_id, {}).values():
+            return
+        self.cancel(user_id, "listing", "gallery")
+
+    def _cancel(self, user_id, kind):
+        task = self._tasks.get(user_id, {}).pop(kind, None)
+        # A task never cancels itself, e.g. a listing that starts over from a fresh search
+        if task is not None and not task.done() and task is not asyncio.current_task():
+            task.cancel()
+            metrics.user_tasks_cancelled.inc(kind=kind)
+        if user_id in self._tasks and not self._tasks[user_id]:
+            del self._tasks[user_id]
+
+    def _forget(self, user_id, kind, task):
+        tasks = self._tasks.get(user_id)
+        if tasks is not None and tasks.get(kind) is task:
+            del tasks[kind]
+            if not tasks:
+                del self._tasks[user_id]
+        if not task.cancelled():
+            # Whoever awaited the task (see run) saw the exception; a background
+            # task must handle its own, this only keeps asyncio from warning
+            task.exception()
+
+    async def close(self):
+        """Cancel every task and wait for them, before the HTTP sessions go."""
+        tasks = [task for user_tasks in self._tasks.values() for task in user_tasks.values()]
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.wait(tasks)
+
+
+class _LeavingContext(FSMContext):
+    async def set_state(self, state=None):
+        name = state.state if isinstance(state, State) else state
+        if name != await self.get_state():
+            registry.leave(self.key.user_id)
+        await super().set_state(state)
+
+
+class StateChangeMiddleware(BaseMiddleware):
+    """Inner middleware on router observers: the handler's FSMContext cancels
+    the user's listing and gallery when it moves them to another state
+    (clear() included)."""
+
+    async def __call__(self, handler, event, data):
+        state = data.get("state")
+        if state is not None:
+            data["state"] = _LeavingContext(storage=state.storage, key=state.key)
+        return await handler(event, data)
+
+
+registry = UserTasks()
+
+
+async def close():
+    await registry.close()
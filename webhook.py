@@ -0,0 +1,97 @@
+"""Webhook runtime: Telegram pushes updates to an aiohttp server instead of
+the bot long-polling for them.
+
+Each request is verified against WEBHOOK_SECRET, which is required: without it
+anyone who can reach the port could post forged updates. Accepted updates are
+answered with 200 right away and handled in a background task. At most
+WEBHOOK_MAX_IN_FLIGHT updates are processed at once; beyond that the server
+answers 503 so Telegram redelivers later.
+
+Sessions and FSM state are cached per process (see db.py), so run one
+instance; to use more cores, start it with --workers, which shards users
+across worker processes behind this one server (see sharding.py)."""
+import logging
+import re
+from aiohttp import web
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+import metrics
+from config import (
+    WEBHOOK_BASE_URL, WEBHOOK_PATH, WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_SECRET, WEBHOOK_MAX_IN_FLIGHT
+)
+
+logger = logging.getLogger(__name__)
+
+# What Telegram accepts as a secret_token
+SECRET_PATTERN = re.compile(r"[A-Za-z0-9_-]{1,256}")
+
+webhook_rejected = metrics.Counter(
+    "webhook_rejected_total", "Updates refused because too many were in flight"
+)
+
+
+class BoundedRequestHandler(SimpleRequestHandler):
+    def __init__(self, dispatcher, bot, max_in_flight=WEBHOOK_MAX_IN_FLIGHT, **kwargs):
+        super().__init__(dispatcher, bot, handle_in_background=True, **kwargs)
+        self.max_in_flight = max_in_flight
+
+    @property
+    def in_flight(self):
+        return len(self._background_feed_update_tasks)
+
+    async def _handle_request_background(self, bot, request):
+        if self.in_flight >= self.max_in_flight:
+            webhook_rejected.inc()
+            return web.Response(status=503, headers={"Retry-After": "1"})
+        return await super()._handle_request_background(bot, request)
+
+
+async def _health(request):
+    return web.json_response({"status": "ok"})
+
+
+def check_config():
+    """Refuse to start a webhook that is unreachable or open to anyone."""
+    if not WEBHOOK_BASE_URL:
+        raise RuntimeError("WEBHOOK_BASE_URL must be set to run in webhook mode")
+    if not WEBHOOK_SECRET:
+        raise RuntimeError("WEBHOOK_SECRET must be set to run in webhook mode")
+    if not SECRET_PATTERN.fullmatch(WEBHOOK_SECRET):
+        raise RuntimeError("WEBHOOK_SECRET must be 1-256 characters of A-Z, a-z, 0-9, _ and -")
+
+
+def create_app(dp, bot, handler=None):
+    """The webhook app. `handler` receives the verified updates; by default
+    a BoundedRequestHandler feeding `dp`."""
+    check_config()
+
+    async def set_webhook():
+        await bot.set_webhook(
+            url=WEBHOOK_BASE_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            max_connections=max(1, min(100, WEBHOOK_MAX_IN_FLIGHT)),
+            allowed_updates=dp.resolve_used_update_types()
+        )
+        logger.info(f"Webhook set to {WEBHOOK_BASE_URL.rstrip('/')}{WEBHOOK_PATH}")
+
+    dp.startup.register(set_webhook)
+
+    app = web.Application()
+    app.router.add_get("/healthz", _health)
+    handler = handler or BoundedRequestHandler(dp, bot, secret_token=WEBHOOK_SECRET)
+    handler.register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+    return app
+
+
+async def delete_for_polling(bot):
+    """Delete a webhook left set, since getUpdates is refused while one is.
+    Warn about it: if a bot is still running in webhook mode elsewhere, the
+    two keep disconnecting each other."""
+    info = await bot.get_webhook_info()
+    if info.url:
+        logger.warning(f"Deleting the webhook set to {info.url}; stop any bot running in webhook mode")
+        await bot.delete_webhook()
+
+
+def run(dp, bot):
+    web.run_app(create_app(dp, bot), host=WEBHOOK_HOST, port=WEBHOOK_PORT)